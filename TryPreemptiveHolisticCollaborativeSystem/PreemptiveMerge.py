@@ -1,18 +1,28 @@
 import platform
 import copy
+import logging
 import os
 import sys
+# Modules shared by the simulation drivers.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+from backend import select_backend
+# 运行方式: traci (默认) 或 libsumo, 由命令行参数 --backend 或环境变量 SUMO_BACKEND 选择, 须在导入 traci 之前
+select_backend()
 import traci
 from xml.etree import ElementTree as ET
 import pandas as pd
 import numpy as np
 from scipy.interpolate import CubicSpline
-import matplotlib.pyplot as plt
-import csv
-from preemptive_follow import TrajectoryMerge
+from preemptive_follow import TrajectoryMerge, AsyncTrajectoryMerge
+from actuation import MoveToActuator, KeyframeActuator
+from arrivals import save_arrivals
 from tools import scale_series
+from observation import VehicleObserver
+from telemetry import TelemetryRecorder
+from plotting import draw_td
 
-
+# 规划器日志 (preemptive_follow): 默认只输出警告和错误, 需要逐车的规划过程时设置环境变量 LOG_LEVEL=DEBUG
+logging.basicConfig(format='%(levelname)s %(name)s: %(message)s', level=os.environ.get('LOG_LEVEL', 'WARNING'))
 
 np.random.seed(1024)
 
@@ -30,17 +40,24 @@ system = platform.system()
 if system == "Linux":
     tools = r'/usr/share/sumo/tools'
     sumo_gui = r'/usr/bin/sumo-gui'
+    sumo_cli = r'/usr/bin/sumo'
 else:
     if 'SUMO_HOME' in os.environ or True:
         tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
         sumo_gui = os.path.join(os.environ['SUMO_HOME'], 'bin\\sumo-gui')
+        sumo_cli = os.path.join(os.environ['SUMO_HOME'], 'bin\\sumo')
         sys.path.append(tools)
     else:
         sys.exit("please declare environment variable 'SUMO_HOME'")
 
 
+# 路网文件, 及主路车和匝道车的路线 (起点边, 终点边)
+NET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1.test.net.xml")
+ROUTES = {'m': ('E0', 'E3'), 'r': ('E1', 'E3')}
+
+
 # 根据车流量生成rou文件
-def update_rou(e_flow, r_flow):
+def update_rou(e_flow, r_flow, filename="1.test.rou.xml"):
     # 创建根标签
     root = ET.Element("routes")
 
@@ -62,7 +79,8 @@ def update_rou(e_flow, r_flow):
     period = number / 3600
     if number > 0:
         flow = ET.Element('flow',
-                          {'id': 'm', 'type': "cav_m", 'from': 'E0', 'to': 'E3', 'departLane': 'random',
+                          {'id': 'm', 'type': "cav_m", 'from': ROUTES['m'][0], 'to': ROUTES['m'][1],
+                           'departLane': 'random',
                            'departSpeed': '14', 'begin': "0", 'period': f'exp({period})', 'number': str(number)})
         root.append(flow)
     # 增加车流:匝道车
@@ -70,12 +88,13 @@ def update_rou(e_flow, r_flow):
     period = number / 3600
     if number > 0:
         flow = ET.Element('flow',
-                          {'id': 'r', 'type': "cav_r", 'from': 'E1', 'to': 'E3', 'departLane': 'random',
+                          {'id': 'r', 'type': "cav_r", 'from': ROUTES['r'][0], 'to': ROUTES['r'][1],
+                           'departLane': 'random',
                            'departSpeed': '7', 'begin': "0", 'period': f'exp({period})', 'number': str(number)})
         root.append(flow)
     # 保存文件
     tree = ET.ElementTree(root)
-    tree.write("1.test.rou.xml", encoding='utf-8', xml_declaration=True)
+    tree.write(filename, encoding='utf-8', xml_declaration=True)
 
 
 
@@ -83,54 +102,69 @@ def update_rou(e_flow, r_flow):
 
 
 # 主函数
-def run_sumo(t, e_flow, r_flow):
+# actuation: 'moveTo' 每步把每辆车移到轨迹上; 'keyframes' 以分段速度 (setSpeed) 驱动车辆, 偏离轨迹超过阈值时才用 moveTo 纠正
+# planner: 'sync' 在仿真步内规划新车轨迹; 'async' 在后台线程规划, 每步最多等待 deadline 秒, 未完成时车辆先按自由行驶轨迹运行
+# resolution: 轨迹规划的时间步长 (秒), 默认为仿真步长; 较粗时控制器每步在轨迹采样点之间插值
+# representation: 'dense' 轨迹按每步采样存储; 'piecewise' 存为分段匀加速多项式, 读取时才计算采样点
+def run_sumo(t, e_flow, r_flow, out_dir=prefix, actuation='moveTo', planner='sync', deadline=0.005, resolution=None,
+             representation='dense'):
     step = 0
-    # 用来储存数据
-    veh_info = []
-    veh_td_3d = []
-    veh_timeloss = {}
-    veh_fuel = []
-    previous_vehicle_list = []
-    tp = TrajectoryMerge()
+    actuator = KeyframeActuator() if actuation == 'keyframes' else MoveToActuator()
+    # 边仿真边写出数据
+    recorder = TelemetryRecorder(out_dir, e_flow, r_flow)
+    fuel_total = 0
+    # 已检测到的车辆
+    known_vehicles = set()
+    if planner == 'async':
+        tp = AsyncTrajectoryMerge(NET_FILE, ROUTES, deadline=deadline, resolution=resolution,
+                                  representation=representation)
+    else:
+        tp = TrajectoryMerge(NET_FILE, ROUTES, resolution=resolution, representation=representation)
+    # 轨迹比仿真步长粗时, 在采样点之间插值
+    interpolate = tp.step_length > traci.simulation.getDeltaT()
+    # 订阅车辆状态, 每步一次取回所有车辆的数据
+    observer = VehicleObserver()
     # 调节仿真时间
     while traci.simulation.getTime() < t:
         # 仿真运行一步
         traci.simulationStep()
         # print(f"simulation time of Current Step: {traci.simulation.getTime()}")
+        states = observer.update()
         # 获取车辆列表
         vehicle_list = traci.vehicle.getIDList()
         for t_vehicle in vehicle_list:
-            if t_vehicle not in previous_vehicle_list:
+            if t_vehicle not in known_vehicles:
                 try:
                     tp.check_new_vehicle(t_vehicle)
                 except Exception as e:
                     pass
-                previous_vehicle_list.append(t_vehicle)
-
-        # for t_vehicle in previous_vehicle_list:
-        #     if t_vehicle not in vehicle_list:
-        #         try:
-        #             previous_vehicle_list.remove(t_vehicle)
-        #             del tp.scheduled_trajectories[t_vehicle]
-        #         except Exception as e:
-        #             pass
+                known_vehicles.add(t_vehicle)
+        # 离开路网的车辆, 其轨迹在不再作为前车后释放. (getIDList 不能用来判断: moveTo 时车辆可能有一步不在其中)
+        arrived = traci.simulation.getArrivedIDList()
+        tp.vehicles_left(arrived)
+        for t_vehicle in arrived:
+            actuator.forget(t_vehicle)
+        # 取得本步已完成的规划
+        tp.collect()
 
         # 获取燃油消耗数据
         if step % 100 == 0:
             if step / 100 == 0:
-                veh_fuel.append([0, 0])
+                recorder.record_fuel(0, 0)
             else:
                 fuel_sum = 0
                 for i in vehicle_list:
-                    fuel = traci.vehicle.getFuelConsumption(i)
+                    fuel = states[i][VehicleObserver.FUEL_CONSUMPTION]
                     fuel_sum += fuel
-                veh_fuel.append([step / 100, round((veh_fuel[-1][-1] + fuel_sum / 1000000), 2)])
+                fuel_total = round((fuel_total + fuel_sum / 1000000), 2)
+                recorder.record_fuel(step / 100, fuel_total)
         current_time = traci.simulation.getTime()
         for i in vehicle_list:
             try:
-                try:
-                    t_index = np.where(tp.scheduled_trajectories[i]['trajectory']['time'] >= current_time)[0][0]
-                except IndexError:
+                t_trajectory = tp.trajectory(i)
+                target = t_trajectory.target_at(current_time, interpolate)
+                if target is None:
+                    # The scheduled trajectory has been finished.
                     try:
                         traci.vehicle.remove(i)
                     except Exception as e:
@@ -138,35 +172,35 @@ def run_sumo(t, e_flow, r_flow):
                     continue
                 if step % 1000 == 0:
                     try:
-                        t_time = tp.scheduled_trajectories[i]['trajectory']['time'][t_index]
-                        t_x = tp.scheduled_trajectories[i]['trajectory']['x'][t_index]
-                        x = traci.vehicle.getDistance(i)
-                        t_lane = traci.vehicle.getLaneID(i)
-                        t_lane_pos = traci.vehicle.getLanePosition(i)
-                        lane_id = tp.scheduled_trajectories[i]['trajectory']['lane_list'][t_index]
-                        lane_pos = tp.scheduled_trajectories[i]['trajectory']['lane_position'][t_index]
+                        t_time = target.time
+                        t_x = target.x
+                        x = states[i][VehicleObserver.DISTANCE]
+                        t_lane = states[i][VehicleObserver.LANE_ID]
+                        t_lane_pos = states[i][VehicleObserver.LANE_POSITION]
+                        lane_id = target.lane_id
+                        lane_pos = target.lane_position
                         if abs(t_x-x) > 0.4:
                             print(f" vehicle: {i}, difference: {t_x - x}, real_lane: {t_lane}, target_lane: {lane_id}, real_lane_pos: {t_lane_pos}, target_lane_pos: {lane_pos}", )
                             print(f"vehicle: {i}, current time: {current_time}, t_time: {t_time}, real_x: {x}, target_x: {t_x}")
                     except Exception as e:
                         print(f"while evaluate difference error: {repr(e)}")
-                lane_id = tp.scheduled_trajectories[i]['trajectory']['lane_list'][t_index]
-                lane_pos = tp.scheduled_trajectories[i]['trajectory']['lane_position'][t_index]
-                x = tp.scheduled_trajectories[i]['trajectory']['x'][t_index]
+                x = target.x
                 try:
-                    traci.vehicle.moveTo(i, lane_id, lane_pos)
+                    state = states.get(i, {})
+                    actuator.actuate(i, t_trajectory, target, state.get(VehicleObserver.LANE_ID),
+                                     state.get(VehicleObserver.LANE_POSITION))
                 except Exception as e:
                     print(f"while move vehicle {i} error: {repr(e)}")
             except Exception as e:
                 print(f"Get error: {repr(e)} while control vehicle {i}")
             # 获取车辆信息
             try:
-                distance = traci.vehicle.getDistance(i)
-                position = traci.vehicle.getLanePosition(i)
-                lane = traci.vehicle.getLaneID(i)
-                # x = traci.vehicle.getDistance(i)
-                speed = traci.vehicle.getSpeed(i)
-                timeloss = traci.vehicle.getTimeLoss(i)
+                state = states[i]
+                distance = state[VehicleObserver.DISTANCE]
+                position = state[VehicleObserver.LANE_POSITION]
+                lane = state[VehicleObserver.LANE_ID]
+                speed = state[VehicleObserver.SPEED]
+                timeloss = state[VehicleObserver.TIME_LOSS]
             except Exception as e:
                 print(f"Obtain information error: {repr(e)} from vehicle {i}")
                 continue
@@ -174,125 +208,43 @@ def run_sumo(t, e_flow, r_flow):
             # 储存热力时空图数据
             if step % 5 == 0:
                 if i[0] == 'm':
-                    veh_info.append([i, 'm', step / 100, x, speed, lane, position, distance])
+                    recorder.record_step(i, 'm', step / 100, x, speed, lane, position, distance)
                 elif i[0] == 'r':
-                    veh_info.append([i, 'r', step / 100, x, speed, lane, position, distance])
+                    recorder.record_step(i, 'r', step / 100, x, speed, lane, position, distance)
             if step % 100 == 0 and 'J' not in lane:
                 # 储存3d时空图数据
-                veh_td_3d.append([i, step / 100, lane, distance])
+                recorder.record_td_3d(i, step / 100, lane, distance)
                 # 储存延误数据
-                if i not in veh_timeloss:
-                    veh_timeloss[i] = [i[0], timeloss]
-                else:
-                    veh_timeloss[i][-1] = timeloss
+                recorder.record_timeloss(i, timeloss)
         # 仿真运行一步
         step += 1
+    print(f"actuation ({actuation}): {actuator.summary(step)}")
+    print(f"planning latency ({planner}): {tp.latency_summary()}")
     tp.close()
     traci.close()
-    # 列名
-    header = ['id', 'flow', 'time', 'x', 'speed', 'lane', 'position', 'distance']
-    # 按照 id 和 time 进行排序
-    sorted_data = sorted(veh_info, key=lambda x: (x[0], x[1]))
-    # 保存为 CSV 文件
-    filename = os.path.join(prefix, f'data_step{e_flow, r_flow}.csv')
-    with open(filename, 'w', newline='') as file:
-        writer = csv.writer(file)
-        # 写入列名行
-        writer.writerow(header)
-        # 写入数据行
-        writer.writerows(sorted_data)
-    data = pd.read_csv(filename)
-    # 添加一列记录时间区间
-    data['time_interval'] = (data['time'] // 5) * 5
-    # 根据来源和时间区间分组计算平均速度
-    grouped = data.groupby(['flow', 'time_interval'])['speed'].mean().reset_index()
-    # 保存结果为新的CSV文件
-    t_filename = os.path.join(prefix, f"data_avg_speed{e_flow, r_flow}.csv")
-    grouped.to_csv(t_filename, index=False)
-
-    # 列名
-    header = ['id', 'time', 'lane', 'distance']
-    file_path = os.path.join(prefix, f"data_td_3d{e_flow, r_flow}.csv")
-    with open(file_path, "w", newline="") as file:
-        writer = csv.writer(file)
-        # 写入列名行
-        writer.writerow(header)
-        for item in veh_td_3d:
-            writer.writerow(item)
-
-    # 指定路径
-
-    csv_file = os.path.join(prefix, 'data_timeloss.csv')
-    # 进行写入
-    with open(csv_file, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        # 写入表头
-        writer.writerow(['id', 'Type', 'TimeLoss'])
-        # 逐行写入
-        for key, value in veh_timeloss.items():
-            writer.writerow([key] + value)
-
-    # 列名
-    header = ['time', 'fuel_sum']
-    file_path = os.path.join(prefix, f"data_fuel{e_flow, r_flow}.csv")
-
-    with open(file_path, "w", newline="") as file:
-        writer = csv.writer(file)
-        # 写入列名行
-        writer.writerow(header)
-        for item in veh_fuel:
-            writer.writerow(item)
-
-
-def draw_td(flow_value, e_flow, r_flow):
-    # 设置中文显示
-    plt.rcParams['font.sans-serif'] = ['SimHei']
-    plt.rcParams['axes.unicode_minus'] = False
-
-    # 读取数据
-    t_filename = os.path.join(prefix, f'data_step{e_flow, r_flow}.csv')
-    data = pd.read_csv(t_filename)
-
-    # 根据 flow 列筛选数据
-    lane_data = data[data['flow'] == flow_value]
-
-    # 提取车辆编号
-    x_vehID = lane_data['id'].drop_duplicates().reset_index(drop=True)
-
-    # 绘制轨迹图
-    plt.figure(figsize=(16,9), dpi=300)
-    # plt.ylim(0, 1000)
-    # plt.xlim(0, 600)
-    plt.xticks(fontproperties="Times New Roman", size=12)
-    plt.yticks(fontproperties="Times New Roman", size=12)
-    plt.ylabel('位置 (m)')
-    plt.xlabel('时间 (s)')
-
-    for i in range(len(x_vehID)):
-        # 获取当前车辆的数据
-        car_data = lane_data[lane_data['id'] == x_vehID[i]]
-
-        # 提取时间和相对移动距离
-        x = car_data['time']
-        y = np.sqrt(np.square(car_data['x']))
-
-        # 提取速度，并作为颜色映射
-        v = car_data['speed']
-
-        # 绘制散点图
-        plt.scatter(x, y, marker='.', s=1, c=v, cmap='jet_r', vmin=0, vmax=25)
-
-    plt.colorbar(label='速度 (m/s)')
-    # 保存图形为图片文件
-    plt.savefig(os.path.join(prefix, f'{flow_value, e_flow, r_flow}_td.png'), format='png', dpi=300)
-
-    # 显示图形
-    plt.show()
-
-
-def process_timeloss():
+    recorder.close()
+
+    # 规划各阶段耗时的直方图
+    print(tp.profile.summary())
+    tp.profile.export(os.path.join(out_dir, f"data_planner_profile{e_flow, r_flow}.json"))
+
+    # 规划结果的校验: 各项检查的违规次数和车辆
+    print(tp.validation.summary())
+    tp.validation.export(os.path.join(out_dir, f"data_validation{e_flow, r_flow}.json"))
+
+    # 每次插入合流队列的计算代价
+    insertion_costs = pd.DataFrame(tp.insertion_costs,
+                                   columns=['vehicle', 'enter_time', 'followers', 'recomposed', 'elapsed'])
+    insertion_costs.to_csv(os.path.join(out_dir, f"data_insertion_cost{e_flow, r_flow}.csv"), index=False)
+
+    # 记录车辆到达数据, 可用MergePlanner.replay离线重放规划
+    save_arrivals(os.path.join(out_dir, f"data_arrivals{e_flow, r_flow}.json"), tp.arrivals, tp.m_lanes_info,
+                  tp.r_lanes_info, tp.step_length, tp.add_len)
+
+
+def process_timeloss(out_dir=prefix):
     # 读取CSV文件
-    df = pd.read_csv(os.path.join(prefix, 'data_timeloss.csv'))
+    df = pd.read_csv(os.path.join(out_dir, 'data_timeloss.csv'))
 
     # 将Type列中的m和r分别替换为主线车和匝道车
     df['Type'] = df['Type'].replace({'m': '主线车', 'r': '匝道车'})
@@ -315,9 +267,9 @@ def process_timeloss():
     avg_delay = df['TimeLoss'].mean()
 
     # 检查根目录下是否存在'3.timeloss.txt'文件
-    if os.path.isfile(os.path.join(prefix, 'timeloss.txt')):
+    if os.path.isfile(os.path.join(out_dir, 'timeloss.txt')):
         # 将数据追加到文件中
-        with open(os.path.join('timeloss.txt'), 'a') as f:
+        with open(os.path.join(out_dir, 'timeloss.txt'), 'a') as f:
             f.write(f"主线车流量, {mainline_flow * 6},")
             f.write(f"匝道车流量, {ramp_flow * 6}\n")
             f.write(f"主线车平均延误, {mainline_avg_delay},")
@@ -325,13 +277,32 @@ def process_timeloss():
             f.write(f"所有车辆平均延误, {avg_delay}\n")
     else:
         # 创建新文件，并将数据写入其中
-        with open(os.path.join(prefix, 'timeloss.txt'), 'w', encoding='utf-8') as f:
+        with open(os.path.join(out_dir, 'timeloss.txt'), 'w', encoding='utf-8') as f:
             f.write(f"主线车流量, {mainline_flow * 6},")
             f.write(f"匝道车流量, {ramp_flow * 6}\n")
             f.write(f"主线车平均延误, {mainline_avg_delay},")
             f.write(f"匝道车平均延误, {ramp_avg_delay},")
             f.write(f"所有车辆平均延误, {avg_delay}\n")
 
+    return {'mainline_vehicles': mainline_flow, 'ramp_vehicles': ramp_flow, 'mainline_avg_delay': mainline_avg_delay,
+            'ramp_avg_delay': ramp_avg_delay, 'avg_delay': avg_delay}
+
+
+def simulate(e_flow, r_flow, t=600, seed=1024, out_dir=prefix, sumo_binary=sumo_gui, label="default",
+             actuation='moveTo', planner='sync', deadline=0.005, resolution=None, representation='dense'):
+    """
+    Runs one simulation with the given main road and ramp flows (veh/h) for t seconds and returns its delay summary.
+    The route file and all the outputs are written into out_dir, simulations with different out_dir and label can
+    run in parallel processes. actuation, planner, deadline, resolution, representation: see run_sumo.
+    """
+    rou_file = os.path.join(out_dir, "1.test.rou.xml")
+    update_rou(e_flow, r_flow, rou_file)
+    sumocfg = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1.test.sumocfg")
+    # traci启动仿真
+    traci.start([sumo_binary, "-c", sumocfg, "-r", rou_file, "--seed", str(seed)], label=label)
+    run_sumo(t, e_flow, r_flow, out_dir, actuation, planner, deadline, resolution, representation)
+    return process_timeloss(out_dir)
+
 
 def main():
     for i in [1800]:
@@ -339,16 +310,10 @@ def main():
             # 仿真时间,主路和匝道车流（veh/h）
             t = 600
             e_flow, r_flow = i, j
-            update_rou(e_flow, r_flow)
-
-            # traci启动仿真
-            traci.start([sumo_gui, "-c", "1.test.sumocfg", "--seed", "1024"])
-
-            # call the trajectory control function
-            run_sumo(t, e_flow, r_flow)
-            draw_td('m', e_flow, r_flow)
-            draw_td('r', e_flow, r_flow)
-            process_timeloss()
+            # 生成rou文件,启动仿真并统计延误
+            simulate(e_flow, r_flow, t)
+            # 一次读取数据, 绘制主路和匝道车辆的时空图
+            draw_td(prefix, e_flow, r_flow, show=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+import numpy as np
+try:
+    import traci
+except ImportError:
+    # speed_keyframes runs without SUMO, the actuators need traci.
+    traci = None
+
+
+def speed_keyframes(time, x, tolerance):
+    """
+    Splits a trajectory into segments driven at constant speed, each as long as the positions of the trajectory stay
+    within tolerance of the straight line between the segment ends.
+
+    Parameters:
+    - time, x: samples of the trajectory.
+    - tolerance: largest distance (m) between the trajectory and the segment line at any sample.
+
+    Returns:
+    - indices of the segment ends, starting with 0 and ending with len(time) - 1.
+    """
+    n = len(time)
+    keys = [0]
+    start = 0
+
+    def fits(end):
+        slope = (x[end] - x[start]) / (time[end] - time[start])
+        line = x[start] + (time[start:end + 1] - time[start]) * slope
+        return np.max(np.abs(x[start:end + 1] - line)) <= tolerance
+
+    while start < n - 1:
+        # Grow the segment by doubling its length, then bisect between the last end that fits and the first that
+        # does not.
+        good, length = start + 1, 1
+        bad = None
+        while good < n - 1:
+            end = min(start + 2 * length, n - 1)
+            if not fits(end):
+                bad = end
+                break
+            good, length = end, end - start
+        if bad is not None:
+            while bad - good > 1:
+                mid = (good + bad) // 2
+                if fits(mid):
+                    good = mid
+                else:
+                    bad = mid
+        keys.append(good)
+        start = good
+    return np.array(keys)
+
+
+def drift_of(t_trajectory, target, lane_id, lane_position):
+    """
+    Distance (m) between a vehicle and its target (Trajectory.target_at), compared along the route from the lane
+    positions (the odometer of SUMO counts a lane length more after a vehicle is moved backwards by moveTo). 0.0 if
+    the position of the vehicle is unknown or off the route.
+    """
+    if lane_id is None:
+        return 0.0
+    geometry = t_trajectory.geometry
+    distance = geometry.distance_of(lane_id, lane_position)
+    if distance is None:
+        return 0.0
+    return abs(geometry.distance_of(target.lane_id, target.lane_position) - distance)
+
+
+class MoveToActuator:
+    """
+    Moves every controlled vehicle to the sample of its trajectory at every simulation step (one traci.vehicle.moveTo
+    per vehicle and step).
+
+    Counts the TraCI commands sent, and the drift of the vehicles from their trajectories: samples, total drift and
+    samples further than drift_limit (the 0.4 m of the difference check of run_sumo).
+    """
+    def __init__(self, drift_limit=0.4):
+        self.drift_limit = drift_limit
+        self.commands = 0
+        self.corrections = 0
+        self.samples = 0
+        self.drift_sum = 0.0
+        self.drifted = 0
+
+    def measure(self, t_trajectory, target, lane_id, lane_position):
+        drift = drift_of(t_trajectory, target, lane_id, lane_position)
+        self.samples += 1
+        self.drift_sum += drift
+        if drift > self.drift_limit:
+            self.drifted += 1
+        return drift
+
+    def actuate(self, vehicle, t_trajectory, target, lane_id, lane_position):
+        """
+        Parameters:
+        - t_trajectory, target: scheduled trajectory of the vehicle and its target at the current time
+          (Trajectory.target_at).
+        - lane_id, lane_position: position of the vehicle reported by SUMO at the current time (lane_id None if
+          unknown).
+        """
+        self.measure(t_trajectory, target, lane_id, lane_position)
+        self.commands += 1
+        traci.vehicle.moveTo(vehicle, target.lane_id, float(target.lane_position))
+
+    def forget(self, vehicle):
+        pass
+
+    def summary(self, steps):
+        return (f"{self.commands} TraCI commands ({self.commands / max(steps, 1):.1f} per step), "
+                f"{self.corrections} corrections, mean drift {self.drift_sum / max(self.samples, 1):.3f} m, "
+                f"{self.drifted} of {self.samples} samples off by more than {self.drift_limit} m")
+
+
+class KeyframeActuator(MoveToActuator):
+    """
+    Hands the scheduled trajectories to SUMO as speed keyframes: the trajectory is split by speed_keyframes, and a
+    vehicle gets one traci.vehicle.setSpeed per segment, with the speed checks of SUMO off (speed mode 0) so it drives
+    the commanded speed exactly. Every step the distance reported by SUMO is compared with the trajectory, the vehicle
+    is moved back onto it (moveTo) when it has drifted further than `correction`.
+
+    - tolerance: largest deviation (m) of the keyframe segments from the trajectory.
+    - correction: drift (m) from the trajectory at which a vehicle is moved back onto it.
+    """
+    def __init__(self, tolerance=0.05, correction=0.2, drift_limit=0.4):
+        super().__init__(drift_limit)
+        self.tolerance = tolerance
+        self.correction = correction
+        # {vehicle: [trajectory, keyframe times, segment speeds, next keyframe]}
+        self.plans = {}
+
+    def plan(self, vehicle, t_trajectory, t_index):
+        keys = t_index + speed_keyframes(t_trajectory.time[t_index:], t_trajectory.x[t_index:], self.tolerance)
+        key_times = t_trajectory.time[keys]
+        speeds = np.diff(t_trajectory.x[keys]) / np.diff(key_times)
+        if vehicle not in self.plans:
+            traci.vehicle.setSpeedMode(vehicle, 0)
+            self.commands += 1
+        # Times, not indices: Trajectory.drop_before shifts the indices of a trajectory.
+        self.plans[vehicle] = [t_trajectory, key_times, speeds, 0]
+
+    def actuate(self, vehicle, t_trajectory, target, lane_id, lane_position):
+        plan = self.plans.get(vehicle)
+        # A recomposed trajectory is a new object.
+        if plan is None or plan[0] is not t_trajectory:
+            self.plan(vehicle, t_trajectory, target.index)
+            plan = self.plans[vehicle]
+        _, key_times, speeds, k = plan
+        drift = self.measure(t_trajectory, target, lane_id, lane_position)
+        if drift > self.correction:
+            traci.vehicle.moveTo(vehicle, target.lane_id, float(target.lane_position))
+            self.commands += 1
+            self.corrections += 1
+        t_time = target.time
+        if k < len(speeds) and t_time >= key_times[k]:
+            while k + 1 < len(speeds) and t_time >= key_times[k + 1]:
+                k += 1
+            traci.vehicle.setSpeed(vehicle, float(speeds[k]))
+            self.commands += 1
+            plan[3] = k + 1
+
+    def forget(self, vehicle):
+        self.plans.pop(vehicle, None)
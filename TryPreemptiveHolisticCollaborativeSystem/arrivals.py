@@ -0,0 +1,65 @@
+import json
+
+
+class VehicleParams:
+    """
+    Kinematic parameters of a vehicle used by the planner.
+    """
+    __slots__ = ('accel', 'decel', 'max_speed', 'length')
+
+    def __init__(self, accel, decel, max_speed, length):
+        self.accel = accel
+        self.decel = decel
+        self.max_speed = max_speed
+        self.length = length
+
+
+class Arrival:
+    """
+    A vehicle entering the system: the planner schedules its trajectory from (time, speed, x).
+
+    - x: travelled distance of the vehicle along its route.
+    """
+    __slots__ = ('vehicle', 'time', 'speed', 'x', 'params')
+
+    def __init__(self, vehicle, time, speed, x, params):
+        self.vehicle = vehicle
+        self.time = time
+        self.speed = speed
+        self.x = x
+        self.params = params
+
+
+def save_arrivals(path, arrivals, m_lanes_info, r_lanes_info, step_length, add_len):
+    """
+    Writes an arrival stream as JSON, with everything MergePlanner needs to replay it.
+
+    Parameters:
+    - arrivals: Arrival objects in the order they were planned.
+    - m_lanes_info, r_lanes_info: lane chains of the main road and the ramp routes.
+    - step_length: simulation step length (s).
+    - add_len: add_len of the planner.
+    """
+    stream = {'step_length': step_length, 'add_len': add_len,
+              'm_lanes_info': m_lanes_info, 'r_lanes_info': r_lanes_info,
+              'arrivals': [{'vehicle': item.vehicle, 'time': item.time, 'speed': item.speed, 'x': item.x,
+                            'accel': item.params.accel, 'decel': item.params.decel,
+                            'max_speed': item.params.max_speed, 'length': item.params.length}
+                           for item in arrivals]}
+    with open(path, 'w') as file:
+        json.dump(stream, file)
+
+
+def load_arrivals(path):
+    """
+    Reads an arrival stream written by save_arrivals.
+
+    Returns:
+    - dict with 'step_length', 'add_len', 'm_lanes_info', 'r_lanes_info' and 'arrivals' (Arrival objects).
+    """
+    with open(path) as file:
+        stream = json.load(file)
+    stream['arrivals'] = [Arrival(item['vehicle'], item['time'], item['speed'], item['x'],
+                                  VehicleParams(item['accel'], item['decel'], item['max_speed'], item['length']))
+                          for item in stream['arrivals']]
+    return stream
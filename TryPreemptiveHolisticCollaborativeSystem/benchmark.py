@@ -0,0 +1,910 @@
+import contextlib
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from trajectory import LaneTable, Trajectory
+from geometry import RouteGeometry
+from tools import scale_series, scale_series_spline, earliest_feasible, free_flow_profile
+from arrivals import Arrival, VehicleParams, load_arrivals
+from preemptive_follow import MergePlanner
+from actuation import speed_keyframes
+from piecewise import PiecewiseTrajectory
+import follow_kernel
+
+# Lane geometry of the routes in 1.test.net.xml, as read by network.load_route_geometry.
+M_LANES_INFO = [{'lane_id': 'E0_0', 'length': 1014.23, 'maxSpeed': 43.33},
+                {'lane_id': ':node_0_1_1_0', 'length': 8.33, 'maxSpeed': 43.33},
+                {'lane_id': 'E2_0', 'length': 197.43, 'maxSpeed': 43.33},
+                {'lane_id': ':J0_0_0', 'length': 0.1, 'maxSpeed': 43.33},
+                {'lane_id': 'E3_0', 'length': 800.0, 'maxSpeed': 43.33}]
+R_LANES_INFO = [{'lane_id': 'E1_0', 'length': 993.17, 'maxSpeed': 43.33},
+                {'lane_id': ':node_0_1_0_0', 'length': 8.3, 'maxSpeed': 43.33},
+                {'lane_id': 'E2_0', 'length': 197.43, 'maxSpeed': 43.33},
+                {'lane_id': ':J0_0_0', 'length': 0.1, 'maxSpeed': 43.33},
+                {'lane_id': 'E3_0', 'length': 800.0, 'maxSpeed': 43.33}]
+VEHICLE_LENGTH = 5.0
+MAX_SPEED = 20.0
+ACCELERATION = 2.5
+DECELERATION = 4.5
+TIME_STEP = 0.01
+
+
+@contextlib.contextmanager
+def quiet_planner(level=logging.CRITICAL):
+    """
+    Raises the level of the planner logger while a benchmark runs, its warnings and errors would be mixed with the
+    results.
+    """
+    t_logger = logging.getLogger('preemptive_follow')
+    previous = t_logger.level
+    t_logger.setLevel(level)
+    try:
+        yield
+    finally:
+        t_logger.setLevel(previous)
+
+
+def arrival_times(flow, horizon, seed=1024):
+    """
+    Departure times of a SUMO flow with period exp(flow / 3600) over the horizon (s).
+    """
+    rng = np.random.default_rng(seed)
+    gaps = rng.exponential(3600.0 / flow, size=int(flow * horizon / 3600.0 * 2) + 10)
+    times = np.cumsum(gaps)
+    return times[times < horizon]
+
+
+def free_flow_samples(depart_time, depart_speed, lanes_info, dt=TIME_STEP):
+    """
+    time/x/speed samples of a vehicle accelerating from depart_speed to MAX_SPEED until the end of its route.
+    """
+    total_len = sum(t_lane['length'] for t_lane in lanes_info)
+    v_step = dt * ACCELERATION * 0.4
+    ramp = np.arange(depart_speed, MAX_SPEED, v_step)
+    ramp_x = np.cumsum(ramp * dt)
+    if ramp_x[-1] < total_len:
+        n_cruise = int(np.ceil((total_len - ramp_x[-1]) / (MAX_SPEED * dt)))
+        speed = np.concatenate((ramp, np.full(n_cruise, MAX_SPEED)))
+    else:
+        speed = ramp[:np.searchsorted(ramp_x, total_len) + 1]
+    x = np.cumsum(speed * dt)
+    t = depart_time + dt * np.arange(1, len(x) + 1)
+    return t, x, speed
+
+
+def lane_samples(x, lanes_info):
+    offsets = np.cumsum([0.0] + [t_lane['length'] for t_lane in lanes_info])
+    front = x + VEHICLE_LENGTH + 0.1
+    idx = np.clip(np.searchsorted(offsets, front, side='right') - 1, 0, len(lanes_info))
+    position = front - offsets[idx]
+    return np.minimum(idx, len(lanes_info) - 1), position
+
+
+def legacy_trajectory(vehicle, t, x, speed, lanes_info):
+    # The nested dict layout used before Trajectory: arrays plus one lane ID and one float object per sample.
+    idx, position = lane_samples(x, lanes_info)
+    return {'vehicle': vehicle,
+            'trajectory': {'time': t.copy(), 'x': x.copy(), 'speed': speed.copy(),
+                           'lane_list': [lanes_info[k]['lane_id'] for k in idx.tolist()],
+                           'lane_position': list(position)},
+            'space_len': VEHICLE_LENGTH + 3.0,
+            'lanes_info': lanes_info}
+
+
+def compact_trajectory(vehicle, t, x, speed, geometry):
+    codes, position = geometry.locate(x + VEHICLE_LENGTH + 0.1)
+    return Trajectory(vehicle, t.copy(), x.copy(), speed.copy(), codes, position, VEHICLE_LENGTH + 3.0, geometry)
+
+
+def bench_trajectory_memory(e_flow=1800, r_flow=1600, horizon=600):
+    """
+    Memory of all the scheduled trajectories of a run, in the nested dict layout and as Trajectory.
+    """
+    vehicles = []
+    for t_flow, t_prefix, t_speed, t_lanes in ((e_flow, 'm', 14.0, M_LANES_INFO), (r_flow, 'r', 7.0, R_LANES_INFO)):
+        for i, t_depart in enumerate(arrival_times(t_flow, horizon)):
+            vehicles.append((f"{t_prefix}.{i}", *free_flow_samples(t_depart, t_speed, t_lanes), t_lanes))
+    n_samples = sum(len(item[1]) for item in vehicles)
+
+    results = {}
+    for name in ('dict', 'Trajectory'):
+        lane_table = LaneTable()
+        geometries = {id(t_lanes): RouteGeometry(t_lanes, lane_table) for t_lanes in (M_LANES_INFO, R_LANES_INFO)}
+        tracemalloc.start()
+        start = time.perf_counter()
+        store = {}
+        for vehicle, t, x, speed, lanes_info in vehicles:
+            if name == 'dict':
+                store[vehicle] = legacy_trajectory(vehicle, t, x, speed, lanes_info)
+            else:
+                store[vehicle] = compact_trajectory(vehicle, t, x, speed, geometries[id(lanes_info)])
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = current
+        print(f"{name:>10}: {len(store)} vehicles, {n_samples} samples, {current / 2 ** 20:8.1f} MiB "
+              f"({current / n_samples:5.1f} B/sample), peak {peak / 2 ** 20:8.1f} MiB, build {elapsed:.2f} s")
+        del store
+    print(f"Trajectory uses {results['Trajectory'] / results['dict']:.1%} of the dict layout "
+          f"at {e_flow}/{r_flow} veh/h over {horizon} s.")
+    return results
+
+
+def bench_step_lookup(n_vehicles=150, duration=20.0):
+    """
+    Per-step cost of finding the current sample of every live vehicle, np.where scan vs Trajectory.index_at.
+    """
+    geometry = RouteGeometry(M_LANES_INFO, LaneTable())
+    departs = np.linspace(0.0, 10.0, n_vehicles)
+    store = {}
+    for i, t_depart in enumerate(departs):
+        t, x, speed = free_flow_samples(t_depart, 14.0, M_LANES_INFO)
+        store[f"m.{i}"] = compact_trajectory(f"m.{i}", t, x, speed, geometry)
+    steps = np.round(np.arange(10.0, 10.0 + duration, TIME_STEP), 2)
+
+    start = time.perf_counter()
+    scan_idx = []
+    for current_time in steps:
+        for t_trajectory in store.values():
+            scan_idx.append(np.where(t_trajectory.time >= current_time)[0][0])
+    scan = (time.perf_counter() - start) / len(steps)
+
+    start = time.perf_counter()
+    cursor_idx = []
+    for current_time in steps:
+        for t_trajectory in store.values():
+            cursor_idx.append(t_trajectory.index_at(current_time))
+    cursor = (time.perf_counter() - start) / len(steps)
+
+    assert scan_idx == cursor_idx
+    mean_len = np.mean([len(item) for item in store.values()])
+    print(f"{n_vehicles} concurrent vehicles, {mean_len:.0f} samples per trajectory, {len(steps)} steps:")
+    print(f"  np.where scan: {scan * 1e3:8.3f} ms/step")
+    print(f"  index_at:      {cursor * 1e3:8.3f} ms/step ({scan / cursor:.1f}x)")
+    return scan, cursor
+
+
+def bench_scale_series(sizes=(1000, 10000, 100000), repeat=5):
+    """
+    scale_series (closed form) vs scale_series_spline (CubicSpline + L-BFGS-B) on the input of test_scale_series.
+    """
+    results = {}
+    for n in sizes:
+        t = np.linspace(0, 100, n) + 10.0
+        x_original = np.linspace(1, 1008, n) + 10 * np.sin(t / 20 * np.pi) + 100.0
+        args = (t, x_original, min(x_original), max(x_original), 2800)
+        timings = {}
+        for t_func in (scale_series_spline, scale_series):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                output = t_func(*args)
+            timings[t_func.__name__] = ((time.perf_counter() - start) / repeat, output)
+        spline_time, spline_out = timings['scale_series_spline']
+        fast_time, fast_out = timings['scale_series']
+        max_error = np.max(np.abs(spline_out - fast_out))
+        print(f"n={n:>6}: spline {spline_time * 1e3:8.3f} ms, closed form {fast_time * 1e3:7.3f} ms "
+              f"({spline_time / fast_time:6.1f}x), max abs difference {max_error:.2e}")
+        results[n] = (spline_time, fast_time, max_error)
+    return results
+
+
+def bench_merge_slot(n_cases=1000, max_wait=6.0, bracket=1.0, seed=1024):
+    """
+    Probes (trajectory compositions) and merge delay of the 1 s retry loop vs earliest_feasible, for entries that
+    become feasible after a random wait of up to max_wait seconds.
+    """
+    rng = np.random.default_rng(seed)
+    n_bracket = int(round(bracket / TIME_STEP))
+    waits = rng.integers(0, int(max_wait / TIME_STEP), size=n_cases)
+    results = {}
+    for name in ('retry', 'bisection'):
+        probes, delays = 0, 0
+        for t_wait in waits:
+            calls = []
+
+            def probe(k):
+                calls.append(k)
+                return True if k >= t_wait else None
+
+            if name == 'retry':
+                t_idx = 0
+                while probe(t_idx * n_bracket) is None:
+                    t_idx += 1
+                k = t_idx * n_bracket
+            else:
+                k, _ = earliest_feasible(probe, n_bracket)
+            probes += len(calls)
+            delays += k - t_wait
+        results[name] = (probes / n_cases, delays * TIME_STEP / n_cases)
+        print(f"{name:>10}: {probes / n_cases:5.2f} probes per merge, "
+              f"{delays * TIME_STEP / n_cases:6.3f} s later than the earliest feasible entry")
+    return results
+
+
+def bench_merge_probes(e_flow=1800, r_flow=1600, horizon=60.0, max_early=6.0, bracket=1.0, seed=1024):
+    """
+    Probes (trajectory compositions) and time per merge of the searches for the earliest feasible entry, on the
+    planned merges with their entry moved up to max_early seconds earlier so that the first entries are infeasible:
+    the 1 s retry loop, earliest_feasible from the entry, and solve_merge_slot (from the first entry clear_entry
+    does not rule out). The entries found by the two exact searches must be the same.
+    """
+    arrivals = synthetic_arrivals(e_flow, r_flow, horizon)
+    planner = MergePlanner(add_len=40, step_length=TIME_STEP, evict=False)
+    planner.set_lanes_info('m', M_LANES_INFO)
+    planner.set_lanes_info('r', R_LANES_INFO)
+    cases = []
+    solve_merge_slot = planner.solve_merge_slot
+    compose_follow_trajectory = planner.compose_follow_trajectory
+
+    def record(*args, **kwargs):
+        cases.append((args, kwargs))
+        return solve_merge_slot(*args, **kwargs)
+
+    planner.solve_merge_slot = record
+    for arrival in arrivals:
+        planner.plan_arrival(arrival)
+    rng = np.random.default_rng(seed)
+    earlier = rng.random(len(cases)) * max_early
+    n_bracket = int(round(bracket / TIME_STEP))
+    calls = []
+
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return compose_follow_trajectory(*args, **kwargs)
+
+    planner.compose_follow_trajectory = counted
+
+    def probe_of(t_vehicle, in_trajectory, enter_time, start_x, leader, additional_space=3.0):
+        def probe(k):
+            t_enter = enter_time + k * TIME_STEP
+            t_trajectory = planner.modify_trajectory_end_time(in_trajectory, t_enter)
+            f_trajectory = planner.compose_follow_trajectory(t_vehicle, from_time=t_enter,
+                                                             init_speed=t_trajectory.speed[-1], start_x=start_x,
+                                                             leader=leader, additional_space=additional_space)
+            return None if f_trajectory is None else (t_trajectory, f_trajectory)
+        return probe
+
+    def retry(*args, **kwargs):
+        probe = probe_of(*args, **kwargs)
+        t_idx = 0
+        result = probe(0)
+        while result is None:
+            t_idx += 1
+            result = probe(t_idx * n_bracket)
+        return result
+
+    def bisection(*args, **kwargs):
+        return earliest_feasible(probe_of(*args, **kwargs), n_bracket)[1]
+
+    entries = {}
+    for name, search in (('retry', retry), ('bisection', bisection), ('clear_entry', solve_merge_slot)):
+        calls.clear()
+        found = []
+        start = time.perf_counter()
+        for (args, kwargs), t_earlier in zip(cases, earlier.tolist()):
+            args = (*args[:2], args[2] - t_earlier, *args[3:])
+            found.append(search(*args, **kwargs)[0].time[-1])
+        elapsed = time.perf_counter() - start
+        entries[name] = found
+        print(f"{name:>11}: {len(calls) / len(cases):5.2f} probes, {elapsed / len(cases) * 1e3:5.2f} ms per merge")
+    later = np.mean(np.array(entries['retry']) - np.array(entries['bisection']))
+    print(f"retry enters {later:.3f} s later on average; same entries from bisection and clear_entry: "
+          f"{entries['bisection'] == entries['clear_entry']}")
+
+
+def stepped_free_flow(geometry, from_time, start_x, init_speed, max_vehicle_speed, acceleration, time_step_length,
+                      total_len):
+    """
+    The step by step loop free_flow_profile replaces in compse_mono_trajectory and complete_mono_trajectory.
+    """
+    t_time, tail_x, t_speed = from_time, start_x, init_speed
+    time_list, x_list, speed_list = [], [], []
+    while tail_x < total_len:
+        if t_speed < min(max_vehicle_speed, geometry.max_speed_at(tail_x)) * 0.995:
+            t_speed += time_step_length * acceleration * 0.4
+        if t_speed > min(max_vehicle_speed, geometry.max_speed_at(tail_x)) * 1.005:
+            t_speed -= time_step_length * acceleration * 0.4
+        t_time += time_step_length
+        tail_x += t_speed * time_step_length
+        time_list.append(t_time)
+        x_list.append(tail_x)
+        speed_list.append(t_speed)
+    return np.array(time_list), np.array(x_list), np.array(speed_list)
+
+
+def bench_free_flow(e_flow=1800, r_flow=1600, horizon=60.0, add_len=40):
+    """
+    Per vehicle latency of the free driving profiles of the planner, stepped loop vs free_flow_profile: the profile
+    up to the merge point of every arrival of synthetic_arrivals (compse_mono_trajectory) and the profile from there
+    to the end of the route (complete_mono_trajectory). The outputs must be equal.
+    """
+    lane_table = LaneTable()
+    geometries = {'m': RouteGeometry(M_LANES_INFO, lane_table), 'r': RouteGeometry(R_LANES_INFO, lane_table)}
+    cases = []
+    for arrival in synthetic_arrivals(e_flow, r_flow, horizon):
+        geometry = geometries[arrival.vehicle[0]]
+        merge_x = geometry.offsets[2] - add_len
+        cases.append((geometry, arrival.time, arrival.x, arrival.speed, min(geometry.total_length, merge_x)))
+        cases.append((geometry, arrival.time + 60.0, merge_x, MAX_SPEED * 0.9, geometry.total_length))
+    results = {}
+    for t_func in (stepped_free_flow, free_flow_profile):
+        latencies = []
+        outputs = []
+        for geometry, from_time, start_x, init_speed, total_len in cases:
+            start = time.perf_counter()
+            outputs.append(t_func(geometry, from_time, start_x, init_speed, MAX_SPEED,
+                                  min(ACCELERATION, DECELERATION), TIME_STEP, total_len))
+            latencies.append(time.perf_counter() - start)
+        # Both profiles of an arrival.
+        latencies = np.array(latencies).reshape(-1, 2).sum(axis=1)
+        results[t_func.__name__] = (latencies, outputs)
+    stepped, stepped_out = results['stepped_free_flow']
+    vectorized, vectorized_out = results['free_flow_profile']
+    n_samples = sum(len(item[0]) for item in stepped_out)
+    mismatches = sum(not all(np.array_equal(a, b) for a, b in zip(item_a, item_b))
+                     for item_a, item_b in zip(stepped_out, vectorized_out))
+    print(f"{len(stepped)} vehicles, {n_samples / len(stepped):.0f} free driving samples per vehicle, "
+          f"{mismatches} profiles differ")
+    for name, latencies in (('stepped loop', stepped), ('free_flow_profile', vectorized)):
+        print(f"  {name:>17}: mean {latencies.mean() * 1e3:7.3f} ms, p95 {np.percentile(latencies, 95) * 1e3:7.3f} ms "
+              f"per vehicle")
+    print(f"  speedup {stepped.mean() / vectorized.mean():.1f}x")
+    return stepped, vectorized, mismatches
+
+
+def stepped_follow(lead_time, lead_x, lead_speed, lead_shift, follower_shift, from_time, start_x, init_speed,
+                   max_vehicle_speed, acceleration, time_step_length, space_len, total_len, geometry):
+    """
+    The loop follow_kernel.follow_steps replaces in compose_follow_trajectory: the leader sample is searched with
+    np.where over the (shifted copy of the) whole leader trajectory every step.
+    """
+    lead_x = lead_x - lead_shift
+    lead_x += follower_shift
+    t_time, tail_x, t_speed = from_time, start_x, init_speed
+    strict_follow, strict_gap = False, space_len
+    time_list, x_list, speed_list = [], [], []
+    lx = ls = 0.0
+    while tail_x < total_len:
+        idx = np.where(lead_time >= t_time)[0]
+        has_leader = len(idx) > 0 and idx[0] != 0
+        if has_leader:
+            lx, ls = lead_x[idx[0]], lead_speed[idx[0]]
+        limit = min(max_vehicle_speed, geometry.max_speed_at(tail_x))
+        if t_speed < limit * 0.995:
+            if not has_leader:
+                t_speed += time_step_length * acceleration * 0.4
+            if has_leader and tail_x + space_len + 5 < lx and t_speed < ls:
+                t_speed += time_step_length * acceleration * 0.4
+        if t_speed > limit * 1.005:
+            t_speed -= time_step_length * acceleration * 0.4
+        if has_leader and tail_x + space_len > lx:
+            t_speed -= time_step_length * acceleration * 1.9
+        if has_leader and t_speed > ls and tail_x + space_len > lx:
+            t_speed -= time_step_length * acceleration * 3.2
+        if has_leader and tail_x + space_len > lx - 2.0 and tail_x < space_len + 8:
+            t_speed = ls
+        if has_leader and t_speed > ls and tail_x < 8:
+            t_speed = ls
+        if has_leader and t_speed > ls + 0.2 and tail_x + space_len > lx - 5.0:
+            t_speed = ls
+        if has_leader and t_speed > ls and tail_x + space_len > lx - 8.0 and tail_x > 5.2 and start_x < 1.0:
+            t_speed -= time_step_length * acceleration * 3.2
+        if has_leader and tail_x + space_len > lx and tail_x < space_len + 8:
+            t_speed = 0.0
+        if has_leader and tail_x + space_len > lx - 4.0 and tail_x > 5.2 and start_x < 1.0:
+            t_speed -= time_step_length * acceleration * 5.2
+        if t_speed < 0.0:
+            t_speed = 0.0
+        if has_leader and -2.0 < tail_x + space_len - lx < 0 and abs(t_speed - ls) < 0.5:
+            strict_follow, strict_gap = True, lx - tail_x
+        if has_leader and strict_follow:
+            t_speed, tail_x = ls, lx - strict_gap
+        else:
+            tail_x += t_speed * time_step_length
+        if has_leader and tail_x + space_len > lx + 0.3 and tail_x > 5.2:
+            return np.array(time_list), np.array(x_list), np.array(speed_list), False
+        t_time += time_step_length
+        time_list.append(t_time)
+        x_list.append(tail_x)
+        speed_list.append(t_speed)
+    return np.array(time_list), np.array(x_list), np.array(speed_list), True
+
+
+def record_follow_plans(path=None, e_flow=1800, r_flow=1600, horizon=60.0):
+    """
+    Replays an arrival stream (as bench_replay) and records the arguments of every follow_profile call of the planner,
+    with the leader trajectory as it was when the plan was made.
+    """
+    plans = []
+    original = follow_kernel.follow_profile
+
+    def recording(*args):
+        plans.append(args)
+        return original(*args)
+
+    follow_kernel.follow_profile = recording
+    # preemptive_follow imported the name, patch it there.
+    import preemptive_follow
+    preemptive_follow.follow_profile = recording
+    try:
+        bench_replay(path, e_flow, r_flow, horizon)
+    finally:
+        follow_kernel.follow_profile = original
+        preemptive_follow.follow_profile = original
+    return plans
+
+
+def bench_follow(path=None, e_flow=1800, r_flow=1600, horizon=60.0):
+    """
+    Per plan latency of the car-following loop, np.where leader search vs follow_kernel (compiled by numba when it
+    is installed, and as plain Python), on the leader trajectories recorded while planning an arrival stream. The
+    outputs must be equal.
+    """
+    plans = record_follow_plans(path, e_flow, r_flow, horizon)
+    kernels = [('np.where loop', stepped_follow)]
+    if follow_kernel.follow_steps_compiled is not None:
+        # Compile outside of the timing.
+        follow_kernel.follow_profile(*plans[0])
+        kernels.append(('kernel (numba)', follow_kernel.follow_profile))
+    kernels.append(('kernel (Python)', lambda *args: follow_kernel.follow_profile(*args, use_numba=False)))
+    results = {}
+    for name, t_func in kernels:
+        latencies, outputs = [], []
+        for args in plans:
+            start = time.perf_counter()
+            outputs.append(t_func(*args))
+            latencies.append(time.perf_counter() - start)
+        results[name] = (np.array(latencies), outputs)
+    reference, reference_out = results['np.where loop']
+    n_steps = np.mean([len(item[0]) for item in reference_out])
+    print(f"{len(plans)} follow plans, {n_steps:.0f} steps per plan:")
+    for name, (latencies, outputs) in results.items():
+        mismatches = sum(not (a[3] == b[3] and all(np.array_equal(u, v) for u, v in zip(a[:3], b[:3])))
+                         for a, b in zip(reference_out, outputs))
+        print(f"  {name:>15}: mean {latencies.mean() * 1e3:8.3f} ms, p95 {np.percentile(latencies, 95) * 1e3:8.3f} ms "
+              f"per plan ({reference.mean() / latencies.mean():6.1f}x), {mismatches} plans differ")
+    return results
+
+
+def bench_allocations(path=None, e_flow=1800, r_flow=1600, horizon=60.0, top=8):
+    """
+    tracemalloc report of planning an arrival stream (as bench_replay): the memory allocated and released within
+    every plan_arrival call (its transient peak), the memory it leaves allocated, the allocation sites holding the
+    most memory at the end, and the peak RSS of the process. Arrays allocated inside the numba compiled follow kernel
+    are not seen by tracemalloc.
+    """
+    if path is None:
+        stream = {'step_length': TIME_STEP, 'add_len': 40, 'm_lanes_info': M_LANES_INFO,
+                  'r_lanes_info': R_LANES_INFO, 'arrivals': synthetic_arrivals(e_flow, r_flow, horizon)}
+    else:
+        stream = load_arrivals(path)
+    planners = []
+    for _ in range(2):
+        planner = MergePlanner(add_len=stream['add_len'], step_length=stream['step_length'])
+        planner.set_lanes_info('m', stream['m_lanes_info'])
+        planner.set_lanes_info('r', stream['r_lanes_info'])
+        planners.append(planner)
+    # Untraced warm-up: the numba compilation and the lazy imports of the first plans.
+    planners[0].replay(stream['arrivals'])
+    planner = planners[1]
+    transient, retained = [], []
+    tracemalloc.start()
+    for arrival in stream['arrivals']:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        planner.plan_arrival(arrival)
+        after, peak = tracemalloc.get_traced_memory()
+        transient.append(peak - before)
+        retained.append(after - before)
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    transient, retained = np.array(transient), np.array(retained)
+    trajectories = sum(item.nbytes() for item in planner.scheduled_trajectories.values())
+    print(f"{len(transient)} arrivals: traced {current / 2 ** 20:.1f} MiB at the end, peak {peak / 2 ** 20:.1f} MiB, "
+          f"scheduled trajectories {trajectories / 2 ** 20:.1f} MiB")
+    print(f"  per plan: transient peak mean {transient.mean() / 2 ** 20:.2f} MiB, max {transient.max() / 2 ** 20:.2f} "
+          f"MiB; retained mean {retained.mean() / 2 ** 10:.0f} KiB")
+    print(f"  peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10:.0f} MiB")
+    statistics = snapshot.filter_traces([tracemalloc.Filter(True, '*PreemptiveHolisticCollaborativeSystem*')])
+    for stat in statistics.statistics('lineno')[:top]:
+        frame = stat.traceback[0]
+        print(f"  {frame.filename.rsplit('/', 1)[-1]}:{frame.lineno}: {stat.size / 2 ** 10:8.0f} KiB in "
+              f"{stat.count} blocks")
+    return transient, retained
+
+
+def bench_horizon(e_flow=1800, r_flow=1600, horizon=900.0, interval=60.0):
+    """
+    Memory of the planner store (trajectories, lists) against simulated time, planning a synthetic arrival stream
+    with and without evicting the vehicles that have left.
+    """
+    arrivals = synthetic_arrivals(e_flow, r_flow, horizon)
+    results = {}
+    for evict in (False, True):
+        planner = MergePlanner(add_len=40, step_length=TIME_STEP, evict=evict)
+        planner.set_lanes_info('m', M_LANES_INFO)
+        planner.set_lanes_info('r', R_LANES_INFO)
+        rows = []
+        next_report = interval
+        start = time.perf_counter()
+        for arrival in arrivals:
+            while arrival.time >= next_report:
+                rows.append((next_report, len(planner.scheduled_trajectories),
+                             sum(item.nbytes() for item in planner.scheduled_trajectories.values()),
+                             len(planner.m_list) + len(planner.r_list) + len(planner.merge_list)))
+                next_report += interval
+            planner.plan_arrival(arrival)
+        results[evict] = rows
+        print(f"evict={evict}: {len(arrivals)} arrivals planned in {time.perf_counter() - start:.1f} s")
+    print(f"{'time (s)':>9} {'trajectories':>23} {'MiB':>17} {'list items':>17}")
+    for (t_time, n_keep, b_keep, l_keep), (_, n_evict, b_evict, l_evict) in zip(results[False], results[True]):
+        print(f"{t_time:9.0f} {n_keep:11d} -> {n_evict:8d} {b_keep / 2 ** 20:7.1f} -> {b_evict / 2 ** 20:6.1f} "
+              f"{l_keep:7d} -> {l_evict:6d}")
+    return results
+
+
+def synthetic_arrivals(e_flow=1800, r_flow=1600, horizon=60.0, seed=1024):
+    """
+    Arrival stream like the one of 1.test.rou.xml: vehicles depart at 14 m/s (main road) and 7 m/s (ramp) at
+    exponentially distributed times, and are seen one step later.
+    """
+    params = VehicleParams(ACCELERATION, DECELERATION, MAX_SPEED, VEHICLE_LENGTH)
+    arrivals = []
+    for t_flow, t_prefix, t_speed, t_seed in ((e_flow, 'm', 14.0, seed), (r_flow, 'r', 7.0, seed + 1)):
+        for i, t_depart in enumerate(arrival_times(t_flow, horizon, t_seed)):
+            t_time = round((np.floor(t_depart / TIME_STEP) + 1) * TIME_STEP, 2)
+            arrivals.append(Arrival(f"{t_prefix}.{i}", t_time, t_speed, t_speed * TIME_STEP, params))
+    arrivals.sort(key=lambda item: item.time)
+    return arrivals
+
+
+def bench_replay(path=None, e_flow=1800, r_flow=1600, horizon=60.0):
+    """
+    Plans an arrival stream with MergePlanner, without SUMO. The stream is read from path (data_arrivals*.json
+    written by PreemptiveMerge.run_sumo) or generated by synthetic_arrivals.
+    """
+    if path is None:
+        stream = {'step_length': TIME_STEP, 'add_len': 40, 'm_lanes_info': M_LANES_INFO,
+                  'r_lanes_info': R_LANES_INFO, 'arrivals': synthetic_arrivals(e_flow, r_flow, horizon)}
+    else:
+        stream = load_arrivals(path)
+    arrivals = stream['arrivals']
+    planner = MergePlanner(add_len=stream['add_len'], step_length=stream['step_length'])
+    planner.set_lanes_info('m', stream['m_lanes_info'])
+    planner.set_lanes_info('r', stream['r_lanes_info'])
+    latencies = []
+    for arrival in arrivals:
+        start = time.perf_counter()
+        planner.plan_arrival(arrival)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies)
+    span = arrivals[-1].time - arrivals[0].time
+    print(f"{len(arrivals)} arrivals over {span:.1f} s of traffic planned in {latencies.sum():.2f} s "
+          f"({span / latencies.sum():.1f}x real time)")
+    print(f"  per vehicle: mean {latencies.mean() * 1e3:.1f} ms, p50 {np.percentile(latencies, 50) * 1e3:.1f} ms, "
+          f"p95 {np.percentile(latencies, 95) * 1e3:.1f} ms, max {latencies.max() * 1e3:.1f} ms")
+    return planner, latencies
+
+
+def bench_keyframes(path=None, e_flow=1800, r_flow=1600, horizon=60.0, tolerances=(0.01, 0.05, 0.2)):
+    """
+    TraCI commands needed to drive the planned trajectories: one moveTo per sample, against one setSpeed per segment
+    of speed_keyframes, and the largest distance between a trajectory and the keyframe segments driven exactly.
+    """
+    if path is None:
+        arrivals = synthetic_arrivals(e_flow, r_flow, horizon)
+        stream = {'step_length': TIME_STEP, 'add_len': 40, 'm_lanes_info': M_LANES_INFO,
+                  'r_lanes_info': R_LANES_INFO}
+    else:
+        stream = load_arrivals(path)
+        arrivals = stream['arrivals']
+    planner = MergePlanner(add_len=stream['add_len'], step_length=stream['step_length'], evict=False)
+    planner.set_lanes_info('m', stream['m_lanes_info'])
+    planner.set_lanes_info('r', stream['r_lanes_info'])
+    for arrival in arrivals:
+        planner.plan_arrival(arrival)
+    trajectories = list(planner.scheduled_trajectories.values())
+    samples = sum(len(item.time) for item in trajectories)
+    print(f"{len(trajectories)} trajectories, {samples} samples (moveTo commands)")
+    for tolerance in tolerances:
+        start = time.perf_counter()
+        commands = 0
+        deviation = 0.0
+        for item in trajectories:
+            keys = speed_keyframes(item.time, item.x, tolerance)
+            commands += len(keys) - 1
+            driven = np.interp(item.time, item.time[keys], item.x[keys])
+            deviation = max(deviation, float(np.max(np.abs(driven - item.x))))
+        print(f"tolerance {tolerance:5.2f} m: {commands:7d} setSpeed commands ({samples / commands:6.1f}x fewer), "
+              f"max deviation {deviation:.3f} m, split in {time.perf_counter() - start:.2f} s")
+
+
+def bench_time_warp(e_flow=1800, r_flow=1600, horizon=300.0):
+    """
+    Cost of modify_trajectory_end_time and of the recompose cascades of merge_into with the CubicSpline time warp
+    and the linear one, planning the same synthetic arrivals, and the largest difference between the two warps on
+    the calls of the spline run.
+    """
+    arrivals = synthetic_arrivals(e_flow, r_flow, horizon)
+    calls = []
+    for name in ('spline', 'linear'):
+        planner = MergePlanner(add_len=40, step_length=TIME_STEP, time_warp=name)
+        planner.set_lanes_info('m', M_LANES_INFO)
+        planner.set_lanes_info('r', R_LANES_INFO)
+        if name == 'spline':
+            warp = planner.modify_trajectory_end_time
+
+            def recording_warp(origin_trajectory, end_time):
+                calls.append((origin_trajectory, end_time))
+                return warp(origin_trajectory, end_time)
+
+            planner.modify_trajectory_end_time = recording_warp
+        for arrival in arrivals:
+            planner.plan_arrival(arrival)
+        warp_timer = planner.profile.timers['modify_trajectory_end_time']
+        cascade_timer = planner.profile.timers.get('recompose_cascade')
+        cascades = planner.profile.samples['recompose_depth']
+        print(f"{name:>7}: modify_trajectory_end_time {warp_timer.count:5d} calls, {warp_timer.total / 1e3:8.1f} ms, "
+              f"mean {warp_timer.total / warp_timer.count / 1e3:.3f} ms; recompose cascades "
+              f"{cascade_timer.total / 1e3 if cascade_timer else 0.0:8.1f} ms ({cascades.total} trajectories "
+              f"recomposed); merge_into {planner.profile.timers['merge_into'].total / 1e3:8.1f} ms")
+    spline_planner = MergePlanner(add_len=40, step_length=TIME_STEP, time_warp='spline')
+    linear_planner = MergePlanner(add_len=40, step_length=TIME_STEP, time_warp='linear')
+    params = VehicleParams(ACCELERATION, DECELERATION, MAX_SPEED, VEHICLE_LENGTH)
+    dx, dv = [], []
+    for origin_trajectory, end_time in calls:
+        for t_planner in (spline_planner, linear_planner):
+            t_planner.vehicle_params[origin_trajectory.vehicle] = params
+        spline_trajectory = spline_planner.modify_trajectory_end_time(origin_trajectory, end_time)
+        linear_trajectory = linear_planner.modify_trajectory_end_time(origin_trajectory, end_time)
+        dx.append(np.max(np.abs(spline_trajectory.x - linear_trajectory.x)))
+        dv.append(np.max(np.abs(spline_trajectory.speed - linear_trajectory.speed)))
+    # The largest differences are at the joins of concatenated trajectories, where x may step back by a few
+    # centimetres and the spline overshoots.
+    for name, values, unit, scale in (('position', dx, 'mm', 1e3), ('speed', dv, 'm/s', 1.0)):
+        print(f"linear vs spline {name} on the {len(calls)} calls: p50 {np.percentile(values, 50) * scale:.2e}, "
+              f"p90 {np.percentile(values, 90) * scale:.2e}, max {np.max(values) * scale:.2e} {unit}")
+
+
+def bench_occupancy(e_flow=1800, r_flow=1600, horizons=(60.0, 300.0, 900.0), n_queries=1000, seed=1024):
+    """
+    OccupancyIndex queries against a scan of every scheduled trajectory, with all the trajectories of a horizon
+    kept (evict=False): occupants of a random 50 m of the shared lanes at a random time, and the conflict check of
+    a plan against all the others.
+    """
+    rng = np.random.default_rng(seed)
+    for horizon in horizons:
+        planner = MergePlanner(add_len=40, step_length=TIME_STEP, evict=False)
+        planner.set_lanes_info('m', M_LANES_INFO)
+        planner.set_lanes_info('r', R_LANES_INFO)
+        for arrival in synthetic_arrivals(e_flow, r_flow, horizon):
+            planner.plan_arrival(arrival)
+        occupancy = planner.occupancy
+        trajectories = planner.scheduled_trajectories
+        times = rng.uniform(0.0, horizon, n_queries)
+        starts = rng.uniform(0.0, 900.0, n_queries)
+        start = time.perf_counter()
+        for t, x in zip(times, starts):
+            occupancy.occupants('shared', x, x + 50.0, t)
+        indexed = (time.perf_counter() - start) / n_queries
+        start = time.perf_counter()
+        for t, x in zip(times, starts):
+            found = []
+            for t_vehicle, t_trajectory in trajectories.items():
+                tail = occupancy.position_at(t_vehicle, t)
+                if tail is None:
+                    continue
+                road, position = occupancy.road_of(t_vehicle[0], tail)
+                if road == 'shared' and position <= x + 50.0 and position + t_trajectory.space_len >= x:
+                    found.append(t_vehicle)
+        scanned = (time.perf_counter() - start) / n_queries
+        vehicles = sorted(trajectories)
+        plans = [(t_vehicle, trajectories[t_vehicle]) for t_vehicle in rng.choice(vehicles, 20)]
+        start = time.perf_counter()
+        for t_vehicle, t_trajectory in plans:
+            occupancy.conflicts(t_vehicle, t_vehicle[0], t_trajectory)
+        checked = (time.perf_counter() - start) / len(plans)
+        start = time.perf_counter()
+        for t_vehicle, t_trajectory in plans:
+            plan = (t_vehicle[0], t_trajectory, occupancy.steps(t_trajectory.time))
+            for other in vehicles:
+                if other != t_vehicle:
+                    occupancy.pair_conflict(plan, occupancy.vehicles[other][:3], -2 ** 62, 2 ** 62)
+        paired = (time.perf_counter() - start) / len(plans)
+        print(f"{len(trajectories):5d} trajectories: occupants {indexed * 1e3:7.3f} ms (scan {scanned * 1e3:7.3f} ms), "
+              f"conflicts {checked * 1e3:7.3f} ms (all pairs {paired * 1e3:8.3f} ms)")
+
+
+def backend_steps(t=60.0, e_flow=1800, r_flow=1600, sumo_binary=None):
+    """
+    Steps per second of the shipped scenario with the SUMO backend this process has selected (see common/backend.py):
+    SUMO alone, stepped and observed with VehicleObserver, and the full PreemptiveMerge driver. Prints one JSON line.
+    """
+    import PreemptiveMerge
+    from backend import active_backend
+    from observation import VehicleObserver
+    traci = PreemptiveMerge.traci
+    sumo_binary = sumo_binary or shutil.which('sumo') or PreemptiveMerge.sumo_cli
+    sumocfg = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1.test.sumocfg")
+    steps = round(t / TIME_STEP)
+    result = {'backend': active_backend()}
+    with tempfile.TemporaryDirectory() as out_dir:
+        rou_file = os.path.join(out_dir, "1.test.rou.xml")
+        PreemptiveMerge.update_rou(e_flow, r_flow, rou_file)
+        traci.start([sumo_binary, "-c", sumocfg, "-r", rou_file, "--seed", "1024", "--no-warnings"])
+        observer = VehicleObserver()
+        start = time.perf_counter()
+        for _ in range(steps):
+            traci.simulationStep()
+            observer.update()
+        result['sumo'] = steps / (time.perf_counter() - start)
+        traci.close()
+        start = time.perf_counter()
+        with quiet_planner():
+            PreemptiveMerge.simulate(e_flow, r_flow, t, 1024, out_dir, sumo_binary)
+        result['PreemptiveMerge'] = steps / (time.perf_counter() - start)
+    print(json.dumps(result))
+
+
+def bench_resolution(e_flow=1800, r_flow=1600, horizon=300.0, resolutions=(0.01, 0.05, 0.1), n_check=100):
+    """
+    Planning the same synthetic arrivals at coarser resolutions than the simulation step: planning time, memory of
+    the trajectories and validation violations per resolution. Then the error of the controller targets
+    (Trajectory.target_at) of the simulation-step plans decimated to each resolution, against the samples they drop:
+    the tolerance of driving a coarse plan. Plans made at different resolutions are not the same plans (the merge
+    order may differ), so they are not compared to each other.
+    """
+    arrivals = synthetic_arrivals(e_flow, r_flow, horizon)
+    trajectories = None
+    for resolution in resolutions:
+        planner = MergePlanner(add_len=40, step_length=resolution, evict=False)
+        planner.set_lanes_info('m', M_LANES_INFO)
+        planner.set_lanes_info('r', R_LANES_INFO)
+        start = time.perf_counter()
+        for arrival in arrivals:
+            planner.plan_arrival(arrival)
+        elapsed = time.perf_counter() - start
+        memory = sum(item.nbytes() for item in planner.scheduled_trajectories.values())
+        violations = ", ".join(f"{name} {count}" for name, count in planner.validation.counts.items())
+        print(f"resolution {resolution:5.2f} s: planned in {elapsed:6.2f} s, trajectories {memory / 1e6:6.1f} MB, "
+              f"violations: {violations}")
+        if trajectories is None:
+            trajectories = list(planner.scheduled_trajectories.values())[:n_check]
+    for resolution in resolutions[1:]:
+        every = int(round(resolution / TIME_STEP))
+        dx, dposition, lanes = [], [], 0
+        for item in trajectories:
+            keep = np.arange(0, len(item.time), every)
+            if keep[-1] != len(item.time) - 1:
+                keep = np.append(keep, len(item.time) - 1)
+            coarse = Trajectory(item.vehicle, item.time[keep], item.x[keep], item.speed[keep], item.lane_code[keep],
+                                item.lane_position[keep], item.space_len, item.geometry)
+            for idx in range(len(item.time)):
+                target = coarse.target_at(item.time[idx], True)
+                dx.append(abs(target.x - item.x[idx]))
+                if target.lane_id == item.lane_id(idx):
+                    dposition.append(abs(target.lane_position - item.lane_position[idx]))
+                else:
+                    lanes += 1
+        print(f"targets of {len(trajectories)} plans decimated to {resolution:5.2f} s: x error p50 "
+              f"{np.percentile(dx, 50) * 1e3:.2f}, p99 {np.percentile(dx, 99) * 1e3:.2f}, max {np.max(dx) * 1e3:.1f} mm; "
+              f"lane position error max {np.max(dposition) * 1e3:.1f} mm, {lanes} of {len(dx)} on another lane")
+
+
+def bench_piecewise(e_flow=1800, r_flow=1600, horizon=300.0, tolerances=(1e-5, 1e-4, 1e-3), n_queries=100000,
+                    seed=1024):
+    """
+    Scheduled trajectories as PiecewiseTrajectory against the dense samples: segments and bytes per vehicle and the
+    largest fit error per tolerance, the latency of the reads of the controller (target_at) and of the planner
+    (position_at, at) on both, and the planner run with each representation.
+    """
+    arrivals = synthetic_arrivals(e_flow, r_flow, horizon)
+    planner = MergePlanner(add_len=40, step_length=TIME_STEP, evict=False)
+    planner.set_lanes_info('m', M_LANES_INFO)
+    planner.set_lanes_info('r', R_LANES_INFO)
+    for arrival in arrivals:
+        planner.plan_arrival(arrival)
+    trajectories = list(planner.scheduled_trajectories.values())
+    dense_bytes = sum(item.nbytes() for item in trajectories) / len(trajectories)
+    print(f"{len(trajectories)} trajectories, dense {dense_bytes / 1e3:.1f} kB per vehicle")
+    fitted = None
+    for tolerance in tolerances:
+        start = time.perf_counter()
+        pieces = [PiecewiseTrajectory.fit(item, planner.vehicle_params[item.vehicle].length + 0.1, TIME_STEP,
+                                          tolerance, planner.vehicle_params[item.vehicle]) for item in trajectories]
+        elapsed = time.perf_counter() - start
+        error = max(float(np.max(np.abs(piece.evaluate(item.time)[0] - item.x)))
+                    for piece, item in zip(pieces, trajectories))
+        segments = sum(len(piece.starts) for piece in pieces) / len(pieces)
+        piece_bytes = sum(piece.nbytes() for piece in pieces) / len(pieces)
+        print(f"tolerance {tolerance:.0e} m: {segments:5.1f} segments, {piece_bytes / 1e3:5.2f} kB per vehicle "
+              f"({dense_bytes / piece_bytes:5.0f}x less), max error {error * 1e3:.4f} mm, fitted in {elapsed:.2f} s")
+        if fitted is None:
+            fitted = pieces
+
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(len(trajectories), size=n_queries)
+    fractions = rng.random(n_queries)
+    queries = [(k, trajectories[k].time[0] + f * (trajectories[k].time[-1] - trajectories[k].time[0]))
+               for k, f in zip(picks.tolist(), fractions.tolist())]
+    for name, items in (('dense', trajectories), ('piecewise', fitted)):
+        for method in ('target_at', 'position_at', 'at'):
+            if method == 'at' and name == 'dense':
+                continue
+            start = time.perf_counter()
+            for k, t in queries:
+                if method == 'target_at':
+                    items[k].target_at(t)
+                elif method == 'position_at':
+                    items[k].position_at(t, TIME_STEP / 2)
+                else:
+                    items[k].at(t)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>9} {method:>11}: {elapsed / n_queries * 1e6:6.2f} us per query")
+
+    for representation in ('dense', 'piecewise'):
+        planner = MergePlanner(add_len=40, step_length=TIME_STEP, evict=False, representation=representation)
+        planner.set_lanes_info('m', M_LANES_INFO)
+        planner.set_lanes_info('r', R_LANES_INFO)
+        start = time.perf_counter()
+        for arrival in arrivals:
+            planner.plan_arrival(arrival)
+        elapsed = time.perf_counter() - start
+        memory = sum(item.nbytes() for item in planner.scheduled_trajectories.values())
+        violations = ", ".join(f"{name} {count}" for name, count in planner.validation.counts.items())
+        print(f"{representation:>9}: planned in {elapsed:6.2f} s, trajectories {memory / 1e6:7.3f} MB, "
+              f"violations: {violations}")
+
+
+def bench_backends(t=60.0, e_flow=1800, r_flow=1600, backends=('traci', 'libsumo')):
+    """
+    backend_steps for every backend, each in its own process (a process can only import traci with one backend).
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    common = os.path.join(os.path.dirname(directory), 'common')
+    child = (f"import sys; sys.path.append({common!r}); from backend import select_backend; select_backend(); "
+             f"import benchmark; benchmark.backend_steps({t!r}, {e_flow!r}, {r_flow!r})")
+    print(f"steps per second, {t:.0f} s of the shipped scenario at {e_flow}/{r_flow} veh/h")
+    for backend in backends:
+        completed = subprocess.run([sys.executable, '-c', child], cwd=directory, capture_output=True, text=True,
+                                   env=dict(os.environ, SUMO_BACKEND=backend))
+        if completed.returncode != 0:
+            print(f"{backend:>8}: failed\n{completed.stderr}")
+            continue
+        # The result is the last line of the output.
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        note = "" if result['backend'] == backend else f" (not installed, ran {result['backend']})"
+        print(f"{backend:>8}: SUMO + observer {result['sumo']:8.0f}, PreemptiveMerge {result['PreemptiveMerge']:6.0f}"
+              f"{note}")
+
+
+BENCHMARKS = {'memory': bench_trajectory_memory,
+              'lookup': bench_step_lookup,
+              'scale_series': bench_scale_series,
+              'merge_slot': bench_merge_slot,
+              'merge_probes': bench_merge_probes,
+              'free_flow': bench_free_flow,
+              'follow': bench_follow,
+              'allocations': bench_allocations,
+              'replay': bench_replay,
+              'horizon': bench_horizon,
+              'keyframes': bench_keyframes,
+              'time_warp': bench_time_warp,
+              'occupancy': bench_occupancy,
+              'resolution': bench_resolution,
+              'piecewise': bench_piecewise,
+              'backends': bench_backends}
+
+if __name__ == "__main__":
+    for t_name in sys.argv[1:] or BENCHMARKS:
+        with quiet_planner():
+            BENCHMARKS[t_name]()
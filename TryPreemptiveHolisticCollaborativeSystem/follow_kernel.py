@@ -0,0 +1,140 @@
+import numpy as np
+try:
+    import numba
+except ImportError:
+    # Optional: without numba the same kernel runs as plain Python.
+    numba = None
+
+
+def follow_steps(lead_time, lead_x, lead_speed, lead_shift, follower_shift, from_time, start_x, init_speed,
+                 max_vehicle_speed, acceleration, time_step_length, space_len, total_len, offsets, max_speeds):
+    """
+    Car-following rules of compose_follow_trajectory, stepped until the tail reaches total_len.
+
+    The leader sample of a step is the first one at or after the step time. As the time only grows, it is found by
+    moving an index along the leader trajectory instead of searching the whole trajectory every step, and the lane at
+    the tail by moving a lane index along the route.
+
+    Parameters:
+    - lead_time, lead_x, lead_speed: leader trajectory (lead_x along the route of the leader).
+    - lead_shift, follower_shift: merge offsets of the leader and follower routes; the leader is followed at
+      lead_x - lead_shift + follower_shift.
+    - from_time, start_x, init_speed: state of the follower at the start.
+    - max_vehicle_speed, acceleration: parameters of the follower.
+    - time_step_length: time step (s).
+    - space_len: vehicle length plus the additional space kept to the leader.
+    - total_len: distance at which the trajectory ends.
+    - offsets, max_speeds: lane offsets and speed limits of the follower route (RouteGeometry).
+
+    Returns:
+    - time, x and speed arrays of the steps after the start, and False if the follower got too near to the leader
+      (the arrays then end at the failing step).
+    """
+    n_lead = len(lead_time)
+    n_lanes = len(max_speeds)
+    dv_up = time_step_length * acceleration * 0.4
+    dv_brake = time_step_length * acceleration * 1.9
+    dv_stop = time_step_length * acceleration * 3.2
+    dv_emergency = time_step_length * acceleration * 5.2
+    capacity = 1024
+    time_out = np.empty(capacity)
+    x_out = np.empty(capacity)
+    speed_out = np.empty(capacity)
+    n = 0
+    t_time = from_time
+    tail_x = start_x
+    t_speed = init_speed
+    lead_idx = 0
+    lane = 0
+    strict_follow = False
+    strict_gap = space_len
+    lead_x_sample = 0.0
+    lead_speed_sample = 0.0
+    while tail_x < total_len:
+        while lead_idx < n_lead and lead_time[lead_idx] < t_time:
+            lead_idx += 1
+        # No leader sample after the end of the leader trajectory, nor at its very first sample.
+        has_leader = 0 < lead_idx < n_lead
+        if has_leader:
+            lead_x_sample = lead_x[lead_idx] - lead_shift + follower_shift
+            lead_speed_sample = lead_speed[lead_idx]
+        while lane + 1 < n_lanes and offsets[lane + 1] <= tail_x:
+            lane += 1
+        while lane > 0 and offsets[lane] > tail_x:
+            lane -= 1
+        limit = min(max_vehicle_speed, max_speeds[lane])
+
+        if t_speed < limit * 0.995:
+            if not has_leader:
+                t_speed += dv_up
+            elif tail_x + space_len + 5 < lead_x_sample and t_speed < lead_speed_sample:
+                t_speed += dv_up
+        if t_speed > limit * 1.005:
+            t_speed -= dv_up
+        if has_leader:
+            if tail_x + space_len > lead_x_sample:
+                t_speed -= dv_brake
+            if t_speed > lead_speed_sample and tail_x + space_len > lead_x_sample:
+                t_speed -= dv_stop
+            if tail_x + space_len > lead_x_sample - 2.0 and tail_x < space_len + 8:
+                t_speed = lead_speed_sample
+            if t_speed > lead_speed_sample and tail_x < 8:
+                t_speed = lead_speed_sample
+            if t_speed > lead_speed_sample + 0.2 and tail_x + space_len > lead_x_sample - 5.0:
+                t_speed = lead_speed_sample
+            if t_speed > lead_speed_sample and tail_x + space_len > lead_x_sample - 8.0 and tail_x > 5.2 \
+                    and start_x < 1.0:
+                t_speed -= dv_stop
+            if tail_x + space_len > lead_x_sample and tail_x < space_len + 8:
+                t_speed = 0.0
+            if tail_x + space_len > lead_x_sample - 4.0 and tail_x > 5.2 and start_x < 1.0:
+                t_speed -= dv_emergency
+        if t_speed < 0.0:
+            t_speed = 0.0
+
+        if has_leader and -2.0 < tail_x + space_len - lead_x_sample < 0 and abs(t_speed - lead_speed_sample) < 0.5:
+            strict_follow = True
+            strict_gap = lead_x_sample - tail_x
+        if has_leader and strict_follow:
+            t_speed = lead_speed_sample
+            tail_x = lead_x_sample - strict_gap
+        else:
+            tail_x += t_speed * time_step_length
+        if has_leader and tail_x + space_len > lead_x_sample + 0.3 and tail_x > 5.2:
+            return time_out[:n], x_out[:n], speed_out[:n], False
+
+        t_time += time_step_length
+        if n == capacity:
+            capacity *= 2
+            time_out = np.concatenate((time_out, np.empty(n)))
+            x_out = np.concatenate((x_out, np.empty(n)))
+            speed_out = np.concatenate((speed_out, np.empty(n)))
+        time_out[n] = t_time
+        x_out[n] = tail_x
+        speed_out[n] = t_speed
+        n += 1
+    return time_out[:n], x_out[:n], speed_out[:n], True
+
+
+if numba is not None:
+    # nogil: the simulation keeps running while AsyncTrajectoryMerge plans in its worker thread.
+    follow_steps_compiled = numba.njit(cache=True, nogil=True)(follow_steps)
+else:
+    follow_steps_compiled = None
+
+
+def follow_profile(lead_time, lead_x, lead_speed, lead_shift, follower_shift, from_time, start_x, init_speed,
+                   max_vehicle_speed, acceleration, time_step_length, space_len, total_len, geometry, use_numba=True):
+    """
+    Runs follow_steps compiled by numba when it is installed (and use_numba), as plain Python (on lists, which index
+    faster than numpy arrays element by element) otherwise. Parameters and returns as follow_steps, geometry being
+    the RouteGeometry of the follower.
+    """
+    if use_numba and follow_steps_compiled is not None:
+        return follow_steps_compiled(lead_time, lead_x, lead_speed, float(lead_shift), float(follower_shift),
+                                     float(from_time), float(start_x), float(init_speed), float(max_vehicle_speed),
+                                     float(acceleration), float(time_step_length), float(space_len),
+                                     float(total_len), geometry.offsets, geometry.max_speeds)
+    return follow_steps(lead_time.tolist(), lead_x.tolist(), lead_speed.tolist(), lead_shift, follower_shift,
+                        from_time, start_x, init_speed, max_vehicle_speed, acceleration, time_step_length, space_len,
+                        total_len, geometry.offsets.tolist(), geometry.max_speeds.tolist())
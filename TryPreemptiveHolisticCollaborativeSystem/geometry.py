@@ -0,0 +1,82 @@
+import bisect
+import numpy as np
+from trajectory import Trajectory
+
+
+class RouteGeometry:
+    """
+    Lane chain of a route with the cumulative lane offsets precomputed, so a distance along the route is resolved
+    to (lane, position on lane) by a binary search instead of walking lanes_info.
+
+    - lanes_info: [{'lane_id', 'length', 'maxSpeed'}, ...] in driving order, as read by Network.route_lanes_info.
+    - lane_table: the shared LaneTable the lane codes refer to.
+    """
+    __slots__ = ('lanes_info', 'lane_table', 'codes', 'lengths', 'max_speeds', 'offsets', 'total_length',
+                 '_offsets_list', '_max_speeds_list')
+
+    def __init__(self, lanes_info, lane_table):
+        self.lanes_info = lanes_info
+        self.lane_table = lane_table
+        self.codes = np.array([lane_table.code(t_lane['lane_id']) for t_lane in lanes_info],
+                              dtype=Trajectory.LANE_CODE_DTYPE)
+        self.lengths = np.array([t_lane['length'] for t_lane in lanes_info], dtype=np.float64)
+        self.max_speeds = np.array([t_lane['maxSpeed'] for t_lane in lanes_info], dtype=np.float64)
+        # offsets[k] is the distance from the start of the route to the start of lane k, offsets[-1] the route length.
+        self.offsets = np.concatenate(([0.0], np.cumsum(self.lengths)))
+        self.total_length = float(self.offsets[-1])
+        self._offsets_list = self.offsets.tolist()
+        self._max_speeds_list = self.max_speeds.tolist()
+
+    def lane_index(self, t_x):
+        """
+        Index (into lanes_info) of the lane at distance t_x. Distances past the end map to the last lane.
+        """
+        idx = bisect.bisect_right(self._offsets_list, t_x) - 1
+        return min(max(idx, 0), len(self._max_speeds_list) - 1)
+
+    def max_speed_at(self, t_x):
+        return self._max_speeds_list[self.lane_index(t_x)]
+
+    def distance_of(self, lane_id, position):
+        """
+        Distance along the route of a position on one of its lanes, None if the lane is not on the route.
+        """
+        for t_lane, t_info in enumerate(self.lanes_info):
+            if t_info['lane_id'] == lane_id:
+                return self._offsets_list[t_lane] + position
+        return None
+
+    def locate(self, x):
+        """
+        Resolves an array of distances along the route to lane codes and positions on those lanes in one
+        np.searchsorted pass.
+
+        Parameters:
+        - x: A 1D numpy array of distances from the start of the route.
+
+        Returns:
+        - lane codes (Trajectory.LANE_CODE_DTYPE) and positions on the lanes. A distance past the end of the route
+          is reported on the last lane, measured from the end of the route.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        n_lanes = len(self.lengths)
+        idx = np.clip(np.searchsorted(self.offsets, x, side='right') - 1, 0, n_lanes)
+        positions = x - self.offsets[idx]
+        return self.codes[np.minimum(idx, n_lanes - 1)], positions
+
+
+def merge_offsets(geometry_a, geometry_b, decimals=2):
+    """
+    Distances along two routes to the start of the first lane they share, where they merge. The lane lengths of a
+    SUMO network have 2 decimals, the sums are rounded to them (so 1014.23 + 8.33 gives 1022.56).
+
+    Returns:
+    - the distances along route a and along route b.
+    """
+    codes_a = geometry_a.codes.tolist()
+    codes_b = geometry_b.codes.tolist()
+    for k, t_code in enumerate(codes_a):
+        if t_code in codes_b:
+            k_b = codes_b.index(t_code)
+            return round(float(geometry_a.offsets[k]), decimals), round(float(geometry_b.offsets[k_b]), decimals)
+    raise ValueError("the routes do not merge")
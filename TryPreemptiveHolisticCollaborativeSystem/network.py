@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+from collections import deque
+from xml.etree import ElementTree as ET
+from geometry import RouteGeometry, merge_offsets
+from trajectory import LaneTable
+
+# Directory of the cache, next to the network file.
+CACHE_DIR = '.geometry_cache'
+
+
+def net_hash(net_file):
+    """
+    SHA-256 of the contents of a network file, the key of its cache.
+    """
+    digest = hashlib.sha256()
+    with open(net_file, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Network:
+    """
+    The parts of a SUMO network (.net.xml) the planner needs, read with ElementTree.
+
+    - lanes: {lane_id: {'length', 'maxSpeed'}} of all the lanes, internal ones included.
+    - edge_lanes: {edge_id: [lane_id, ...]} of the normal (not internal) edges, by lane index.
+    - connections: {(from_edge, from_lane_index): [(to_edge, to_lane_index, via_lane_id or None), ...]} between
+      normal edges.
+    """
+    def __init__(self, net_file):
+        root = ET.parse(net_file).getroot()
+        self.lanes = {}
+        self.edge_lanes = {}
+        for edge in root.iter('edge'):
+            internal = edge.get('function') == 'internal'
+            lanes = []
+            for lane in edge.iter('lane'):
+                self.lanes[lane.get('id')] = {'length': float(lane.get('length')),
+                                              'maxSpeed': float(lane.get('speed'))}
+                lanes.append((int(lane.get('index')), lane.get('id')))
+            if not internal:
+                self.edge_lanes[edge.get('id')] = [lane_id for _, lane_id in sorted(lanes)]
+        self.connections = {}
+        for connection in root.iter('connection'):
+            if connection.get('from') not in self.edge_lanes or connection.get('to') not in self.edge_lanes:
+                continue
+            key = (connection.get('from'), int(connection.get('fromLane')))
+            self.connections.setdefault(key, []).append((connection.get('to'), int(connection.get('toLane')),
+                                                         connection.get('via')))
+
+    def route_edges(self, from_edge, to_edge):
+        """
+        Edges of the route from from_edge to to_edge with the fewest edges (breadth-first over the connections).
+        """
+        previous = {from_edge: None}
+        pending = deque([from_edge])
+        while pending:
+            edge = pending.popleft()
+            if edge == to_edge:
+                edges = []
+                while edge is not None:
+                    edges.append(edge)
+                    edge = previous[edge]
+                return edges[::-1]
+            for lane_index in range(len(self.edge_lanes[edge])):
+                for next_edge, _, _ in self.connections.get((edge, lane_index), ()):
+                    if next_edge not in previous:
+                        previous[next_edge] = edge
+                        pending.append(next_edge)
+        raise ValueError(f"no route from {from_edge} to {to_edge}")
+
+    def route_lanes_info(self, from_edge, to_edge, depart_lane=0):
+        """
+        Lane chain driven from lane depart_lane of from_edge to to_edge, internal lanes included, as
+        [{'lane_id', 'length', 'maxSpeed'}, ...] (the lanes_info of MergePlanner.set_lanes_info).
+        """
+        edges = self.route_edges(from_edge, to_edge)
+        lane_ids = [self.edge_lanes[from_edge][depart_lane]]
+        lane_index = depart_lane
+        for edge, next_edge in zip(edges, edges[1:]):
+            for to_edge_id, to_lane, via in self.connections[(edge, lane_index)]:
+                if to_edge_id == next_edge:
+                    if via is not None:
+                        lane_ids.append(via)
+                    lane_ids.append(self.edge_lanes[next_edge][to_lane])
+                    lane_index = to_lane
+                    break
+            else:
+                raise ValueError(f"lane {lane_index} of {edge} has no connection to {next_edge}")
+        return [{'lane_id': lane_id, **self.lanes[lane_id]} for lane_id in lane_ids]
+
+
+def load_route_geometry(net_file, routes, cache_dir=None):
+    """
+    Lane chains of the routes and their merge offsets, read from the cache of the network file when it has them, else
+    parsed from the network and added to the cache. The cache is keyed by the hash of the network file, so a changed
+    network is parsed again.
+
+    Parameters:
+    - net_file: SUMO network file.
+    - routes: {route name: (from_edge, to_edge)}, two routes that merge.
+    - cache_dir: directory of the cache, CACHE_DIR next to the network file by default.
+
+    Returns:
+    - {'lanes_info': {route name: lanes_info}, 'merge_offsets': {route name: distance along the route to the
+      first lane it shares with the other route}}.
+    """
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(net_file)), CACHE_DIR)
+    cache_file = os.path.join(cache_dir, f"{net_hash(net_file)}.json")
+    key = json.dumps(sorted(routes.items()))
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as file:
+            cache = json.load(file)
+        if key in cache:
+            return cache[key]
+
+    network = Network(net_file)
+    lanes_info = {name: network.route_lanes_info(from_edge, to_edge) for name, (from_edge, to_edge) in routes.items()}
+    lane_table = LaneTable()
+    names = list(routes)
+    offsets = merge_offsets(RouteGeometry(lanes_info[names[0]], lane_table),
+                            RouteGeometry(lanes_info[names[1]], lane_table))
+    cache[key] = {'lanes_info': lanes_info, 'merge_offsets': dict(zip(names, offsets))}
+    # Written to a temporary file and renamed: simulations of a sweep may start at the same time.
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary = f"{cache_file}.{os.getpid()}"
+    with open(temporary, 'w') as file:
+        json.dump(cache, file)
+    os.replace(temporary, cache_file)
+    return cache[key]
@@ -0,0 +1,281 @@
+import bisect
+import numpy as np
+
+# Road of the lanes the routes share, from their merge point on.
+SHARED = 'shared'
+
+
+class OccupancyCell:
+    """
+    Vehicles on one road during one time bucket, each as the interval of the road it occupies at some time of the
+    bucket, sorted by the start of the interval.
+
+    - extent: length of the longest interval, a query for [start, end] only has to look at the intervals starting in
+      [start - extent, end].
+    """
+    __slots__ = ('starts', 'entries', 'extent')
+
+    def __init__(self):
+        self.starts = []
+        # (start, end, vehicle), in the order of starts.
+        self.entries = []
+        self.extent = 0.0
+
+    def insert(self, start, end, vehicle):
+        k = bisect.bisect_right(self.starts, start)
+        self.starts.insert(k, start)
+        self.entries.insert(k, (start, end, vehicle))
+        self.extent = max(self.extent, end - start)
+
+    def remove(self, start, vehicle):
+        k = bisect.bisect_left(self.starts, start)
+        while self.entries[k][2] != vehicle:
+            k += 1
+        del self.starts[k]
+        del self.entries[k]
+
+    def overlapping(self, start, end):
+        """
+        Entries whose interval overlaps [start, end].
+        """
+        low = bisect.bisect_left(self.starts, start - self.extent)
+        high = bisect.bisect_right(self.starts, end)
+        return [t_entry for t_entry in self.entries[low:high] if t_entry[1] >= start]
+
+
+class OccupancyIndex:
+    """
+    Space–time index of the scheduled trajectories of two routes merging into shared lanes.
+
+    The network is split into roads: the lanes of each route before its merge point (road 'm', road 'r') and the
+    shared lanes after it (road SHARED, measured from the merge point). A vehicle occupies the interval from its tail
+    to its tail plus the space_len of its trajectory (the vehicle and the gap it keeps in front, the extent
+    compose_follow_trajectory keeps free), split at the merge point when it spans it. Time is cut into buckets of
+    `bucket` seconds, every (road, bucket) cell keeps the interval each vehicle covers during the bucket sorted by its
+    start, so the vehicles near a place and time are found with a dict lookup and a binary search, and only those are
+    checked sample by sample.
+
+    - geometries: {route: RouteGeometry}.
+    - merges: {route: distance along the route to its merge point} (geometry.merge_offsets).
+    - step_length: time step of the trajectories (s).
+    - bucket: time bucket (s).
+    - tolerance: overlap (m) two vehicles may have before they conflict (the 0.3 m of gap_conflict).
+    - depart_zone: samples with the tail this close to the start of the route are not checked, SUMO inserts the
+      vehicles there (the 5.2 m of gap_conflict).
+    - cache_steps: keep the steps of the samples of every trajectory, instead of computing them at every check
+      (they take as much memory as a column of the trajectory, more than a PiecewiseTrajectory).
+    """
+    def __init__(self, geometries, merges, step_length, bucket=1.0, tolerance=0.3, depart_zone=5.2,
+                 cache_steps=True):
+        self.geometries = geometries
+        self.merges = merges
+        self.step_length = step_length
+        self.bucket_steps = max(int(round(bucket / step_length)), 1)
+        self.tolerance = tolerance
+        self.depart_zone = depart_zone
+        self.cache_steps = cache_steps
+        # {(road, bucket): OccupancyCell}
+        self.cells = {}
+        # {vehicle: (route, trajectory, steps of its samples or None, [(road, bucket, start), ...])}
+        self.vehicles = {}
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def __contains__(self, vehicle):
+        return vehicle in self.vehicles
+
+    def steps(self, time):
+        return np.rint(np.asarray(time) / self.step_length).astype(np.int64)
+
+    def road_of(self, route, x):
+        """
+        Road and position on it of a distance x along a route.
+        """
+        merge = self.merges[route]
+        if x < merge:
+            return route, x
+        return SHARED, x - merge
+
+    def intervals(self, route, t_trajectory, steps):
+        """
+        Interval of its road a trajectory covers during every time bucket, split at the merge point.
+
+        Returns:
+        - [(road, bucket, start, end), ...].
+        """
+        merge = self.merges[route]
+        buckets = steps // self.bucket_steps
+        # The times are increasing: the samples of a bucket are consecutive.
+        firsts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        lows = np.minimum.reduceat(t_trajectory.x, firsts).tolist()
+        highs = (np.maximum.reduceat(t_trajectory.x, firsts) + t_trajectory.space_len).tolist()
+        found = []
+        for t_bucket, low, high in zip(buckets[firsts].tolist(), lows, highs):
+            if low < merge:
+                found.append((route, t_bucket, low, min(high, merge)))
+            if high > merge:
+                found.append((SHARED, t_bucket, max(low, merge) - merge, high - merge))
+        return found
+
+    def add(self, vehicle, route, t_trajectory):
+        """
+        Indexes the trajectory of a vehicle, in place of the one it had.
+        """
+        self.remove(vehicle)
+        steps = self.steps(t_trajectory.time)
+        keys = self.intervals(route, t_trajectory, steps)
+        for road, t_bucket, start, end in keys:
+            cell = self.cells.get((road, t_bucket))
+            if cell is None:
+                cell = self.cells[(road, t_bucket)] = OccupancyCell()
+            cell.insert(start, end, vehicle)
+        if not self.cache_steps:
+            steps = None
+        self.vehicles[vehicle] = (route, t_trajectory, steps, [t_key[:3] for t_key in keys])
+
+    def replace(self, vehicle, t_trajectory):
+        """
+        Replaces the indexed trajectory of a vehicle by a part of it (Trajectory.drop_before) without reindexing:
+        the cells of the dropped samples stay until the vehicle is removed, they hold no sample any more.
+        """
+        route, _, _, keys = self.vehicles[vehicle]
+        steps = self.steps(t_trajectory.time) if self.cache_steps else None
+        self.vehicles[vehicle] = (route, t_trajectory, steps, keys)
+
+    def remove(self, vehicle):
+        entry = self.vehicles.pop(vehicle, None)
+        if entry is None:
+            return
+        for road, t_bucket, start in entry[3]:
+            cell = self.cells[(road, t_bucket)]
+            cell.remove(start, vehicle)
+            if not cell.entries:
+                del self.cells[(road, t_bucket)]
+
+    def position_at(self, vehicle, t):
+        """
+        Tail of a vehicle at time t (its first sample at or after t), None outside its trajectory.
+        """
+        return self.vehicles[vehicle][1].position_at(t, self.step_length / 2)
+
+    def occupants(self, road, start, end, t):
+        """
+        Vehicles occupying [start, end] of a road at time t, as [(vehicle, start, end of its interval), ...] sorted
+        by position.
+        """
+        cell = self.cells.get((road, int(self.steps(t)) // self.bucket_steps))
+        if cell is None:
+            return []
+        found = []
+        for _, _, vehicle in cell.overlapping(start, end):
+            route, t_trajectory, _, _ = self.vehicles[vehicle]
+            tail = self.position_at(vehicle, t)
+            if tail is None:
+                continue
+            t_road, t_start = self.road_of(route, tail)
+            t_end = t_start + t_trajectory.space_len
+            if t_road != SHARED:
+                t_end = min(t_end, self.merges[route])
+            if t_road != road:
+                # The interval starts on the road of the route and reaches into the shared lanes.
+                if road != SHARED:
+                    continue
+                t_start, t_end = 0.0, tail + t_trajectory.space_len - self.merges[route]
+            if t_start <= end and t_end >= start:
+                found.append((vehicle, t_start, t_end))
+        found.sort(key=lambda item: item[1])
+        return found
+
+    def lane_occupants(self, lane_id, start, end, t):
+        """
+        Vehicles occupying the positions start to end of a lane at time t (see occupants).
+        """
+        for route, geometry in self.geometries.items():
+            distance = geometry.distance_of(lane_id, start)
+            if distance is not None:
+                road, position = self.road_of(route, distance)
+                return self.occupants(road, position, position + end - start, t)
+        raise KeyError(f"lane {lane_id} is not on the routes")
+
+    def vehicles_ahead(self, route, x, t):
+        """
+        Vehicles ahead of distance x along a route at time t on the road of the route before the merge point,
+        nearest first (see occupants). Empty from the merge point on.
+        """
+        road, position = self.road_of(route, x)
+        if road == SHARED:
+            return []
+        return [item for item in self.occupants(road, position, self.merges[route], t) if item[1] > position]
+
+    def conflicts(self, vehicle, route, t_trajectory, exclude=()):
+        """
+        Checks a trajectory against the indexed ones: two vehicles conflict when their intervals on the same road
+        overlap by more than tolerance at the same step. Only the vehicles sharing a cell with the trajectory are
+        compared, over the buckets they share.
+
+        Returns:
+        - [(other vehicle, first time of the conflict, largest overlap), ...].
+        """
+        # {other vehicle: [first bucket, last bucket]} of the cells shared with the trajectory.
+        candidates = {}
+        steps = self.steps(t_trajectory.time)
+        for road, t_bucket, start, end in self.intervals(route, t_trajectory, steps):
+            cell = self.cells.get((road, t_bucket))
+            if cell is None:
+                continue
+            for _, _, other in cell.overlapping(start, end):
+                span = candidates.get(other)
+                if span is None:
+                    candidates[other] = [t_bucket, t_bucket]
+                else:
+                    span[1] = t_bucket
+        candidates.pop(vehicle, None)
+        found = []
+        for other in sorted(candidates):
+            if other in exclude:
+                continue
+            first, last = candidates[other]
+            conflict = self.pair_conflict((route, t_trajectory, steps), self.vehicles[other][:3],
+                                          first * self.bucket_steps, (last + 1) * self.bucket_steps)
+            if conflict is not None:
+                found.append((other, *conflict))
+        return found
+
+    def pair_conflict(self, plan_a, plan_b, first_step, end_step):
+        """
+        First time and largest overlap of two trajectories at the steps they share from first_step to before
+        end_step, None if they do not conflict.
+
+        Parameters:
+        - plan_a, plan_b: (route, trajectory, steps of its samples, None to compute them).
+        """
+        route_a, trajectory_a, steps_a = plan_a
+        route_b, trajectory_b, steps_b = plan_b
+        if steps_b is None:
+            steps_b = self.steps(trajectory_b.time)
+        a0, a1 = np.searchsorted(steps_a, (first_step, end_step))
+        b0, b1 = np.searchsorted(steps_b, (first_step, end_step))
+        if a0 >= a1 or b0 >= b1:
+            return None
+        steps_a, x_a = steps_a[a0:a1], trajectory_a.x[a0:a1]
+        steps_b, x_b = steps_b[b0:b1], trajectory_b.x[b0:b1]
+        idx = np.minimum(np.searchsorted(steps_b, steps_a), len(steps_b) - 1)
+        mask = (steps_b[idx] == steps_a) & (x_a > self.depart_zone) & (x_b[idx] > self.depart_zone)
+        if not mask.any():
+            return None
+        low_a = x_a[mask]
+        low_b = x_b[idx[mask]]
+        high_a = low_a + trajectory_a.space_len
+        high_b = low_b + trajectory_b.space_len
+        if route_a == route_b:
+            overlap = np.minimum(high_a, high_b) - np.maximum(low_a, low_b)
+        else:
+            # Only the shared lanes are common to the two routes.
+            merge_a, merge_b = self.merges[route_a], self.merges[route_b]
+            overlap = (np.minimum(high_a - merge_a, high_b - merge_b) -
+                       np.maximum(np.maximum(low_a - merge_a, low_b - merge_b), 0.0))
+        conflict = overlap > self.tolerance
+        if not conflict.any():
+            return None
+        return float(trajectory_a.time[a0:a1][mask][np.argmax(conflict)]), float(np.max(overlap))
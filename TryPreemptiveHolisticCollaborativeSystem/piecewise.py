@@ -0,0 +1,444 @@
+import math
+import threading
+from collections import OrderedDict
+import numpy as np
+from trajectory import ControlTarget, Trajectory
+
+# Largest distance (m) between a fitted trajectory and the samples it was fitted to, well below the distance a
+# vehicle moves in a step so the speeds between the samples stay those of the plan.
+FIT_TOLERANCE = 1e-5
+# Number of trajectories whose sample columns are kept once evaluated, the ones read last: the leaders and the
+# neighbours of the vehicles being planned, read again and again while an arrival is planned.
+CACHED_TRAJECTORIES = 16
+
+
+def constant_acceleration_segments(time, x, speed, tolerance, params=None):
+    """
+    Splits samples into segments of constant acceleration, each through the samples at its ends and within tolerance
+    of the samples between them (the acceleration is the least squares one). Segments are grown as in
+    actuation.speed_keyframes: doubled, then bisected. A sample at the time of the one before it (the join of two
+    concatenated trajectories) starts a new segment.
+
+    The samples at which x is held while the speed is not 0 (the tail waiting at the end of a trajectory while the
+    planner drives on at its speed) are one held segment, at the speed of its first sample: the follow kernel
+    reads the speed of its leader there.
+
+    With params, the acceleration of a segment is kept within the limits of the vehicle and so that its speed
+    stays within 0 and max_speed at both ends, hence all along it (it is linear): x never decreases and the
+    segments drive as validation.check_trajectory expects. A segment that cannot meet them within tolerance is
+    split, down to two samples (their constant speed).
+
+    Parameters:
+    - time, x, speed: samples of a trajectory.
+    - tolerance: largest distance (m) between a segment and the samples it covers.
+    - params: VehicleParams of the vehicle, None for no limits.
+
+    Returns:
+    - [(start time, x, speed and acceleration at the start, held), ...].
+    """
+    n = len(time)
+    segments = []
+    start = 0
+    if params is None:
+        max_speed = accel = decel = np.inf
+    else:
+        max_speed, accel, decel = params.max_speed, params.accel, params.decel
+    # Steps from a sample to the next one at which x is held.
+    held_steps = np.flatnonzero((x[1:] <= x[:-1]) & (time[1:] > time[:-1]) & (speed[1:] > 0))
+
+    def fit(end):
+        tau = time[start:end + 1] - time[start]
+        span = tau[-1]
+        if span <= 0:
+            return None
+        # Through both ends: x = line + a * basis, with a the only free parameter.
+        slope = (x[end] - x[start]) / span
+        residual = x[start:end + 1] - x[start]
+        residual -= slope * tau
+        basis = tau * (tau - span)
+        basis *= 0.5
+        norm = basis @ basis
+        acceleration = (residual @ basis) / norm if norm > 0 else 0.0
+        # The speeds at the ends are slope -+ acceleration * span / 2. The residual is convex in the acceleration,
+        # the closest one within the limits is the best one.
+        half = span / 2
+        acceleration = min(max(acceleration, -slope / half, (slope - max_speed) / half, -decel),
+                           slope / half, (max_speed - slope) / half, accel)
+        residual -= acceleration * basis
+        if np.abs(residual, out=residual).max() > tolerance:
+            return None
+        return slope - acceleration * span / 2, acceleration
+
+    while start < n - 1:
+        if time[start + 1] <= time[start]:
+            start += 1
+            continue
+        hold = int(np.searchsorted(held_steps, start))
+        # A segment ends where x starts to be held.
+        last = int(held_steps[hold]) if hold < len(held_steps) else n - 1
+        if last == start:
+            run = hold
+            while run + 1 < len(held_steps) and held_steps[run + 1] == held_steps[run] + 1:
+                run += 1
+            # From the sample before the held ones: the times between them are held too.
+            segments.append((time[start], x[start], speed[start + 1], 0.0, True))
+            start = int(held_steps[run]) + 1
+            continue
+        good = start + 1
+        coefficients = fit(good)
+        bad = None
+        # Most segments are long: the first try is 64 samples, then the length is doubled.
+        end = min(start + 64, last)
+        while end > good:
+            t_fit = fit(end)
+            if t_fit is None:
+                bad = end
+                break
+            good, coefficients = end, t_fit
+            end = min(start + 2 * (good - start), last)
+        if bad is not None:
+            while bad - good > 1:
+                mid = (good + bad) // 2
+                t_fit = fit(mid)
+                if t_fit is None:
+                    bad = mid
+                else:
+                    good, coefficients = mid, t_fit
+        segments.append((time[start], x[start], *coefficients, False))
+        start = good
+    return segments
+
+
+class PiecewiseTrajectory:
+    """
+    Scheduled trajectory of one vehicle as segments of constant acceleration instead of samples: memory in the number
+    of segments (tens per vehicle) instead of the number of steps (thousands).
+
+    The samples of the dense Trajectory are evaluated lazily, on the step grid from the start of the trajectory
+    (origin, origin + step_length, ..., and end): the columns time, x and speed are evaluated at their first read
+    and kept while the trajectory is one of the CACHED_TRAJECTORIES read last, lane_code and lane_position are
+    located at every read. start_state, end_state, index_at, target_at and lane_id evaluate one sample. The planner
+    reads its leaders and the controller its targets through them unchanged. Shifting, retiming, joining and
+    cutting only touch the segments.
+
+    - starts: start time of every segment, increasing. A segment lasts until the next one starts, the last one until
+      end.
+    - coefficients: x, speed and acceleration at the start of every segment.
+    - held: whether x is held at the start of every segment, the speed still being the one of its coefficients
+      (see constant_acceleration_segments).
+    - origin, end: times of the first and of the last sample.
+    - step_length: time between the samples.
+    - front: distance from the tail of the vehicle to the position located on its lanes (its length + 0.1).
+    """
+    __slots__ = ('vehicle', 'starts', 'coefficients', 'held', 'origin', 'end', 'step_length', 'front', 'space_len',
+                 'geometry', 'cursor', 'samples')
+
+    # {trajectory: None} of the trajectories holding their samples, the one read last at the end. The planner of
+    # AsyncTrajectoryMerge reads them in its worker thread.
+    cached = OrderedDict()
+    cache_lock = threading.Lock()
+
+    def __init__(self, vehicle, starts, coefficients, held, origin, end, step_length, front, space_len, geometry):
+        self.vehicle = vehicle
+        self.starts = np.asarray(starts, dtype=Trajectory.TIME_DTYPE).reshape(-1)
+        self.coefficients = np.asarray(coefficients, dtype=Trajectory.X_DTYPE).reshape(-1, 3)
+        self.held = np.asarray(held, dtype=bool).reshape(-1)
+        self.origin = float(origin)
+        self.end = float(end)
+        self.step_length = step_length
+        self.front = front
+        self.space_len = space_len
+        self.geometry = geometry
+        # Read index of the controller, as Trajectory.cursor.
+        self.cursor = 0
+        # (time, x, speed) once evaluated, see samples_of.
+        self.samples = None
+        # Shared between the trajectories derived from one another.
+        self.starts.flags.writeable = False
+        self.coefficients.flags.writeable = False
+        self.held.flags.writeable = False
+
+    @classmethod
+    def fit(cls, t_trajectory, front, step_length, tolerance=FIT_TOLERANCE, params=None):
+        """
+        Fits a Trajectory, within tolerance (m) of its positions at its samples and within the limits of params
+        (see constant_acceleration_segments).
+        """
+        time, x, speed = t_trajectory.time, t_trajectory.x, t_trajectory.speed
+        segments = constant_acceleration_segments(time, x, speed, tolerance, params)
+        if not segments:
+            segments = [(time[0], x[0], speed[0], 0.0, False)]
+        segments = np.array(segments)
+        return cls(t_trajectory.vehicle, segments[:, 0], segments[:, 1:4], segments[:, 4], time[0], time[-1],
+                   step_length, front, t_trajectory.space_len, t_trajectory.geometry)
+
+    def derive(self, starts, coefficients, held, origin, end):
+        return PiecewiseTrajectory(self.vehicle, starts, coefficients, held, origin, end, self.step_length,
+                                   self.front, self.space_len, self.geometry)
+
+    def __len__(self):
+        return int(round((self.end - self.origin) / self.step_length)) + 1
+
+    def sample_time(self, index):
+        if index == len(self) - 1:
+            return self.end
+        return self.origin + index * self.step_length
+
+    def segment_of(self, times):
+        """
+        Segment of every time. A time within a millionth of a step before the start of a segment is in it: the
+        samples of joined trajectories are on grids accumulated from different times, which drift apart by rounding.
+        """
+        return np.maximum(np.searchsorted(self.starts, times + self.step_length * 1e-6, side='right') - 1, 0)
+
+    def evaluate(self, times):
+        """
+        Positions and speeds at the given times (an increasing array): the times of every segment are found with
+        one binary search per segment start, then all of them are evaluated at once.
+        """
+        starts = self.starts
+        # Number of times in every segment, see segment_of.
+        bounds = np.searchsorted(times, starts[1:] - self.step_length * 1e-6, side='left')
+        segment = np.repeat(np.arange(len(starts)), np.diff(bounds, prepend=0, append=len(times)))
+        tau = times - starts[segment]
+        x0, t_speed, acceleration = (column[segment] for column in self.coefficients.T)
+        speed = t_speed + tau * acceleration
+        x = np.where(self.held[segment], x0, x0 + tau * (t_speed + tau * acceleration / 2))
+        return x, speed
+
+    def at(self, t):
+        """
+        Position and speed at time t.
+        """
+        segment = int(self.segment_of(t))
+        tau = t - float(self.starts[segment])
+        x0, speed, acceleration = self.coefficients[segment].tolist()
+        if self.held[segment]:
+            return x0, speed + tau * acceleration
+        return x0 + tau * (speed + tau * acceleration / 2), speed + tau * acceleration
+
+    def samples_of(self):
+        """
+        Columns time, x and speed, evaluated at the first read and kept while the trajectory is one of the
+        CACHED_TRAJECTORIES read last.
+        """
+        cached = PiecewiseTrajectory.cached
+        with PiecewiseTrajectory.cache_lock:
+            samples = self.samples
+            if samples is not None:
+                cached.move_to_end(self)
+                return samples
+        # Accumulated as the planner steps its times (tools.step_times), for the follow kernel to find the same
+        # leader sample at the same step.
+        times = np.cumsum(np.concatenate(([self.origin], np.full(len(self) - 1, self.step_length))))
+        times[-1] = self.end
+        samples = (times, *self.evaluate(times))
+        for t_column in samples:
+            t_column.flags.writeable = False
+        with PiecewiseTrajectory.cache_lock:
+            self.samples = samples
+            cached[self] = None
+            while len(cached) > CACHED_TRAJECTORIES:
+                cached.popitem(last=False)[0].samples = None
+        return samples
+
+    @property
+    def time(self):
+        return self.samples_of()[0]
+
+    @property
+    def x(self):
+        return self.samples_of()[1]
+
+    @property
+    def speed(self):
+        return self.samples_of()[2]
+
+    def start_state(self):
+        """
+        Time, x and speed of the first sample.
+        """
+        return (self.origin, *self.at(self.origin))
+
+    def end_state(self):
+        """
+        Time, x and speed of the last sample.
+        """
+        return (self.end, *self.at(self.end))
+
+    @property
+    def lane_code(self):
+        return self.geometry.locate(self.x + self.front)[0]
+
+    @property
+    def lane_position(self):
+        return self.geometry.locate(self.x + self.front)[1].astype(Trajectory.LANE_POSITION_DTYPE)
+
+    def dense(self):
+        """
+        The samples as a Trajectory.
+        """
+        time, x, speed = self.samples_of()
+        lane_code, lane_position = self.geometry.locate(x + self.front)
+        return Trajectory(self.vehicle, time, x, speed, lane_code, lane_position, self.space_len, self.geometry)
+
+    def first_index(self, t):
+        """
+        Index of the first sample at or after time t, for t up to end.
+        """
+        return min(max(math.ceil((t - self.origin) / self.step_length - 1e-9), 0), len(self) - 1)
+
+    def position_at(self, t, slack):
+        """
+        x at the first sample at or after time t, None after the end or more than slack (s) before the start.
+        """
+        if t > self.end or self.origin > t + slack:
+            return None
+        return self.at(self.sample_time(self.first_index(t)))[0]
+
+    def index_at(self, t):
+        """
+        Index of the first sample at or after time t, None when the trajectory ends before t (see
+        Trajectory.index_at). The samples are on a grid, the index is computed.
+        """
+        if t > self.end:
+            return None
+        self.cursor = self.first_index(t)
+        return self.cursor
+
+    def lane_id(self, index):
+        x, _ = self.at(self.sample_time(index))
+        lane_code, _ = self.geometry.locate(np.array([x + self.front]))
+        return self.geometry.lane_table.ids[lane_code[0]]
+
+    def target_at(self, t, interpolate=False):
+        """
+        Where the vehicle is to be at simulation time t, None when the trajectory ends before t (see
+        Trajectory.target_at). Interpolated, it is evaluated at t itself.
+        """
+        idx = self.index_at(t)
+        if idx is None:
+            return None
+        t_time = t if interpolate and idx > 0 else self.sample_time(idx)
+        x, _ = self.at(t_time)
+        lane_code, lane_position = self.geometry.locate(np.array([x + self.front]))
+        return ControlTarget(t_time, idx, x, self.geometry.lane_table.ids[lane_code[0]], lane_position[0])
+
+    def shift(self, dt):
+        """
+        The trajectory dt seconds later.
+        """
+        return self.derive(self.starts + dt, self.coefficients, self.held, self.origin + dt, self.end + dt)
+
+    def retime(self, end_time):
+        """
+        The trajectory stretched (or compressed) in time to end at end_time, from the same start: time is mapped
+        linearly onto its span, as MergePlanner.modify_trajectory_end_time does, and a segment stays a segment of
+        constant acceleration, its speed scaled by the ratio of the spans and its acceleration by its square.
+
+        Without a span to map, the trajectory is its first sample at end_time == origin, and stays at its first
+        position until end_time when it has a single sample. ValueError when end_time is before its start.
+        """
+        if end_time < self.origin:
+            raise ValueError(f"{self.vehicle}: cannot retime a trajectory starting at {self.origin} to end at "
+                             f"{end_time}")
+        if end_time == self.origin:
+            return self.truncate(self.origin)
+        if self.end == self.origin:
+            x0, _ = self.at(self.origin)
+            return self.derive([self.origin], [[x0, 0.0, 0.0]], [False], self.origin, end_time)
+        scale = (self.end - self.origin) / (end_time - self.origin)
+        coefficients = self.coefficients * np.array([1.0, scale, scale * scale])
+        return self.derive(self.origin + (self.starts - self.origin) / scale, coefficients, self.held, self.origin,
+                           end_time)
+
+    def truncate(self, end_time):
+        """
+        The trajectory up to end_time.
+        """
+        kept = max(int(np.searchsorted(self.starts, end_time, side='left')), 1)
+        return self.derive(self.starts[:kept], self.coefficients[:kept], self.held[:kept], self.origin, end_time)
+
+    def head(self, length):
+        """
+        The first `length` samples of the trajectory (see Trajectory.head).
+        """
+        return self.truncate(self.sample_time(length - 1))
+
+    def cut_after(self, limit):
+        """
+        The trajectory without its samples from the first one beyond position limit, the segment where it passes
+        limit is found from the extremes of the segments. IndexError when it never does, or from its first sample.
+        """
+        ends = np.append(self.starts[1:], self.end) - self.starts
+        x0, speed, acceleration = self.coefficients.T
+        highest = np.maximum(x0, x0 + ends * (speed + ends * acceleration / 2))
+        highest[self.held] = x0[self.held]
+        # A decelerating segment may turn back within it.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            turn = np.where(acceleration < 0, -speed / acceleration, -1.0)
+            peak = x0 - speed * speed / (2 * acceleration)
+        inside = (turn > 0) & (turn < ends) & ~self.held
+        highest[inside] = np.maximum(highest[inside], peak[inside])
+        passing = np.flatnonzero(highest > limit)
+        if not len(passing):
+            raise IndexError(f"{self.vehicle} never passes {limit}")
+        segment = passing[0]
+        x0, speed, acceleration = self.coefficients[segment].tolist()
+        # First root of x0 + speed * tau + acceleration * tau ** 2 / 2 = limit in the segment.
+        if x0 > limit:
+            tau = 0.0
+        elif abs(acceleration) < 1e-12:
+            tau = (limit - x0) / speed
+        else:
+            discriminant = max(speed * speed + 2 * acceleration * (limit - x0), 0.0)
+            tau = (-speed + math.sqrt(discriminant)) / acceleration
+            if not 0.0 <= tau <= ends[segment]:
+                tau = (-speed - math.sqrt(discriminant)) / acceleration
+        crossing = float(self.starts[segment]) + tau
+        length = min(math.floor((crossing - self.origin) / self.step_length + 1e-9) + 1, len(self))
+        if length < 1:
+            raise IndexError(f"{self.vehicle} starts beyond {limit}")
+        return self.head(length)
+
+    def drop_before(self, t):
+        """
+        The trajectory without its segments before the one of its last sample before time t (see
+        Trajectory.drop_before), the trajectory itself when there is none.
+        """
+        idx = max(math.ceil((t - self.origin) / self.step_length - 1e-9) - 1, 0)
+        if idx >= len(self) - 1:
+            idx = len(self) - 1
+        origin = self.sample_time(idx)
+        first = max(int(np.searchsorted(self.starts, origin, side='right')) - 1, 0)
+        if first == 0:
+            return self
+        t_trajectory = self.derive(self.starts[first:].copy(), self.coefficients[first:].copy(),
+                                   self.held[first:].copy(), origin, self.end)
+        t_trajectory.cursor = max(self.cursor - idx, 0)
+        return t_trajectory
+
+    @classmethod
+    def concatenate(cls, trajectory_a, trajectory_b):
+        """
+        trajectory_a until trajectory_b starts, then trajectory_b, on the sample grid of trajectory_a.
+        """
+        origin = trajectory_b.origin
+        kept = max(int(np.searchsorted(trajectory_a.starts, origin, side='left')), 1)
+        first = max(int(np.searchsorted(trajectory_b.starts, origin, side='right')) - 1, 0)
+        starts_b = trajectory_b.starts[first:].copy()
+        coefficients_b = trajectory_b.coefficients[first:].copy()
+        held_b = trajectory_b.held[first:]
+        if starts_b[0] < origin:
+            # Restarted at the origin of trajectory_b.
+            x0, speed = trajectory_b.at(origin)
+            starts_b[0] = origin
+            coefficients_b[0, :2] = x0, speed
+        return trajectory_a.derive(np.concatenate((trajectory_a.starts[:kept], starts_b)),
+                                   np.concatenate((trajectory_a.coefficients[:kept], coefficients_b)),
+                                   np.concatenate((trajectory_a.held[:kept], held_b)), trajectory_a.origin,
+                                   trajectory_b.end)
+
+    def nbytes(self):
+        samples = 0 if self.samples is None else sum(t_column.nbytes for t_column in self.samples)
+        return self.starts.nbytes + self.coefficients.nbytes + self.held.nbytes + samples
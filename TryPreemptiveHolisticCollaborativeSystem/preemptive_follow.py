@@ -1,528 +1,441 @@
+import logging
+import math
 import os
-import copy
-import sys
+import queue
 import time
-import traceback
-import traci
+try:
+    import traci
+except ImportError:
+    # Only TrajectoryMerge (the TraCI adapter) needs traci, MergePlanner runs without SUMO.
+    traci = None
 import numpy as np
 from scipy.interpolate import CubicSpline
-from tools import scale_series
+from tools import scale_series, earliest_feasible, free_flow_profile, step_times
+from follow_kernel import follow_profile
+from trajectory import LaneTable, Trajectory
+from piecewise import PiecewiseTrajectory
+from geometry import RouteGeometry, merge_offsets
+from network import load_route_geometry
+from occupancy import OccupancyIndex
+from arrivals import Arrival, VehicleParams
+from profiling import PlannerProfile, timed
+from validation import ValidationReport, check_trajectory
 import threading
 
-
-def analyze_array(arr):
-    if len(arr) < 2:
-        return False, None, None, arr[0] if len(arr) > 0 else None, arr[0] if len(arr) > 0 else None
-    diffs = np.diff(arr)
-    is_strictly_increasing = np.all(diffs > 0)
-    max_diff = np.max(diffs)
-    min_diff = np.min(diffs)
-    if min_diff <= 0:
-        print("error")
-        t_idx = np.where(diffs < 0)[0][0]
-        print(t_idx)
-    return is_strictly_increasing, max_diff, min_diff, np.min(arr), np.max(arr)
-
-
-class TrajectoryMerge:
-    def __init__(self, add_len=40):
+# Progress messages of the planner are DEBUG, inconsistencies it recovers from WARNING, failed plans ERROR. The
+# arguments are only formatted when the level is enabled.
+logger = logging.getLogger(__name__)
+
+
+class MergePlanner:
+    """
+    Merge scheduler working on plain data: the vehicles arrive as Arrival events carrying their VehicleParams, the
+    routes are given as lanes_info, so it runs (and can replay a recorded arrival stream) without SUMO.
+    TrajectoryMerge feeds it from a running simulation through TraCI.
+    """
+    def __init__(self, add_len=40, step_length=0.01, evict=True, time_warp='linear', representation='dense'):
+        # Release the vehicles that have left, and the parts of the lists and trajectories that can no longer be used,
+        # before every arrival (see evict). Without it scheduled_trajectories keeps every trajectory of the run.
+        self.evict_exited = evict
+        # Interpolation of modify_trajectory_end_time: 'linear' (np.interp over the samples) or 'spline' (a
+        # CubicSpline fitted to the whole trajectory at every call, as planned before).
+        self.time_warp = time_warp
+        # Storage of the scheduled trajectories: 'dense' (Trajectory, a sample per step) or 'piecewise'
+        # (PiecewiseTrajectory, segments of constant acceleration fitted to the planned samples, evaluated when read).
+        # The trajectories are composed from samples either way.
+        self.representation = representation
         # Scheduled merging trajectories for the vehicles in the system.
         # Trajectories of the vehicles in the system.
         self.scheduled_trajectories = {}
-        self.check_new_vehicle_lock = threading.Lock()
+        # Lane IDs of all the trajectories are stored as codes into this table.
+        self.lane_table = LaneTable()
+        self.add_len = add_len
+        # Time step of the trajectories (s): the step length of the simulation, or a coarser planning resolution the
+        # controller interpolates between (Trajectory.target_at).
+        self.step_length = step_length
+        # {vehicle_id: VehicleParams}
+        self.vehicle_params = {}
         #  Before the offset, the vehilces are in mainline or ramp line. After it, the vehicle are in merged lanes.
-        self.m_offset = 1022.56 - add_len
-        self.r_offset = 1001.47 - add_len
+        # add_len before the start of the merged lanes (see merge_offsets), set once both routes are known.
+        self.m_offset = None
+        self.r_offset = None
         # {"vehicle": vehicle_id, "enter_time": time} The vehicle_id and its corresponding time entering the list.
         # mainline list, ramp list and merged list.
         self.m_list, self.r_list, self.merge_list = [], [], []
         self.m_lanes_info = None
         self.r_lanes_info = None
-        self.run = True
-        # self.check_trajectories()
+        self.m_geometry = None
+        self.r_geometry = None
+        # {'vehicle', 'enter_time', 'followers', 'recomposed', 'elapsed'} of every merge_into call.
+        self.insertion_costs = []
+        # Latency histograms of the planning phases, see profiling.py.
+        self.profile = PlannerProfile()
+        # Space–time index of scheduled_trajectories, set once both routes are known.
+        self.occupancy = None
+        # Vehicles whose trajectories were scheduled by the current arrival and not checked yet.
+        self.unverified = set()
+        # Violations found by verify_plans.
+        self.validation = ValidationReport()
+
+    def route_geometry(self, t_vehicle):
+        if t_vehicle[0] == 'm':
+            return self.m_geometry
+        return self.r_geometry
 
-    def close(self):
-        self.run = False
-        time.sleep(2)
-
-    def check_trajectories(self):
-        def analyze_array(arr):
-            if len(arr) < 2:
-                return False, None, None, arr[0] if len(arr) > 0 else None, arr[0] if len(arr) > 0 else None
-            diffs = np.diff(arr)
-            is_strictly_increasing = np.all(diffs > 0)
-            max_diff = np.max(diffs)
-            min_diff = np.min(diffs)
-            if min_diff <= 0:
-                print("error")
-                t_idx = np.where(diffs < 0)[0][0]
-                print(t_idx)
-            return is_strictly_increasing, max_diff, min_diff, np.min(arr), np.max(arr)
-
-        def res_to_str(in_res):
-            return f"strictly increasing: {str(in_res[0])}, max_diff: {in_res[1]:.3f}, min_diff: {in_res[2]:.3f}, min: {in_res[3]:.3f} max: {in_res[4]:.3f}"
-
-        def checking():
-            i = 0
-            while True:
-                i += 1
-                try:
-                    if i % 100 == 0:
-                        print("\n ==>")
-                        print(
-                            f"Current Time: {traci.simulation.getTime()} len(m_list)={len(self.m_list)}, len(r_list)={len(self.r_list)}, len(merge_list)={len(self.merge_list)})")
-                        for t_traj in self.scheduled_trajectories.values():
-                            t_vehicle = t_traj['vehicle']
-                            time_res = analyze_array(t_traj['trajectory']['time'])
-                            x_res = analyze_array(t_traj['trajectory']['x'])
-                            print(f"Vehicle: {t_vehicle}, time: {res_to_str(time_res)}, x: {res_to_str(x_res)}")
-                except Exception as e:
-                    print(f"error: {repr(e)}")
-                if not self.run:
-                    return
-                time.sleep(0.1)
-
-        thread = threading.Thread(target=checking, args=())
-        thread.start()
-        print('Started trajectory checking ... ')
-
-    def obtain_lanes_info(self, t_vehicle):
-        current_lane = traci.vehicle.getLaneID(t_vehicle)
-        route_id = traci.vehicle.getRouteID(t_vehicle)
-        route_edges = traci.route.getEdges(route_id)
-        lanes_to_end = [current_lane]
-        current_edge = traci.lane.getEdgeID(current_lane)
-        lane = traci.vehicle.getLaneID(t_vehicle)
-        allowed_speed = traci.lane.getMaxSpeed(lane)
-        lanes_info = [{'lane_id': lane, 'length': traci.lane.getLength(lane), 'maxSpeed': allowed_speed}]
-        for next_edge in route_edges[route_edges.index(current_edge) + 1:]:
-            finished = False  # Whether finding lanes to this next edge is finished.
-            while not finished:
-                links = traci.lane.getLinks(current_lane)
-                for link in links:
-                    if traci.lane.getEdgeID(link[0]) == next_edge:
-                        if link[4] not in lanes_to_end:
-                            lanes_to_end.append(link[4])
-                            lanes_info.append({'lane_id': link[4], 'length': traci.lane.getLength(link[4]),
-                                               'maxSpeed': traci.lane.getMaxSpeed(link[4])})
-                            current_lane = link[4]
-                        if link[0] not in lanes_to_end:
-                            lanes_to_end.append(link[0])
-                            lanes_info.append({'lane_id': link[0], 'length': traci.lane.getLength(link[0]),
-                                               'maxSpeed': traci.lane.getMaxSpeed(link[0])})
-                            current_lane = link[0]
-                        finished = True
-                        break
-        return lanes_info
+    def set_lanes_info(self, route, lanes_info):
+        """
+        Sets the lane chain of the main road (route 'm') or the ramp (route 'r') route. Once both are set, the merge
+        offsets are derived from them.
+        """
+        if route == 'm':
+            self.m_lanes_info = lanes_info
+            self.m_geometry = RouteGeometry(lanes_info, self.lane_table)
+        else:
+            self.r_lanes_info = lanes_info
+            self.r_geometry = RouteGeometry(lanes_info, self.lane_table)
+        if self.m_geometry is not None and self.r_geometry is not None:
+            m_merge, r_merge = merge_offsets(self.m_geometry, self.r_geometry)
+            self.m_offset = m_merge - self.add_len
+            self.r_offset = r_merge - self.add_len
+            self.occupancy = OccupancyIndex({'m': self.m_geometry, 'r': self.r_geometry}, {'m': m_merge, 'r': r_merge},
+                                            self.step_length, cache_steps=self.representation == 'dense')
+
+    def schedule(self, t_vehicle, t_trajectory):
+        """
+        Sets the trajectory of a vehicle and indexes it. It is checked against the other plans by verify_plans
+        once the arrival that scheduled it is planned.
+        """
+        if self.representation == 'piecewise':
+            t_trajectory = self.piecewise(t_trajectory)
+        self.scheduled_trajectories[t_vehicle] = t_trajectory
+        with self.profile.timer('occupancy'):
+            self.occupancy.add(t_vehicle, t_vehicle[0], t_trajectory)
+        self.unverified.add(t_vehicle)
+
+    def piecewise(self, t_trajectory):
+        """
+        A trajectory as a PiecewiseTrajectory, fitted when it is a Trajectory.
+        """
+        if isinstance(t_trajectory, PiecewiseTrajectory):
+            return t_trajectory
+        with self.profile.timer('fit_piecewise'):
+            params = self.vehicle_params[t_trajectory.vehicle]
+            return PiecewiseTrajectory.fit(t_trajectory, params.length + 0.1, self.step_length, params=params)
 
+    def verify_plans(self):
+        """
+        Checks the trajectories scheduled by the current arrival, once, before the controller gets them: against the
+        limits of their vehicles (validation.check_trajectory) and against all the scheduled ones (OccupancyIndex
+        .conflicts). The violations are collected in `validation`, a plan is kept anyway: there is no other.
+
+        Returns:
+        - [(vehicle, other vehicle, first time of the conflict, largest overlap), ...].
+        """
+        found = []
+        checked = set()
+        with self.profile.timer('verify_plans'):
+            for t_vehicle in sorted(self.unverified):
+                t_trajectory = self.scheduled_trajectories.get(t_vehicle)
+                if t_trajectory is None:
+                    continue
+                self.validation.plan()
+                for name, (value, t_time) in check_trajectory(t_trajectory, self.vehicle_params[t_vehicle]).items():
+                    logger.debug("%s: %s check failed at %.2f s (%.3f)", t_vehicle, name, t_time, value)
+                    self.validation.violation(name, t_vehicle, value, t_time)
+                for other, t_time, overlap in self.occupancy.conflicts(t_vehicle, t_vehicle[0], t_trajectory,
+                                                                       exclude=checked):
+                    logger.warning("%s: plan conflicts with %s at %.2f s, %.2f m overlap", t_vehicle, other,
+                                   t_time, overlap)
+                    self.profile.count('plan_conflicts')
+                    self.validation.violation('gap', t_vehicle, overlap, t_time)
+                    found.append((t_vehicle, other, t_time, overlap))
+                checked.add(t_vehicle)
+        self.unverified.clear()
+        return found
+
+    def road_leader(self, t_vehicle, road_list, from_time, start_x):
+        """
+        Leader of a vehicle entering its road: the nearest vehicle ahead of it on the road at its arrival
+        (OccupancyIndex.vehicles_ahead). The last vehicle that entered the road leads while it waits to be inserted
+        (its trajectory starts later, or it is still in the depart zone, where the vehicles are in the order they
+        entered), and when there is no vehicle ahead.
+        """
+        last = road_list[-1]
+        if last['vehicle'] not in self.occupancy:
+            # Its plan failed, compose_follow_trajectory reports it.
+            return last
+        ahead = self.occupancy.vehicles_ahead(t_vehicle[0], start_x, from_time)
+        if not ahead or ahead[0][0] == last['vehicle']:
+            return last
+        last_x = self.occupancy.position_at(last['vehicle'], from_time)
+        if last_x is None:
+            waiting = self.scheduled_trajectories[last['vehicle']].start_state()[0] >= from_time
+        else:
+            waiting = last_x <= self.occupancy.depart_zone
+        if waiting:
+            return last
+        logger.debug("%s: follows %s, not %s", t_vehicle, ahead[0][0], last['vehicle'])
+        return {'vehicle': ahead[0][0]}
+
+    @timed('compose_mono')
     def compse_mono_trajectory(self, t_vehicle, from_time=None, additional_space=3.0, init_speed=None, start_x=None,
                                end=None):
         # (t_vehicle, from_time=time, init_speed=speed, start=x, end=self.m_offset)
-        if init_speed is None:
-            speed = traci.vehicle.getSpeed(t_vehicle)
-        else:
-            speed = init_speed
-        if start_x is None:
-            x = traci.vehicle.getDistance(t_vehicle)
-        else:
-            x = start_x
+        speed = init_speed
+        x = start_x
         if end is None:
             return None
-        if from_time is None:
-            current_time = traci.simulation.getTime()
-        else:
-            current_time = from_time
-        if start_x < 0.25:
-            start_x = 0.35
-        time_step_length = traci.simulation.getDeltaT()
-        deceleration = traci.vehicle.getDecel(t_vehicle)
-        max_acceleration = traci.vehicle.getAccel(t_vehicle)
-        max_vehicle_speed = traci.vehicle.getMaxSpeed(t_vehicle)
-        vehicle_length = traci.vehicle.getLength(t_vehicle)
-        speed = traci.vehicle.getSpeed(t_vehicle)
-        x = traci.vehicle.getDistance(t_vehicle)
+        current_time = from_time
+        time_step_length = self.step_length
+        params = self.vehicle_params[t_vehicle]
+        deceleration = params.decel
+        max_acceleration = params.accel
+        max_vehicle_speed = params.max_speed
+        vehicle_length = params.length
         t_speed = speed
         tail_x = x
-        if t_vehicle[0] == 'm':
-            lanes_info = self.m_lanes_info
-        else:
-            lanes_info = self.r_lanes_info
-
-
-        def total_length_of_lanes():
-            sum = 0.0
-            for t_lane_info in lanes_info:
-                sum += t_lane_info['length']
-            return sum
-
-        def get_lane(t_x):
-            if t_x < 0:
-                return None
-            cumulated_x = 0
-            my_t = None
-            for t_lane in lanes_info:
-                my_t = t_lane
-                if cumulated_x <= t_x < cumulated_x + t_lane['length']:
-                    return t_lane, t_x - cumulated_x
-                cumulated_x += t_lane['length']
-            return my_t, t_x - cumulated_x
+        geometry = self.route_geometry(t_vehicle)
 
         t_time = current_time
         t_acceleration = min(max_acceleration, deceleration)
         # trajectory = [{'time': t_time, 'tail_x': tail_x, 'head_x': head_x}]
-        time_list = [t_time]
-        x_list = [tail_x]
-        speed_list = [t_speed]
-        lane_list = []
-        lane_position = []
-        total_len = min(total_length_of_lanes(), end)
-        while tail_x < total_len:
-            if t_speed < min(max_vehicle_speed, get_lane(tail_x)[0]['maxSpeed']) * 0.995:
-                t_speed += time_step_length * t_acceleration * 0.4
-            if t_speed > min(max_vehicle_speed, get_lane(tail_x)[0]['maxSpeed']) * 1.005:
-                t_speed -= time_step_length * t_acceleration * 0.4
-            t_len = t_speed * time_step_length
-            t_time += time_step_length
-            tail_x += t_len
-            time_list.append(t_time)
-            x_list.append(tail_x)
-            speed_list.append(t_speed)
-        x_dis = scale_series(np.array(time_list), np.array(x_list), x_list[0], x_list[-1], end)
+        total_len = min(geometry.total_length, end)
+        time_steps, x_steps, speed_steps = free_flow_profile(geometry, t_time, tail_x, t_speed, max_vehicle_speed,
+                                                             t_acceleration, time_step_length, total_len)
+        time_list = np.concatenate(([t_time], time_steps))
+        x_list = np.concatenate(([tail_x], x_steps))
+        speed_list = np.concatenate(([t_speed], speed_steps))
+        with self.profile.timer('scale_series'):
+            x_dis = scale_series(time_list, x_list, x_list[0], x_list[-1], end)
         x_dis[x_dis < 0.0] = 0.0
-        np.round(x_dis, decimals=3)
-
-        for t_x in list(x_dis):
-            cal_position = t_x + vehicle_length + 0.1
-            lane_list.append(get_lane(cal_position)[0]['lane_id'])
-            lane_position.append(get_lane(cal_position)[1])
-        return {'vehicle': t_vehicle,
-                'trajectory': {'time': np.array(time_list), 'x': x_dis, 'speed': np.array(speed_list),
-                               'lane_list': lane_list, 'lane_position': lane_position},
-                'space_len': vehicle_length + additional_space,
-                'lanes_info': lanes_info}
-
-    def complete_mono_trajectory(self, in_trajectory, additional_space=3.0):
-        t_vehicle = in_trajectory['vehicle']
-        time_step_length = traci.simulation.getDeltaT()
-        deceleration = traci.vehicle.getDecel(t_vehicle)
-        max_acceleration = traci.vehicle.getAccel(t_vehicle)
-        max_vehicle_speed = traci.vehicle.getMaxSpeed(t_vehicle)
-        vehicle_length = traci.vehicle.getLength(t_vehicle)
-        if t_vehicle[0] == 'm':
-            lanes_info = self.m_lanes_info
-        else:
-            lanes_info = self.r_lanes_info
 
-        def total_length_of_lanes():
-            sum = 0.0
-            for t_lane_info in lanes_info:
-                sum += t_lane_info['length']
-            return sum
+        lane_list, lane_position = geometry.locate(x_dis + vehicle_length + 0.1)
+        return Trajectory(t_vehicle, time_list, x_dis, speed_list, lane_list, lane_position,
+                          vehicle_length + additional_space, geometry)
 
-        def get_lane(t_x):
-            if t_x < 0:
-                return None
-            cumulated_x = 0
-            my_t = None
-            for t_lane in lanes_info:
-                my_t = t_lane
-                if cumulated_x <= t_x < cumulated_x + t_lane['length']:
-                    return t_lane, t_x - cumulated_x
-                cumulated_x += t_lane['length']
-            return my_t, t_x - cumulated_x
-
-        t_time = in_trajectory['trajectory']['time'][-1]
-        t_speed = in_trajectory['trajectory']['speed'][-1]
-        tail_x = in_trajectory['trajectory']['x'][-1]
+    @timed('complete_mono')
+    def complete_mono_trajectory(self, in_trajectory, additional_space=3.0):
+        t_vehicle = in_trajectory.vehicle
+        time_step_length = self.step_length
+        params = self.vehicle_params[t_vehicle]
+        deceleration = params.decel
+        max_acceleration = params.accel
+        max_vehicle_speed = params.max_speed
+        vehicle_length = params.length
+        geometry = self.route_geometry(t_vehicle)
+
+        t_time, tail_x, t_speed = in_trajectory.end_state()
         t_acceleration = min(max_acceleration, deceleration)
         # trajectory = [{'time': t_time, 'tail_x': tail_x, 'head_x': head_x}]
-        time_list = []
-        x_list = []
-        speed_list = []
-        lane_list = []
-        lane_position = []
-        total_len = total_length_of_lanes()
-        while tail_x < total_len:
-            if t_speed < min(max_vehicle_speed, get_lane(tail_x)[0]['maxSpeed']) * 0.995:
-                t_speed += time_step_length * t_acceleration * 0.4
-            if t_speed > min(max_vehicle_speed, get_lane(tail_x)[0]['maxSpeed']) * 1.005:
-                t_speed -= time_step_length * t_acceleration * 0.4
-            t_len = t_speed * time_step_length
-            t_time += time_step_length
-            tail_x += t_len
-            time_list.append(t_time)
-            x_list.append(tail_x)
-            speed_list.append(t_speed)
-        for t_x in x_list:
-            cal_position = t_x + vehicle_length + 0.1
-            lane_list.append(get_lane(cal_position)[0]['lane_id'])
-            lane_position.append(get_lane(cal_position)[1])
-
-        t_diff = in_trajectory['trajectory']['time'][-1] - [time_list[0]]
-        x_diff = in_trajectory['trajectory']['x'][-1] - [x_list[0]]
+        time_list, x_list, speed_list = free_flow_profile(geometry, t_time, tail_x, t_speed, max_vehicle_speed,
+                                                          t_acceleration, time_step_length, geometry.total_length)
+        t_diff = t_time - [time_list[0]]
+        x_diff = tail_x - [x_list[0]]
         if t_diff > 0:
-            print("error")
-        print(f"t_diff: {t_diff}, x_diff: {x_diff}")
-        time_vals = np.concatenate((in_trajectory['trajectory']['time'], np.array(time_list)))
-        x_vals = np.concatenate((in_trajectory['trajectory']['x'], np.array(x_list)))
-        speed_vals = np.concatenate((in_trajectory['trajectory']['speed'], np.array(speed_list)))
-        lane_vals = [*in_trajectory['trajectory']['lane_list'], *lane_list]
-        lane_position_vals = [*in_trajectory['trajectory']['lane_position'], *lane_position]
-        return {'vehicle': t_vehicle,
-                'trajectory': {'time': time_vals, 'x': x_vals, 'speed': speed_vals,
-                               'lane_list': lane_vals, 'lane_position': lane_position_vals},
-                'space_len': vehicle_length + additional_space,
-                'lanes_info': lanes_info}
+            logger.warning("%s: free driving starts before the end of its trajectory", t_vehicle)
+        logger.debug("t_diff: %s, x_diff: %s", t_diff, x_diff)
+        lane_list, lane_position = geometry.locate(x_list + vehicle_length + 0.1)
+        return Trajectory.concatenate((in_trajectory.time, time_list), (in_trajectory.x, x_list),
+                                      (in_trajectory.speed, speed_list), (in_trajectory.lane_code, lane_list),
+                                      (in_trajectory.lane_position, lane_position), t_vehicle,
+                                      vehicle_length + additional_space, geometry)
 
     # compose_follow_trajectory(t_vehicle, from_time=time, init_speed=speed, start_x=x,
     #                                                              end=self.m_offset,leader=t_leader)
+    @timed('compose_follow')
     def compose_follow_trajectory(self, in_vehicle, from_time=None, init_speed=None, start_x=None, end=None,
                                   leader=None, additional_space=3.0):
         t_vehicle = in_vehicle
-        time_step_length = traci.simulation.getDeltaT()
-        deceleration = traci.vehicle.getDecel(t_vehicle)
-        max_acceleration = traci.vehicle.getAccel(t_vehicle)
-        max_vehicle_speed = traci.vehicle.getMaxSpeed(t_vehicle)
-        vehicle_length = traci.vehicle.getLength(t_vehicle)
-        if t_vehicle[0] == 'm':
-            lanes_info = self.m_lanes_info
-        else:
-            lanes_info = self.r_lanes_info
-
-        def total_length_of_lanes():
-            sum = 0.0
-            for t_lane_info in lanes_info:
-                sum += t_lane_info['length']
-            return sum
+        time_step_length = self.step_length
+        params = self.vehicle_params[t_vehicle]
+        deceleration = params.decel
+        max_acceleration = params.accel
+        max_vehicle_speed = params.max_speed
+        vehicle_length = params.length
+        geometry = self.route_geometry(t_vehicle)
 
-        def get_lane(t_x):
-            if t_x < 0:
-                return None
-            cumulated_x = 0
-            my_t = None
-            for t_lane in lanes_info:
-                my_t = t_lane
-                if cumulated_x <= t_x < cumulated_x + t_lane['length']:
-                    return t_lane, t_x - cumulated_x
-                cumulated_x += t_lane['length']
-            return my_t, t_x - cumulated_x
-
-        t_time = from_time
-        t_speed = init_speed
         if start_x < 0.25:
             start_x = 0.35
-        tail_x = start_x
-        leader_trajectory = copy.deepcopy(
-            self.scheduled_trajectories[leader['vehicle']]['trajectory'])  # 'time' and 'x'
+        leader_trajectory = self.scheduled_trajectories[leader['vehicle']]
         # fix the difference of two types of offsets.
-        if leader['vehicle'][0] == 'm':
-            leader_trajectory['x'] -= self.m_offset
-        else:
-            leader_trajectory['x'] -= self.r_offset
-        if in_vehicle[0] == 'm':
-            leader_trajectory['x'] += self.m_offset
-        else:
-            leader_trajectory['x'] += self.r_offset
-
-        def get_leader_x(in_time):
-            try:
-                idx = np.where(leader_trajectory['time'] >= in_time)[0][0]
-                if not idx.any():
-                    return None
-                else:
-                    t_res_x = leader_trajectory['x'][idx]
-                    t_res_speed = leader_trajectory['speed'][idx]
-                    return t_res_x, t_res_speed
-            except Exception as e:
-                return None
-
+        lead_shift = self.m_offset if leader['vehicle'][0] == 'm' else self.r_offset
+        follower_shift = self.m_offset if in_vehicle[0] == 'm' else self.r_offset
         space_len = vehicle_length + additional_space
         t_acceleration = min(max_acceleration, deceleration)
-        # trajectory = [{'time': t_time, 'tail_x': tail_x, 'head_x': head_x}]
-        time_list = []
-        x_list = []
-        speed_list = []
-        lane_list = []
-        lane_position = []
-        try:
-            if end is None:
-                total_len = total_length_of_lanes()
-            else:
-                total_len = min(total_length_of_lanes(), end)
-        except Exception as e:
-            print(f"error {repr(e)}")
-        strict_follow = False
-        strict_gap = space_len
-        while tail_x < total_len:
-            try:
-                try:
-                    t_lead_x_sample, t_lead_speed_sample = get_leader_x(t_time)
-                    leader_res = True
-                except Exception as e:
-                    leader_res = False
-                if t_speed < min(max_vehicle_speed, get_lane(tail_x)[0]['maxSpeed']) * 0.995:
-                    if not leader_res:
-                        t_speed += time_step_length * t_acceleration * 0.4
-                    if leader_res and tail_x + space_len + 5 < t_lead_x_sample and t_speed < t_lead_speed_sample:
-                        t_speed += time_step_length * t_acceleration * 0.4
-
-                if t_speed > min(max_vehicle_speed, get_lane(tail_x)[0]['maxSpeed']) * 1.005:
-                    t_speed -= time_step_length * t_acceleration * 0.4
-                if leader_res and tail_x + space_len > t_lead_x_sample:
-                    t_speed -= time_step_length * t_acceleration * 1.9
-                if leader_res and (t_speed > t_lead_speed_sample) and tail_x + space_len > t_lead_x_sample:
-                    t_speed -= time_step_length * t_acceleration * 3.2
-
-                if leader_res and tail_x + space_len > t_lead_x_sample - 2.0 and tail_x < space_len + 8:
-                    t_speed = t_lead_speed_sample
-                if leader_res and (t_speed > t_lead_speed_sample) and tail_x < 8:
-                    t_speed = t_lead_speed_sample
-                if leader_res and (t_speed > t_lead_speed_sample + 0.2) and tail_x + space_len > t_lead_x_sample - 5.0:
-                    t_speed = t_lead_speed_sample
-                if leader_res and (
-                        t_speed > t_lead_speed_sample) and tail_x + space_len > t_lead_x_sample - 8.0 and tail_x > 5.2 and start_x < 1.0:
-                    t_speed -= time_step_length * t_acceleration * 3.2
-                if leader_res and tail_x + space_len > t_lead_x_sample and tail_x < space_len + 8:
-                    t_speed = 0.0
-                if leader_res and tail_x + space_len > t_lead_x_sample - 4.0 and tail_x > 5.2 and start_x < 1.0:
-                    if t_vehicle == 'm.0':
-                        print(f"speed: {t_speed}, {t_lead_speed_sample}, distance between: {t_lead_x_sample - tail_x}")
-                    t_speed -= time_step_length * t_acceleration * 5.2
-
-                if t_speed < 0.0:
-                    t_speed = 0.0
-
-                if leader_res and -2.0 < tail_x + space_len - t_lead_x_sample < 0 and abs(
-                        t_speed - t_lead_speed_sample) < 0.5:
-                    strict_follow = True
-                    strict_gap = t_lead_x_sample - tail_x
-                if leader_res and strict_follow:
-                    n_tail_x = t_lead_x_sample - strict_gap
-                    t_speed = t_lead_speed_sample
-                    tail_x = n_tail_x
-                else:
-                    t_len = t_speed * time_step_length
-                    tail_x += t_len
-            except Exception as e:
-                print(f"follow error: {repr(e)}.")
-
-            try:
-                if leader_res and tail_x + space_len > t_lead_x_sample + 0.3 and tail_x > 5.2 and start_x < 1.0:
-                    print(" Too near! Failed to follow")
-                    return None
-                if leader_res and tail_x + space_len > t_lead_x_sample + 0.3 and tail_x > 5.2:
-                    print(" Too near! Failed to follow")
-                    return None
-                t_time += time_step_length
-                time_list.append(t_time)
-                x_list.append(tail_x)
-                speed_list.append(t_speed)
-            except Exception as e:
-                print(f"follow error: {repr(e)}.")
+        if end is None:
+            total_len = geometry.total_length
+        else:
+            total_len = min(geometry.total_length, end)
+        time_list, x_list, speed_list, followed = follow_profile(
+            leader_trajectory.time, leader_trajectory.x, leader_trajectory.speed, lead_shift, follower_shift,
+            from_time, start_x, init_speed, max_vehicle_speed, t_acceleration, time_step_length, space_len, total_len,
+            geometry)
+        if not followed:
+            logger.debug(" Too near! Failed to follow")
+            self.profile.count('follow_failures')
+            return None
         if end is None:
             try:
                 end = x_list[-1]
             except IndexError as e:
-                print(f"Index error: {repr(e)}.")
-        x_dis = scale_series(np.array(time_list), np.array(x_list), x_list[0], x_list[-1], end)
+                logger.warning("Index error: %r.", e)
+        with self.profile.timer('scale_series'):
+            x_dis = scale_series(time_list, x_list, x_list[0], x_list[-1], end)
         x_dis[x_dis < 0.0] = 0.0
-        np.round(x_dis, decimals=3)
-        for t_x in list(x_dis):
-            cal_position = t_x + vehicle_length + 0.1
-            lane_list.append(get_lane(cal_position)[0]['lane_id'])
-            lane_position.append(get_lane(cal_position)[1])
-        return {'vehicle': t_vehicle,
-                'trajectory': {'time': np.array(time_list), 'x': x_dis, 'speed': np.array(speed_list),
-                               'lane_list': lane_list, 'lane_position': lane_position},
-                'space_len': vehicle_length + additional_space,
-                'lanes_info': lanes_info}
+        lane_list, lane_position = geometry.locate(x_dis + vehicle_length + 0.1)
+        return Trajectory(t_vehicle, time_list, x_dis, speed_list, lane_list, lane_position,
+                          vehicle_length + additional_space, geometry)
 
+    @timed('modify_trajectory_end_time')
     def modify_trajectory_end_time(self, origin_trajectory, end_time):
-        time_step_length = traci.simulation.getDeltaT()
-        t_vehicle = origin_trajectory['vehicle']
-        vehicle_length = traci.vehicle.getLength(t_vehicle)
-        lanes_info = origin_trajectory['lanes_info']
-        space_len = origin_trajectory['space_len']
-        o_x = origin_trajectory['trajectory']['x']
-        o_time = origin_trajectory['trajectory']['time']
-        t_time = o_time[0]
-        from_time = t_time
-        time_list = []
-        while t_time <= end_time:
-            time_list.append(t_time)
-            t_time += time_step_length
-
-        n_time = np.array(time_list)
-        cal_time = from_time + (n_time - from_time) * (np.max(o_time) - np.min(o_time)) / (
-                np.max(n_time) - np.min(n_time))
-
-        cs = CubicSpline(o_time, o_x)
-        cal_x = cs(cal_time)
-
-        # print(f"end error: {cal_x[-1] - o_x[-1]}, start error: {cal_x[0]-o_x[0]}")
-
-        def get_lane(t_x):
-            if t_x < 0:
-                return None
-            cumulated_x = 0
-            my_t = None
-            for t_lane in lanes_info:
-                my_t = t_lane
-                if cumulated_x <= t_x < cumulated_x + t_lane['length']:
-                    return t_lane, t_x - cumulated_x
-                cumulated_x += t_lane['length']
-            return my_t, t_x - cumulated_x
-
-        lane_list = []
-        lane_position = []
-        speed_list = []
-        t_i = 0
-        for t_x in list(cal_x):
-            if t_i == 0:
-                speed_list.append(origin_trajectory['trajectory']['speed'][0])
-            else:
-                t_speed = (cal_x[t_i] - cal_x[t_i - 1]) / time_step_length
-                speed_list.append(t_speed)
-            t_i += 1
-            cal_position = t_x + vehicle_length + 0.1
-            lane_list.append(get_lane(cal_position)[0]['lane_id'])
-            lane_position.append(get_lane(cal_position)[1])
-
-        # if n_time[-1] != end_time:
-        #     real_end = n_time[-1]
-        #     print(f"real end: {real_end}, required end: {end_time}")
-        return {'vehicle': t_vehicle,
-                'trajectory': {'time': n_time, 'x': cal_x, 'speed': np.array(speed_list),
-                               'lane_list': lane_list, 'lane_position': lane_position},
-                'space_len': space_len,
-                'lanes_info': lanes_info}
+        """
+        Stretches (or compresses) a trajectory in time to end at end_time: the steps from its start to end_time are
+        mapped linearly onto its time span and the positions are read there, the path driven stays the same.
+
+        The trajectories are sampled every step, so interpolating between the samples stays within a fraction of a
+        millimetre of the CubicSpline through them (see bench_time_warp), at a fraction of its cost. A
+        PiecewiseTrajectory is retimed segment by segment.
+        """
+        time_step_length = self.step_length
+        if isinstance(origin_trajectory, PiecewiseTrajectory):
+            from_time = origin_trajectory.origin
+            return origin_trajectory.retime(from_time + math.floor((end_time - from_time) / time_step_length + 1e-9) *
+                                            time_step_length)
+        t_vehicle = origin_trajectory.vehicle
+        vehicle_length = self.vehicle_params[t_vehicle].length
+        geometry = origin_trajectory.geometry
+        space_len = origin_trajectory.space_len
+        o_x = origin_trajectory.x
+        o_time = origin_trajectory.time
+        from_time = o_time[0]
+        n_time = step_times(from_time, end_time, time_step_length)
+        # The times are increasing: the span is last - first.
+        cal_time = from_time + (n_time - from_time) * (o_time[-1] - from_time) / (n_time[-1] - n_time[0])
+
+        if self.time_warp == 'spline':
+            cal_x = CubicSpline(o_time, o_x)(cal_time)
+        else:
+            cal_x = np.interp(cal_time, o_time, o_x)
+
+        speed_list = np.empty(len(cal_x))
+        speed_list[0] = origin_trajectory.speed[0]
+        np.divide(np.diff(cal_x), time_step_length, out=speed_list[1:])
+        lane_list, lane_position = geometry.locate(cal_x + vehicle_length + 0.1)
+        return Trajectory(t_vehicle, n_time, cal_x, speed_list, lane_list, lane_position, space_len, geometry)
 
     def concatenate_trajectories(self, trajectory_a, trajectory_b):
-        if trajectory_b['vehicle'] != trajectory_b['vehicle']:
-            print('Wrong!')
-        if trajectory_a['trajectory']['time'][-1] > trajectory_b['trajectory']['time'][0]:
-            print(
-                f"Concatenate trajectory error=> time_a: {trajectory_a['trajectory']['time'][-1]}  time_b: {trajectory_b['trajectory']['time'][0]}")
-        t_time_res = np.concatenate((trajectory_a['trajectory']['time'], trajectory_b['trajectory']['time']))
-        t_x_res = np.concatenate((trajectory_a['trajectory']['x'], trajectory_b['trajectory']['x']))
-        t_speed_res = np.concatenate((trajectory_a['trajectory']['speed'], trajectory_b['trajectory']['speed']))
-        t_lane_list = [*trajectory_a['trajectory']['lane_list'], *trajectory_b['trajectory']['lane_list']]
-        t_lane_position = [*trajectory_a['trajectory']['lane_position'], *trajectory_b['trajectory']['lane_position']]
-        t_res = copy.deepcopy(trajectory_a)
-        t_res['trajectory'] = {'time': t_time_res, 'x': t_x_res, 'speed': t_speed_res,
-                               'lane_list': t_lane_list, 'lane_position': t_lane_position}
-        for t_lane in t_res['trajectory']['lane_list']:
-            if t_lane not in [item['lane_id'] for item in t_res['lanes_info']]:
-                print("Wrong")
+        if trajectory_a.vehicle != trajectory_b.vehicle:
+            logger.warning("concatenating trajectories of different vehicles")
+        end_a, start_b = trajectory_a.end_state()[0], trajectory_b.start_state()[0]
+        if end_a > start_b:
+            logger.warning("Concatenate trajectory error=> time_a: %s  time_b: %s", end_a, start_b)
+        if isinstance(trajectory_a, PiecewiseTrajectory) or isinstance(trajectory_b, PiecewiseTrajectory):
+            return PiecewiseTrajectory.concatenate(self.piecewise(trajectory_a), self.piecewise(trajectory_b))
+        t_res = Trajectory.concatenate((trajectory_a.time, trajectory_b.time), (trajectory_a.x, trajectory_b.x),
+                                       (trajectory_a.speed, trajectory_b.speed),
+                                       (trajectory_a.lane_code, trajectory_b.lane_code),
+                                       (trajectory_a.lane_position, trajectory_b.lane_position),
+                                       trajectory_a.vehicle, trajectory_a.space_len, trajectory_a.geometry)
+        if not np.isin(t_res.lane_code, t_res.geometry.codes).all():
+            logger.warning("%s: lanes off the route", t_res.vehicle)
         return t_res
 
+    def cut_trajectory(self, t_trajectory, offset):
+        """
+        The trajectory without its samples from the first one beyond offset, IndexError when it never passes offset.
+        """
+        if isinstance(t_trajectory, PiecewiseTrajectory):
+            return t_trajectory.cut_after(offset)
+        t_len = np.flatnonzero(t_trajectory.x > offset)[0]
+        return t_trajectory.head(t_len)
+
+    @timed('merge_slot')
+    def solve_merge_slot(self, t_vehicle, in_trajectory, enter_time, start_x, leader, additional_space=3.0):
+        """
+        Finds the earliest time, on the simulation step grid, at or after enter_time at which the vehicle can enter
+        the merged lanes behind leader.
+
+        A probe stretches in_trajectory to end at the entry time and composes the follow trajectory from there,
+        the entry is feasible when compose_follow_trajectory does not reject it. enter_time is probed first, it
+        mostly is feasible. Otherwise the entries at which the leader is not far enough ahead yet are skipped
+        without a probe (clear_entry), and as a later entry only leaves more gap to the leader, the earliest feasible
+        one from there is searched with earliest_feasible, by steps doubled from one simulation step and bisected:
+        the first entry after the skipped ones mostly is feasible, so a merge takes one or two probes after the
+        first.
+
+        Parameters:
+        - t_vehicle: ID of the vehicle.
+        - in_trajectory: Trajectory of the vehicle up to the merged lanes.
+        - enter_time: earliest entry time to try.
+        - start_x: x of the vehicle where it enters the merged lanes.
+        - leader: merge_list item of the vehicle to follow.
+        - additional_space: space kept to the leader in addition to the vehicle length.
+
+        Returns:
+        - in_trajectory stretched to the entry time and the follow trajectory from it.
+        """
+        time_step_length = self.step_length
+        probes = []
+
+        def probe(k):
+            probes.append(k)
+            t_enter = enter_time + k * time_step_length
+            t_trajectory = self.modify_trajectory_end_time(in_trajectory, t_enter)
+            f_trajectory = self.compose_follow_trajectory(t_vehicle, from_time=t_enter,
+                                                          init_speed=t_trajectory.end_state()[2], start_x=start_x,
+                                                          leader=leader, additional_space=additional_space)
+            if f_trajectory is None:
+                return None
+            return t_trajectory, f_trajectory
+
+        result = probe(0)
+        if result is None:
+            first = max(self.clear_entry(t_vehicle, enter_time, start_x, leader, additional_space), 1)
+            _, result = earliest_feasible(lambda k: probe(first + k), 1, grow=True)
+        # Every probe after the first is a retry at a later entry time.
+        self.profile.sample('merge_probes', len(probes))
+        return result
+
+    def clear_entry(self, t_vehicle, enter_time, start_x, leader, additional_space=3.0):
+        """
+        Smallest k for which the entry at enter_time + k steps may be feasible, checked on the leader trajectory
+        only, for all the entries at once: the follow kernel rejects an entry at its first step when the tail plus
+        the space of the vehicle is more than 0.3 m past the leader, and the tail does not move back, so an entry
+        at which start_x is already that near is infeasible. The tail moves on in that step: the first feasible
+        entry is mostly the next one.
+
+        Returns:
+        - k, 0 when the entry at enter_time is clear.
+        """
+        leader_trajectory = self.scheduled_trajectories[leader['vehicle']]
+        lead_time = leader_trajectory.time
+        if start_x < 0.25:
+            start_x = 0.35
+        if start_x <= 5.2 or enter_time >= lead_time[-1]:
+            return 0
+        lead_shift = self.m_offset if leader['vehicle'][0] == 'm' else self.r_offset
+        follower_shift = self.m_offset if t_vehicle[0] == 'm' else self.r_offset
+        space_len = self.vehicle_params[t_vehicle].length + additional_space
+        # Entry times as the probes compute them, up to the end of the leader trajectory (no leader, no rejection).
+        steps = np.arange(int((lead_time[-1] - enter_time) / self.step_length) + 2)
+        entries = enter_time + steps * self.step_length
+        idx = np.searchsorted(lead_time, entries, side='left')
+        # The leader sample of a step is the first one at or after it, none at its first sample or after its end.
+        has_leader = (idx > 0) & (idx < len(lead_time))
+        lead_x = leader_trajectory.x[np.minimum(idx, len(lead_time) - 1)] - lead_shift + follower_shift
+        rejected = has_leader & (start_x + space_len > lead_x + 0.3)
+        clear = np.flatnonzero(~rejected)
+        return int(clear[0]) if len(clear) else len(steps)
+
+    @timed('merge_into')
     def merge_into(self, in_vehicle, in_trajectory, additional_space=3.0):
         """
         (t_vehicle, m_trajectory)
         """
+        start = time.perf_counter()
         need_recompose_trajectory = []
-        try_enter_time = in_trajectory['trajectory']['time'][-1]
-        space_len = in_trajectory['space_len']
+        try_enter_time = in_trajectory.end_state()[0]
+        space_len = in_trajectory.space_len
         for i in range(len(self.merge_list)):
             t_item = self.merge_list[i]
             if t_item['time'] > try_enter_time:
@@ -531,199 +444,475 @@ class TrajectoryMerge:
                 break
             i += 1
         if len(self.merge_list) == 0:
-            self.merge_list.append({'vehicle': in_vehicle, 'time': in_trajectory['trajectory']['time'][-1],
-                                    'speed': in_trajectory['trajectory']['speed'][-1],
-                                    'x': in_trajectory['trajectory']['x'][-1]})
+            self.merge_list.append(self.merge_item(in_vehicle, in_trajectory))
             t_complete_trajectory = self.complete_mono_trajectory(in_trajectory)
-            self.scheduled_trajectories[in_vehicle] = t_complete_trajectory
+            self.schedule(in_vehicle, t_complete_trajectory)
         else:
             leader = self.merge_list[-1]
-            leader_id = leader['vehicle']
-            if leader_id[0] == 'm':
-                t_offset = self.m_offset
-            else:
-                t_offset = self.r_offset
-            idx = np.where(self.scheduled_trajectories[leader_id]['trajectory']['x'] - t_offset - space_len > 0)[0][0]
-            may_enter_time = self.scheduled_trajectories[leader_id]['trajectory']['time'][idx]
+            may_enter_time = self.entry_time(leader['vehicle'], space_len)
             # in_vehicle, from_time=None, init_speed=None, start_x=None, end=None,
             #                                   leader=None, additional_space=3.0
-            start_x = in_trajectory['trajectory']['x'][-1]
-            f_trajectory = None
-            t_idx = 0
-            while f_trajectory is None:
-                in_trajectory = self.modify_trajectory_end_time(in_trajectory,
-                                                                max(may_enter_time, try_enter_time) + t_idx * 1.0)
-                continue_speed = in_trajectory['trajectory']['speed'][-1]
-                f_trajectory = self.compose_follow_trajectory(in_vehicle, from_time=max(may_enter_time,
-                                                                                        try_enter_time) + t_idx * 1.0,
-                                                              init_speed=continue_speed, start_x=start_x, leader=leader,
-                                                              additional_space=additional_space)
-                t_idx += 1
+            start_x = in_trajectory.end_state()[1]
+            in_trajectory, f_trajectory = self.solve_merge_slot(in_vehicle, in_trajectory,
+                                                                max(may_enter_time, try_enter_time), start_x, leader,
+                                                                additional_space=additional_space)
             t_trajectory = self.concatenate_trajectories(in_trajectory, f_trajectory)
-            self.merge_list.append({'vehicle': in_vehicle, 'time': in_trajectory['trajectory']['time'][-1],
-                                    'speed': in_trajectory['trajectory']['speed'][-1],
-                                    'x': in_trajectory['trajectory']['x'][-1]})
-            self.scheduled_trajectories[in_vehicle] = t_trajectory
-
-        # Handle all the trajectories on need_recompose_trajectory
-        i = 0
-        for t_recompose in need_recompose_trajectory:
+            self.merge_list.append(self.merge_item(in_vehicle, in_trajectory))
+            self.schedule(in_vehicle, t_trajectory)
+
+        # Handle the trajectories on need_recompose_trajectory. Only the followers that conflict with the changed
+        # trajectories are recomposed, a follower whose slot still has enough gap keeps its trajectory.
+        changed = {in_vehicle}
+        recomposed = 0
+        cascade_start = time.perf_counter()
+        for i, t_recompose in enumerate(need_recompose_trajectory):
             t_vehicle = t_recompose['vehicle']
             if t_vehicle[0] == 'm':
                 my_offset = self.m_offset
             else:
                 my_offset = self.r_offset
             leader = self.merge_list[-1]
-            leader_id = leader['vehicle']
-            if leader_id[0] == 'm':
-                t_offset = self.m_offset
-            else:
-                t_offset = self.r_offset
-            idx = np.where(self.scheduled_trajectories[leader_id]['trajectory']['x'] - t_offset - space_len > 0)[0][0]
-            may_enter_time = self.scheduled_trajectories[leader_id]['trajectory']['time'][idx]
-
-            def cut_trajectory(t_trajectory, in_offset):
-                # cut off the end part of in_trajectory from offset.
-                t_len = np.where(t_trajectory['trajectory']['x'] > in_offset)[0][0]
-                """
-                'trajectory': {'time': cal_time, 'x': cal_x, 'speed': np.array(speed_list),
-                               'lane_list': lane_list, 'lane_position': lane_position},
-                """
-                t_trajectory['trajectory']['time'] = t_trajectory['trajectory']['time'][:t_len]
-                t_trajectory['trajectory']['x'] = t_trajectory['trajectory']['x'][:t_len]
-                t_trajectory['trajectory']['speed'] = t_trajectory['trajectory']['speed'][:t_len]
-                return t_trajectory
+            may_enter_time = self.entry_time(leader['vehicle'], space_len)
 
             origin_trajectory = self.scheduled_trajectories[t_vehicle]
+            if not self.slot_conflict(t_recompose, may_enter_time, changed):
+                self.merge_list.append(t_recompose)
+                continue
+
             try:
-                n_trajectory = cut_trajectory(origin_trajectory, my_offset)
-            except Exception as e:
-                # print(f"error: {repr(e)}")
+                n_trajectory = self.cut_trajectory(origin_trajectory, my_offset)
+            except IndexError:
+                # The trajectory never passes the offset.
                 n_trajectory = origin_trajectory
 
             if i == 0:
+                # Only the first follower, right behind the inserted vehicle, keeps its path and is delayed to the
+                # new entry time. A follower behind a kept one is composed behind it as the others are.
                 t_trajectory = self.modify_trajectory_end_time(n_trajectory, may_enter_time)
-                t_end_ts = t_trajectory['trajectory']['time'][-1]
-                print(f"{t_end_ts}-{may_enter_time}")
+                t_end_ts = t_trajectory.end_state()[0]
+                logger.debug("%s-%s", t_end_ts, may_enter_time)
             else:
                 """
                 compose_follow_trajectory(self, in_vehicle, from_time=None, init_speed=None, start_x=None, end=None,
                                   leader=None, additional_space=3.0):
                 """
-                f_time = origin_trajectory['trajectory']['time'][0]
-                i_speed = origin_trajectory['trajectory']['speed'][0]
-                s_x = origin_trajectory['trajectory']['x'][0]
+                f_time, s_x, i_speed = origin_trajectory.start_state()
                 t_end = my_offset
-                my_leader = need_recompose_trajectory[i - 1]
+                my_leader = leader
 
                 t_trajectory = self.compose_follow_trajectory(t_vehicle, from_time=f_time, init_speed=i_speed,
                                                               start_x=s_x, end=t_end, leader=my_leader)
 
-            f_i_x = t_trajectory['trajectory']['x'][-1]
-            f_i_time = t_trajectory['trajectory']['time'][-1]
-
-            f_trajectory = None
-            t_idx = 0
-            while f_trajectory is None:
-                t_trajectory = self.modify_trajectory_end_time(t_trajectory,
-                                                               f_i_time + t_idx * 1.0)
-                continue_speed = t_trajectory['trajectory']['speed'][-1]
-                f_trajectory = self.compose_follow_trajectory(t_vehicle, from_time=f_i_time + t_idx * 1.0,
-                                                              init_speed=continue_speed, start_x=f_i_x, leader=leader,
-                                                              additional_space=additional_space)
-                t_idx += 1
+            f_i_time, f_i_x, _ = t_trajectory.end_state()
+
+            t_trajectory, f_trajectory = self.solve_merge_slot(t_vehicle, t_trajectory, f_i_time, f_i_x, leader,
+                                                               additional_space=additional_space)
 
-            self.merge_list.append({'vehicle': t_vehicle, 'time': t_trajectory['trajectory']['time'][-1],
-                                    'speed': t_trajectory['trajectory']['speed'][-1],
-                                    'x': t_trajectory['trajectory']['x'][-1]})
+            self.merge_list.append(self.merge_item(t_vehicle, t_trajectory))
             con_trajectory = self.concatenate_trajectories(t_trajectory, f_trajectory)
-            self.scheduled_trajectories[t_vehicle] = con_trajectory
-            i += 1
+            self.schedule(t_vehicle, con_trajectory)
+            changed.add(t_vehicle)
+            recomposed += 1
+
+        if need_recompose_trajectory:
+            self.profile.record('recompose_cascade', time.perf_counter() - cascade_start)
+        self.profile.sample('recompose_depth', recomposed)
+        t_cost = {'vehicle': in_vehicle, 'enter_time': try_enter_time, 'followers': len(need_recompose_trajectory),
+                  'recomposed': recomposed, 'elapsed': time.perf_counter() - start}
+        self.insertion_costs.append(t_cost)
+        logger.debug("Merge %s: %d followers, %d recomposed, %.1f ms", in_vehicle, t_cost['followers'], recomposed,
+                     t_cost['elapsed'] * 1000)
+
+    def merge_item(self, t_vehicle, t_trajectory):
+        """
+        merge_list item of a vehicle entering the merged lanes at the end of t_trajectory.
+        """
+        t_time, t_x, t_speed = t_trajectory.end_state()
+        return {'vehicle': t_vehicle, 'time': t_time, 'speed': t_speed, 'x': t_x}
 
-    def check_new_vehicle(self, t_vehicle, additional_space=3.0):
-        print(f"New vehilce: {t_vehicle} entered:")
-        self.check_new_vehicle_lock.acquire()
-        try:
-            current_lane = traci.vehicle.getLaneID(t_vehicle)
-            if current_lane == '':
-                try:
-                    traci.vehicle.remove(t_vehicle)
-                except Exception as e:
-                    print(f"vehicle: {t_vehicle} remove failed. message: {repr(e)}")
-                    self.check_new_vehicle_lock.release()
-                    return
-        except Exception as e:
-            print(f"vehicle: {t_vehicle} obtain information failed. message: {repr(e)}")
-            self.check_new_vehicle_lock.release()
-            return
+    def entry_time(self, leader_id, space_len):
+        """
+        Earliest time a follower with space_len may enter the merged lanes behind leader_id: the first sample at
+        which the leader is more than space_len beyond the merge offset of its route.
+        """
+        leader_trajectory = self.scheduled_trajectories[leader_id]
+        t_offset = self.m_offset if leader_id[0] == 'm' else self.r_offset
+        # One temporary, shifted in place, instead of one per operation.
+        t_gap = np.subtract(leader_trajectory.x, t_offset)
+        np.subtract(t_gap, space_len, out=t_gap)
+        idx = np.flatnonzero(t_gap > 0)[0]
+        return leader_trajectory.time[idx]
+
+    def slot_conflict(self, item, may_enter_time, changed):
+        """
+        Whether a follower on merge_list has to be recomposed after the trajectories of the vehicles in `changed`
+        were modified.
 
-        print(f"Check new: {t_vehicle} Computing Trajectory<<<<<<")
-        vehicle_length = traci.vehicle.getLength(t_vehicle)
-        space_len = vehicle_length + additional_space
-        time = traci.simulation.getTime()
-        speed = traci.vehicle.getSpeed(t_vehicle)
-        x = traci.vehicle.getDistance(t_vehicle)
+        Parameters:
+        - item: merge_list item of the follower.
+        - may_enter_time: earliest time the follower may enter the merged lanes behind merge_list[-1].
+        - changed: IDs of the vehicles whose trajectories were modified by the current insertion.
+
+        Returns:
+        - True when the follower enters before may_enter_time, comes closer than its space to merge_list[-1] on
+          the merged lanes, or comes closer than its space to the changed vehicle ahead of it on its own road.
+        """
+        t_vehicle = item['vehicle']
+        if item['time'] < may_enter_time:
+            return True
+        t_trajectory = self.scheduled_trajectories[t_vehicle]
+        leader_id = self.merge_list[-1]['vehicle']
+        if leader_id in changed and self.gap_conflict(t_trajectory, leader_id, merged_only=True):
+            return True
+        # The vehicle ahead on the same road, its trajectory may have been delayed by this insertion.
+        for t_item in reversed(self.merge_list):
+            if t_item['vehicle'][0] == t_vehicle[0]:
+                if t_item['vehicle'] in changed:
+                    return self.gap_conflict(t_trajectory, t_item['vehicle'], merged_only=False)
+                break
+        return False
+
+    def gap_conflict(self, t_trajectory, leader_id, merged_only=True):
+        """
+        Checks a scheduled trajectory against the one of its leader with the same rule compose_follow_trajectory
+        uses to reject a trajectory: the tail plus space_len passing the leader sample by more than 0.3 m.
+
+        Parameters:
+        - t_trajectory: Trajectory of the follower.
+        - leader_id: ID of the leader in scheduled_trajectories.
+        - merged_only: only check the samples on the merged lanes (the leader is on the other road before them).
+
+        Returns:
+        - True if the follower comes too near to the leader.
+        """
+        leader_trajectory = self.scheduled_trajectories[leader_id]
+        my_offset = self.m_offset if t_trajectory.vehicle[0] == 'm' else self.r_offset
+        leader_offset = self.m_offset if leader_id[0] == 'm' else self.r_offset
+        tail_x = t_trajectory.x
+        # The leader sample of a time is the first one at or after it, none before the leader starts or after it ends.
+        idx = np.searchsorted(leader_trajectory.time, t_trajectory.time, side='left')
+        mask = (idx > 0) & (idx < len(leader_trajectory.time)) & (tail_x > 5.2)
+        if merged_only:
+            mask &= tail_x >= my_offset
+        if not mask.any():
+            return False
+        lead_x = leader_trajectory.x[idx[mask]] - leader_offset + my_offset
+        return bool(np.any(tail_x[mask] + t_trajectory.space_len > lead_x + 0.3))
+
+    def has_left(self, t_vehicle, t_trajectory, current_time):
+        """
+        Whether the vehicle has left the system. Without a simulation, when its trajectory has ended.
+        """
+        return t_trajectory.end_state()[0] < current_time
+
+    @timed('evict')
+    def evict(self, current_time):
+        """
+        Releases what no plan made at or after current_time can use.
+
+        The arrivals come in time order, so a new vehicle tries to enter the merged lanes at or after current_time:
+        every merge_list item merged by then stays before the cut in merge_into, and only the last of them can be the
+        leader. Of m_list and r_list only the last item is ever followed. The trajectories of the remaining items
+        are kept whole (they are read, and may be recomposed, from their start). The other trajectories are only
+        needed while their vehicles drive: they are dropped when the vehicle has left (has_left), their samples
+        before current_time are released.
+        """
+        for t_idx in range(len(self.merge_list) - 1, -1, -1):
+            if self.merge_list[t_idx]['time'] <= current_time:
+                del self.merge_list[:t_idx]
+                break
+        del self.m_list[:-1]
+        del self.r_list[:-1]
+        referenced = {t_item['vehicle'] for t_item in self.merge_list + self.m_list + self.r_list}
+        for t_vehicle, t_trajectory in list(self.scheduled_trajectories.items()):
+            if t_vehicle in referenced:
+                continue
+            if self.has_left(t_vehicle, t_trajectory, current_time):
+                del self.scheduled_trajectories[t_vehicle]
+                del self.vehicle_params[t_vehicle]
+                self.occupancy.remove(t_vehicle)
+            else:
+                t_dropped = t_trajectory.drop_before(current_time)
+                if t_dropped is not t_trajectory:
+                    self.scheduled_trajectories[t_vehicle] = t_dropped
+                    self.occupancy.replace(t_vehicle, t_dropped)
+
+    @timed('plan_arrival')
+    def plan_arrival(self, arrival, additional_space=3.0):
+        """
+        Schedules the trajectory of a vehicle entering the system. The lanes_info of its route must have been set.
+
+        Parameters:
+        - arrival: Arrival of the vehicle.
+        - additional_space: space kept to the leader in addition to the vehicle length.
+        """
+        if self.evict_exited:
+            self.evict(arrival.time)
+        t_vehicle = arrival.vehicle
+        self.vehicle_params[t_vehicle] = arrival.params
+        time = arrival.time
+        speed = arrival.speed
+        x = arrival.x
         if t_vehicle[0] == 'm':
-            if self.m_lanes_info is None:
-                self.m_lanes_info = self.obtain_lanes_info(t_vehicle)
             if len(self.m_list) == 0:
                 m_trajectory = self.compse_mono_trajectory(t_vehicle, from_time=time, init_speed=speed, start_x=x,
                                                            end=self.m_offset, additional_space=additional_space)
             else:
-                t_leader = self.m_list[-1]
+                t_leader = self.road_leader(t_vehicle, self.m_list, time, x)
                 m_trajectory = self.compose_follow_trajectory(t_vehicle, from_time=time, init_speed=speed, start_x=x,
                                                               end=self.m_offset, leader=t_leader,
                                                               additional_space=additional_space)
                 if m_trajectory is None:
-                    print('failed.')
+                    logger.error("%s: failed to follow %s", t_vehicle, t_leader['vehicle'])
             self.m_list.append({'vehicle': t_vehicle, 'time': time, 'speed': speed, 'x': x})
             # try entering the merged lanes with already composed trajectory.
             if len(self.merge_list) == 0:
-                self.merge_list.append({'vehicle': t_vehicle, 'time': m_trajectory['trajectory']['time'][-1],
-                                        'speed': m_trajectory['trajectory']['speed'][-1],
-                                        'x': m_trajectory['trajectory']['x'][-1]})
+                self.merge_list.append(self.merge_item(t_vehicle, m_trajectory))
                 t_complete_trajectory = self.complete_mono_trajectory(m_trajectory, additional_space=additional_space)
-                self.scheduled_trajectories[t_vehicle] = t_complete_trajectory
+                self.schedule(t_vehicle, t_complete_trajectory)
             else:
                 try:
                     self.merge_into(t_vehicle, m_trajectory, additional_space=additional_space)
                 except Exception as e:
-                    print(f"m vehicle merge failed: {repr(e)}")
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    traceback.print_tb(exc_traceback)
+                    logger.error("m vehicle merge failed: %r", e, exc_info=True)
 
         if t_vehicle[0] == 'r':
-            if self.r_lanes_info is None:
-                self.r_lanes_info = self.obtain_lanes_info(t_vehicle)
             if len(self.r_list) == 0:
                 r_trajectory = self.compse_mono_trajectory(t_vehicle, from_time=time, init_speed=speed, start_x=x,
                                                            end=self.r_offset, additional_space=additional_space)
             else:
-                t_leader = self.r_list[-1]
+                t_leader = self.road_leader(t_vehicle, self.r_list, time, x)
                 try:
                     r_trajectory = self.compose_follow_trajectory(t_vehicle, from_time=time, init_speed=speed,
                                                                   start_x=x,
                                                                   end=self.r_offset, leader=t_leader,
                                                                   additional_space=additional_space)
                     if r_trajectory is None:
-                        print('Failed')
+                        logger.error("%s: failed to follow %s", t_vehicle, t_leader['vehicle'])
                 except Exception as e:
-                    print(f"compose follow trajectory for {t_vehicle} failed with error {repr(e)}.")
+                    logger.error("compose follow trajectory for %s failed with error %r.", t_vehicle, e)
             self.r_list.append({'vehicle': t_vehicle, 'time': time, 'speed': speed, 'x': x})
             if len(self.merge_list) == 0:
-                self.merge_list.append({'vehicle': t_vehicle, 'time': r_trajectory['trajectory']['time'][-1],
-                                        'speed': r_trajectory['trajectory']['speed'][-1],
-                                        'x': r_trajectory['trajectory']['x'][-1]})
+                self.merge_list.append(self.merge_item(t_vehicle, r_trajectory))
                 t_complete_trajectory = self.complete_mono_trajectory(r_trajectory, additional_space=additional_space)
-                self.scheduled_trajectories[t_vehicle] = t_complete_trajectory
+                self.schedule(t_vehicle, t_complete_trajectory)
             else:
                 try:
                     self.merge_into(t_vehicle, r_trajectory, additional_space=additional_space)
                 except Exception as e:
-                    print(f"r vehicle merge failed: {repr(e)}")
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    traceback.print_tb(exc_traceback)
+                    logger.error("r vehicle merge failed: %r", e, exc_info=True)
+        self.verify_plans()
 
-        self.check_new_vehicle_lock.release()
-        print(f"!!!! <====================scheduled trajectory for vehicle:{t_vehicle}.================>!!!")
+    def provisional_trajectory(self, arrival, additional_space=3.0):
+        """
+        Free driving trajectory from the arrival to the end of the route, ignoring all the other vehicles. Drives a
+        vehicle while its planned trajectory is not there yet (AsyncTrajectoryMerge). Reads only the route geometry,
+        so it can be built while the planner works.
+        """
+        params = arrival.params
+        geometry = self.route_geometry(arrival.vehicle)
+        time_steps, x_steps, speed_steps = free_flow_profile(geometry, arrival.time, arrival.x, arrival.speed,
+                                                             params.max_speed, min(params.accel, params.decel),
+                                                             self.step_length, geometry.total_length)
+        x_list = np.concatenate(([arrival.x], x_steps))
+        lane_list, lane_position = geometry.locate(x_list + params.length + 0.1)
+        return Trajectory(arrival.vehicle, np.concatenate(([arrival.time], time_steps)), x_list,
+                          np.concatenate(([arrival.speed], speed_steps)), lane_list, lane_position,
+                          params.length + additional_space, geometry)
+
+    def replay(self, arrivals, additional_space=3.0):
+        """
+        Plans a recorded arrival stream (see arrivals.load_arrivals) and returns the scheduled trajectories (all of
+        them only when the planner was created with evict=False).
+        """
+        for arrival in arrivals:
+            self.plan_arrival(arrival, additional_space=additional_space)
+        return self.scheduled_trajectories
+
+
+class TrajectoryMerge(MergePlanner):
+    """
+    MergePlanner driven by a running SUMO: new vehicles and their parameters are read through TraCI, the lanes of the
+    routes from the network file (network.load_route_geometry). The arrivals are kept in `arrivals` so the run can be
+    replayed offline.
+
+    - net_file: network of the simulation.
+    - routes: {'m': (from_edge, to_edge), 'r': (from_edge, to_edge)} of the main road and the ramp vehicles.
+    - resolution: time step of the trajectories (s), the step length of the simulation by default.
+    - representation: storage of the scheduled trajectories, see MergePlanner.
+    """
+    def __init__(self, net_file, routes, add_len=40, resolution=None, representation='dense'):
+        super().__init__(add_len=add_len, step_length=resolution or traci.simulation.getDeltaT(),
+                         representation=representation)
+        with self.profile.timer('route_geometry'):
+            network = load_route_geometry(net_file, routes)
+        self.set_lanes_info('m', network['lanes_info']['m'])
+        self.set_lanes_info('r', network['lanes_info']['r'])
+        self.check_new_vehicle_lock = threading.Lock()
+        self.arrivals = []
+        # Time (s) from the arrival of every vehicle to its plan being available to the controller.
+        self.latencies = []
+        # Vehicles reported by vehicles_left that still have a trajectory.
+        self.exited = set()
+
+    def close(self):
+        pass
+
+    def vehicles_left(self, vehicles):
+        """
+        Vehicles that have left the simulation, their trajectories are dropped by the next evict that finds them
+        unused.
+        """
+        self.exited = {t_vehicle for t_vehicle in self.exited.union(vehicles)
+                       if t_vehicle in self.scheduled_trajectories}
+
+    def has_left(self, t_vehicle, t_trajectory, current_time):
+        return t_vehicle in self.exited
+
+    def observe_arrival(self, t_vehicle):
+        """
+        Reads the arrival of a new vehicle through TraCI. Returns None (removing the vehicle if it has no lane) when
+        the vehicle cannot be read.
+        """
+        try:
+            current_lane = traci.vehicle.getLaneID(t_vehicle)
+            if current_lane == '':
+                try:
+                    traci.vehicle.remove(t_vehicle)
+                except Exception as e:
+                    logger.warning("vehicle: %s remove failed. message: %r", t_vehicle, e)
+                    return None
+        except Exception as e:
+            logger.warning("vehicle: %s obtain information failed. message: %r", t_vehicle, e)
+            return None
+
+        params = VehicleParams(traci.vehicle.getAccel(t_vehicle), traci.vehicle.getDecel(t_vehicle),
+                               traci.vehicle.getMaxSpeed(t_vehicle), traci.vehicle.getLength(t_vehicle))
+        arrival = Arrival(t_vehicle, traci.simulation.getTime(), traci.vehicle.getSpeed(t_vehicle),
+                          traci.vehicle.getDistance(t_vehicle), params)
+        self.arrivals.append(arrival)
+        return arrival
+
+    def check_new_vehicle(self, t_vehicle, additional_space=3.0):
+        logger.debug("New vehicle: %s entered:", t_vehicle)
+        with self.check_new_vehicle_lock:
+            arrival = self.observe_arrival(t_vehicle)
+            if arrival is None:
+                return
+            logger.debug("Check new: %s Computing Trajectory", t_vehicle)
+            start = time.perf_counter()
+            self.plan_arrival(arrival, additional_space=additional_space)
+            self.latencies.append(time.perf_counter() - start)
+        logger.debug("scheduled trajectory for vehicle: %s", t_vehicle)
         return None
+
+    def collect(self):
+        """
+        Called by the controller once the new and exited vehicles of a step are reported, before it reads the
+        trajectories. The plans are made right away here, see AsyncTrajectoryMerge.
+        """
+        pass
+
+    def trajectory(self, t_vehicle):
+        """
+        Trajectory the controller drives the vehicle along (KeyError when it has none).
+        """
+        return self.scheduled_trajectories[t_vehicle]
+
+    def latency_summary(self):
+        """
+        Percentiles (ms) of the time from the arrival of a vehicle to its plan, as a printable line.
+        """
+        if not self.latencies:
+            return "no arrivals planned"
+        latencies = np.array(self.latencies) * 1e3
+        p50, p95, p99 = np.percentile(latencies, (50, 95, 99))
+        return (f"{len(latencies)} arrivals, p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, "
+                f"max {latencies.max():.1f} ms")
+
+
+class AsyncTrajectoryMerge(TrajectoryMerge):
+    """
+    TrajectoryMerge planning in a worker thread, so a long recompose cascade does not stall the simulation.
+
+    The controller reports the new vehicles (check_new_vehicle, reading their arrival through TraCI) and the exited
+    ones (vehicles_left) as events on a queue, the worker applies them to the planner in order. After every event the
+    worker publishes its trajectories as a new dict, swapped in with one assignment, so the controller never sees a
+    half-made plan (trajectories are never changed once built). collect() waits for the events of the step up to
+    `deadline` seconds of wall time; a vehicle whose plan is not published yet drives on provisional_trajectory
+    until it is.
+
+    - deadline: planning budget per step (s), None to always wait for the plans (the same trajectories as
+      TrajectoryMerge).
+    """
+    def __init__(self, net_file, routes, add_len=40, deadline=0.005, resolution=None, representation='dense'):
+        super().__init__(net_file, routes, add_len=add_len, resolution=resolution, representation=representation)
+        self.deadline = deadline
+        self.events = queue.Queue()
+        self.condition = threading.Condition()
+        self.submitted = 0
+        self.done = 0
+        # Trajectories published by the worker, and the provisional ones of the vehicles not planned yet.
+        self.published = {}
+        self.provisional = {}
+        # Arrivals whose plan was not published by the end of their step.
+        self.late = 0
+        self.worker = threading.Thread(target=self.work, name='planner', daemon=True)
+        self.worker.start()
+
+    def submit(self, event):
+        self.submitted += 1
+        self.events.put(event)
+
+    def work(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            kind, payload, submitted = event
+            try:
+                if kind == 'arrival':
+                    self.plan_arrival(payload)
+                else:
+                    TrajectoryMerge.vehicles_left(self, payload)
+            except Exception as e:
+                logger.error("planner failed on %s %s: %r", kind, payload, e, exc_info=True)
+            self.published = dict(self.scheduled_trajectories)
+            if kind == 'arrival':
+                self.latencies.append(time.perf_counter() - submitted)
+            with self.condition:
+                self.done += 1
+                self.condition.notify_all()
+
+    def check_new_vehicle(self, t_vehicle, additional_space=3.0):
+        arrival = self.observe_arrival(t_vehicle)
+        if arrival is None:
+            return
+        self.provisional[t_vehicle] = self.provisional_trajectory(arrival, additional_space=additional_space)
+        self.submit(('arrival', arrival, time.perf_counter()))
+
+    def vehicles_left(self, vehicles):
+        if vehicles:
+            self.submit(('left', list(vehicles), time.perf_counter()))
+
+    def collect(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.done == self.submitted, timeout=self.deadline)
+        published = self.published
+        for t_vehicle in [t_vehicle for t_vehicle in self.provisional if t_vehicle in published]:
+            del self.provisional[t_vehicle]
+        self.late += len(self.provisional)
+
+    def trajectory(self, t_vehicle):
+        t_trajectory = self.published.get(t_vehicle)
+        if t_trajectory is None:
+            return self.provisional[t_vehicle]
+        return t_trajectory
+
+    def close(self):
+        self.events.put(None)
+        self.worker.join()
+        super().close()
+
+    def latency_summary(self):
+        return f"{super().latency_summary()}, {self.late} vehicle steps on a provisional plan"
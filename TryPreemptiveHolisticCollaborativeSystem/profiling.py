@@ -0,0 +1,148 @@
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+
+class Histogram:
+    """
+    HDR-style histogram of non-negative integers: values below 2 ** precision are counted exactly, larger ones in
+    buckets of 2 ** (precision - 1) per power of two, so every value is known to within 2 ** (1 - precision) of
+    itself (1.6 % with precision 7) over any range, in a few hundred buckets at most.
+
+    - unit: unit of the recorded values, for the export.
+    """
+    __slots__ = ('unit', 'precision', 'half', 'buckets', 'count', 'total', 'min', 'max')
+
+    def __init__(self, unit, precision=7):
+        self.unit = unit
+        self.precision = precision
+        self.half = 1 << (precision - 1)
+        # {bucket index: count}
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        value = max(int(value), 0)
+        shift = max(value.bit_length() - self.precision, 0)
+        index = shift * self.half + (value >> shift)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def bucket_range(self, index):
+        """
+        Lowest and highest value counted in a bucket.
+        """
+        shift = max(index // self.half - 1, 0)
+        low = (index - shift * self.half) << shift
+        return low, low + (1 << shift) - 1
+
+    def percentile(self, p):
+        """
+        Highest value of the bucket holding the p-th percentile (0 <= p <= 100), None when empty.
+        """
+        if self.count == 0:
+            return None
+        rank = max(p / 100.0 * self.count, 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.bucket_range(index)[1], self.max)
+        return self.max
+
+    def to_dict(self, percentiles=(50, 90, 99, 99.9)):
+        return {'unit': self.unit, 'count': self.count, 'min': self.min, 'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'percentiles': {str(p): self.percentile(p) for p in percentiles},
+                'buckets': [[*self.bucket_range(index), self.buckets[index]] for index in sorted(self.buckets)]}
+
+
+class PlannerProfile:
+    """
+    Instrumentation of the planner: a latency histogram (microseconds) per timed phase, a histogram per sampled
+    quantity (e.g. the depth of a recompose cascade) and plain event counters.
+
+    Usage:
+        with profile.timer('merge_into'):
+            ...
+        profile.sample('recompose_depth', recomposed)
+        profile.count('follow_failures')
+        profile.export(path)
+    """
+    def __init__(self):
+        self.timers = {}
+        self.samples = {}
+        self.counters = {}
+
+    def record(self, name, seconds):
+        t_histogram = self.timers.get(name)
+        if t_histogram is None:
+            t_histogram = self.timers[name] = Histogram('us')
+        t_histogram.record(seconds * 1e6)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def sample(self, name, value):
+        t_histogram = self.samples.get(name)
+        if t_histogram is None:
+            t_histogram = self.samples[name] = Histogram('count')
+        t_histogram.record(value)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {'timers': {name: item.to_dict() for name, item in self.timers.items()},
+                'samples': {name: item.to_dict() for name, item in self.samples.items()},
+                'counters': dict(self.counters)}
+
+    def export(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+    def summary(self):
+        """
+        One line per timed phase: calls, total, p50, p99 and max, slowest phase first.
+        """
+        lines = []
+        for name, item in sorted(self.timers.items(), key=lambda entry: -entry[1].total):
+            lines.append(f"{name:>26}: {item.count:7d} calls, {item.total / 1e6:8.3f} s, "
+                         f"p50 {item.percentile(50) / 1e3:8.3f} ms, p99 {item.percentile(99) / 1e3:8.3f} ms, "
+                         f"max {item.max / 1e3:8.3f} ms")
+        for name, item in self.samples.items():
+            lines.append(f"{name:>26}: {item.count:7d} samples, mean {item.total / item.count:.2f}, "
+                         f"p99 {item.percentile(99)}, max {item.max}")
+        for name, value in self.counters.items():
+            lines.append(f"{name:>26}: {value}")
+        return "\n".join(lines)
+
+
+def timed(name):
+    """
+    Decorator timing a method of an object with a `profile` (PlannerProfile) as the phase `name`.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.profile.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
@@ -9,6 +9,11 @@ def scale_series(t, x_original, a, b, b_alter):
     Transforms the given function x(t) to have a new value at t = T while maintaining
     continuity and similarity of first and second derivatives at the boundaries.
 
+    Closed form of scale_series_spline: the smoothing step there only adjusts the cubic and quadratic
+    coefficients of the first spline segment, which vanish at the knots, and the result is only
+    evaluated at the knots t. What remains is an affine map of x_original, so no spline or optimiser
+    is needed.
+
     Parameters:
     - t: A 1D numpy array representing the time values at which the function is evaluated.
          These values are evenly spaced in the interval (0, T).
@@ -23,6 +28,24 @@ def scale_series(t, x_original, a, b, b_alter):
     - A 1D numpy array representing the transformed values of the function x(t).
     """
 
+    def scale_function(x_original, a, b, b_alter):
+        """
+        Scales the original function values to fit the new end value b_alter.
+        """
+        scale_factor = (b_alter - a) / (b - a)
+        return a + (x_original - a) * scale_factor
+
+    x_scaled = scale_function(np.asarray(x_original, dtype=np.float64), a, b, b_alter)
+    t_res = x_scaled - np.min(x_scaled) + a
+    return scale_function(t_res, a, np.max(t_res), b_alter)
+
+
+def scale_series_spline(t, x_original, a, b, b_alter):
+    """
+    Reference implementation of scale_series, fitting the boundary derivatives with CubicSpline and
+    scipy.optimize.minimize. Kept to check and benchmark the closed form against.
+    """
+
     def scale_function(x_original, a, b, b_alter):
         """
         Scales the original function values to fit the new end value b_alter.
@@ -90,6 +113,131 @@ def scale_series(t, x_original, a, b, b_alter):
     return t_res
 
 
+def earliest_feasible(probe, bracket, grow=False):
+    """
+    Finds the smallest integer k >= 0 for which probe(k) is feasible, assuming that every k after a feasible one is
+    feasible as well.
+
+    k = 0 is tried first. When it fails, a feasible k is bracketed in steps of `bracket` and the bracket is then
+    bisected, so the search takes about k / bracket + log2(bracket) probes instead of k. With grow, the step is
+    doubled after every infeasible probe (an exponential search): about 2 * log2(k) probes, and only a few when k
+    is small.
+
+    Parameters:
+    - probe: function of k returning a result, None when k is not feasible.
+    - bracket: step of the bracketing search (>= 1), the first one with grow.
+    - grow: double the step after every infeasible probe.
+
+    Returns:
+    - k and probe(k).
+    """
+    result = probe(0)
+    if result is not None:
+        return 0, result
+    # probe(lo) failed, probe(hi) succeeded.
+    lo, hi = 0, bracket
+    result = probe(hi)
+    while result is None:
+        if grow:
+            bracket *= 2
+        lo, hi = hi, hi + bracket
+        result = probe(hi)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        t_result = probe(mid)
+        if t_result is None:
+            lo = mid
+        else:
+            hi, result = mid, t_result
+    return hi, result
+
+
+def step_times(from_time, end_time, time_step_length):
+    """
+    Times from_time, from_time + time_step_length, ... up to end_time, accumulated step by step (np.cumsum adds in
+    the same order as repeated +=, so the values are the same as stepping in a loop).
+    """
+    n = max(int((end_time - from_time) / time_step_length) + 2, 0)
+    times = np.cumsum(np.concatenate(([from_time], np.full(n, time_step_length))))
+    return times[times <= end_time]
+
+
+def free_flow_profile(geometry, from_time, start_x, init_speed, max_vehicle_speed, acceleration, time_step_length,
+                      total_len):
+    """
+    Free driving profile of a vehicle from (from_time, start_x, init_speed) until its tail reaches total_len.
+
+    Every step the speed is raised (lowered) by time_step_length * acceleration * 0.4 while it is below 99.5 %
+    (above 100.5 %) of the speed limit of the lane at the tail, then the vehicle advances by speed * time_step_length.
+    Within a lane the speed is a linear ramp followed by a constant, so the steps are generated per lane and ramp
+    with np.cumsum, which adds in the same order as stepping one by one and gives the same floating point values.
+
+    Parameters:
+    - geometry: RouteGeometry of the route.
+    - from_time, start_x, init_speed: state of the vehicle at the start.
+    - max_vehicle_speed, acceleration: parameters of the vehicle.
+    - time_step_length: time step (s).
+    - total_len: distance at which the profile ends.
+
+    Returns:
+    - time, x and speed arrays of the steps after the start (the start is not included).
+    """
+    dv = time_step_length * acceleration * 0.4
+    n_lanes = len(geometry.max_speeds)
+    times, xs, speeds = [], [], []
+    t_time, tail_x, t_speed = from_time, start_x, init_speed
+    while tail_x < total_len:
+        idx = geometry.lane_index(tail_x)
+        limit = min(max_vehicle_speed, geometry.max_speed_at(tail_x))
+        low, high = limit * 0.995, limit * 1.005
+        boundary = total_len if idx + 1 >= n_lanes else min(total_len, geometry.offsets[idx + 1])
+        if t_speed < low:
+            step, n_ramp = dv, int((low - t_speed) / dv) + 2
+        elif t_speed > high:
+            step, n_ramp = -dv, int((t_speed - high) / dv) + 2
+        else:
+            step, n_ramp = 0.0, 4096
+        if step != 0.0 and dv >= high - low:
+            # One step could jump over the band around the limit, follow the rules step by step.
+            if t_speed < low:
+                t_speed += dv
+            if t_speed > high:
+                t_speed -= dv
+            t_time += time_step_length
+            tail_x += t_speed * time_step_length
+            times.append(np.array([t_time]))
+            xs.append(np.array([tail_x]))
+            speeds.append(np.array([t_speed]))
+            continue
+        slowest = min(t_speed, t_speed + step * n_ramp)
+        if slowest > 0:
+            n = min(n_ramp, int((boundary - tail_x) / (slowest * time_step_length)) + 2, 4096)
+        else:
+            n = min(n_ramp, 4096)
+        speed = np.cumsum(np.concatenate(([t_speed], np.full(n, step))))
+        # Step k is in this phase while the speed before it is still below (above) the band.
+        if step > 0:
+            in_phase = speed[:-1] < low
+        elif step < 0:
+            in_phase = speed[:-1] > high
+        else:
+            in_phase = np.ones(n, dtype=bool)
+        m = n if in_phase.all() else int(np.argmin(in_phase))
+        x = np.cumsum(np.concatenate(([tail_x], speed[1:m + 1] * time_step_length)))
+        # ... and while the tail is still on this lane (before total_len) when it starts.
+        on_lane = x[:-1] < boundary
+        if not on_lane.all():
+            m = int(np.argmin(on_lane))
+        t = np.cumsum(np.concatenate(([t_time], np.full(m, time_step_length))))
+        times.append(t[1:])
+        xs.append(x[1:m + 1])
+        speeds.append(speed[1:m + 1])
+        t_time, tail_x, t_speed = t[m], x[m], speed[m]
+    if not times:
+        return np.array([]), np.array([]), np.array([])
+    return np.concatenate(times), np.concatenate(xs), np.concatenate(speeds)
+
+
 def test_scale_series():
     # Given parameters
     T = 100  # Example interval end. Represents the maximum time value for the function.
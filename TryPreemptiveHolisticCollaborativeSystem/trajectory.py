@@ -0,0 +1,205 @@
+import numpy as np
+
+
+class LaneTable:
+    """
+    Shared table of lane IDs. Trajectories store a small integer code per sample instead of the lane ID string,
+    the table translates the codes back when a lane ID is needed (e.g. for traci.vehicle.moveTo).
+    """
+    __slots__ = ('ids', 'codes')
+
+    def __init__(self):
+        self.ids = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def code(self, lane_id):
+        t_code = self.codes.get(lane_id)
+        if t_code is None:
+            t_code = len(self.ids)
+            self.codes[lane_id] = t_code
+            self.ids.append(lane_id)
+        return t_code
+
+    def lane_id(self, code):
+        return self.ids[code]
+
+
+class Trajectory:
+    """
+    Scheduled trajectory of one vehicle, stored column-wise in fixed dtype arrays.
+
+    - time: simulation time of every sample.
+    - x: travelled distance of the vehicle (tail) along its route.
+    - speed: planned speed.
+    - lane_code: code of the lane (in lane_table) the front of the vehicle is on.
+    - lane_position: position of the front of the vehicle on that lane.
+    - geometry: RouteGeometry of the route of the vehicle.
+    """
+    __slots__ = ('vehicle', 'time', 'x', 'speed', 'lane_code', 'lane_position', 'space_len', 'geometry', 'cursor')
+
+    # time, x and speed are fed back into the planner (continuation speed, leader samples), keep them in double.
+    TIME_DTYPE = np.float64
+    X_DTYPE = np.float64
+    SPEED_DTYPE = np.float64
+    LANE_CODE_DTYPE = np.int16
+    LANE_POSITION_DTYPE = np.float32
+
+    def __init__(self, vehicle, time, x, speed, lane_code, lane_position, space_len, geometry):
+        self.vehicle = vehicle
+        self.time = np.asarray(time, dtype=self.TIME_DTYPE)
+        self.x = np.asarray(x, dtype=self.X_DTYPE)
+        self.speed = np.asarray(speed, dtype=self.SPEED_DTYPE)
+        self.lane_code = np.asarray(lane_code, dtype=self.LANE_CODE_DTYPE)
+        self.lane_position = np.asarray(lane_position, dtype=self.LANE_POSITION_DTYPE)
+        self.space_len = space_len
+        self.geometry = geometry
+        # Read index of the controller, advanced monotonically by index_at.
+        self.cursor = 0
+        # The arrays are shared without copying (leader trajectories read by the follow kernel, head() slices, the
+        # buffers the arrays were composed in), so they are read-only once they belong to a trajectory.
+        for t_column in (self.time, self.x, self.speed, self.lane_code, self.lane_position):
+            t_column.flags.writeable = False
+
+    @classmethod
+    def concatenate(cls, time, x, speed, lane_code, lane_position, vehicle, space_len, geometry):
+        """
+        Builds a trajectory from parts of its columns (a tuple of arrays per column), each column written once into
+        a buffer of the final length and dtype.
+        """
+        columns = []
+        for parts, dtype in ((time, cls.TIME_DTYPE), (x, cls.X_DTYPE), (speed, cls.SPEED_DTYPE),
+                             (lane_code, cls.LANE_CODE_DTYPE), (lane_position, cls.LANE_POSITION_DTYPE)):
+            buffer = np.empty(sum(len(t_part) for t_part in parts), dtype=dtype)
+            np.concatenate(parts, out=buffer, casting='same_kind')
+            columns.append(buffer)
+        return cls(vehicle, *columns, space_len, geometry)
+
+    def __len__(self):
+        return len(self.time)
+
+    def start_state(self):
+        """
+        Time, x and speed of the first sample.
+        """
+        return self.time[0], self.x[0], self.speed[0]
+
+    def end_state(self):
+        """
+        Time, x and speed of the last sample.
+        """
+        return self.time[-1], self.x[-1], self.speed[-1]
+
+    def index_at(self, t):
+        """
+        Index of the first sample at or after time t, None when the trajectory ends before t.
+
+        Simulation time only moves forward, so the lookup continues from the previous read index and costs O(1)
+        per step. Going back in time, or jumping far ahead, falls back to a binary search.
+        """
+        time = self.time
+        n = len(time)
+        c = min(self.cursor, n)
+        if c > 0 and time[c - 1] >= t:
+            c = int(np.searchsorted(time, t, side='left'))
+        else:
+            steps = 0
+            while c < n and time[c] < t:
+                c += 1
+                steps += 1
+                if steps > 8:
+                    c = int(np.searchsorted(time, t, side='left'))
+                    break
+        self.cursor = c
+        if c >= n:
+            return None
+        return c
+
+    def lane_id(self, index):
+        return self.geometry.lane_table.ids[self.lane_code[index]]
+
+    def position_at(self, t, slack):
+        """
+        x at the first sample at or after time t, None after the end or more than slack (s) before the start. Not
+        index_at: its cursor belongs to the controller.
+        """
+        idx = int(np.searchsorted(self.time, t, side='left'))
+        if idx >= len(self.time) or (idx == 0 and self.time[0] > t + slack):
+            return None
+        return float(self.x[idx])
+
+    def target_at(self, t, interpolate=False):
+        """
+        Where the vehicle is to be at simulation time t, None when the trajectory ends before t.
+
+        A trajectory planned at the simulation step gives its first sample at or after t. One planned at a coarser
+        resolution (interpolate) is interpolated linearly between the samples around t, on demand: the tail x, and
+        the front at the distance from the tail it has in the first sample, located on the route as the planner
+        locates it.
+
+        Parameters:
+        - t: simulation time.
+        - interpolate: whether the trajectory is sampled more coarsely than the simulation.
+
+        Returns:
+        - ControlTarget.
+        """
+        idx = self.index_at(t)
+        if idx is None:
+            return None
+        if not interpolate or idx == 0:
+            return ControlTarget(self.time[idx], idx, self.x[idx], self.lane_id(idx), self.lane_position[idx])
+        time = self.time
+        geometry = self.geometry
+        weight = (t - time[idx - 1]) / (time[idx] - time[idx - 1])
+        x = self.x[idx - 1] + (self.x[idx] - self.x[idx - 1]) * weight
+        front = geometry.distance_of(self.lane_id(0), self.lane_position[0]) - self.x[0]
+        lane_code, lane_position = geometry.locate(np.array([x + front]))
+        return ControlTarget(t, idx, x, geometry.lane_table.ids[lane_code[0]], lane_position[0])
+
+    def head(self, length):
+        """
+        The first `length` samples of the trajectory, as a new trajectory sharing the arrays. A trajectory is never
+        changed once built: the controller may be reading it while the planner works (AsyncTrajectoryMerge).
+        """
+        return Trajectory(self.vehicle, self.time[:length], self.x[:length], self.speed[:length],
+                          self.lane_code[:length], self.lane_position[:length], self.space_len, self.geometry)
+
+    def drop_before(self, t):
+        """
+        The trajectory without its samples before time t (keeping the last one before it). The remaining samples are
+        copied into a new trajectory only once the past is at least half of the trajectory (slices would keep the
+        whole arrays alive), until then the trajectory itself is returned.
+        """
+        idx = max(int(np.searchsorted(self.time, t, side='left')) - 1, 0)
+        if idx == 0 or 2 * idx < len(self.time):
+            return self
+        t_trajectory = Trajectory(self.vehicle, self.time[idx:].copy(), self.x[idx:].copy(), self.speed[idx:].copy(),
+                                  self.lane_code[idx:].copy(), self.lane_position[idx:].copy(), self.space_len,
+                                  self.geometry)
+        t_trajectory.cursor = max(self.cursor - idx, 0)
+        return t_trajectory
+
+    def nbytes(self):
+        return (self.time.nbytes + self.x.nbytes + self.speed.nbytes + self.lane_code.nbytes +
+                self.lane_position.nbytes)
+
+
+class ControlTarget:
+    """
+    Target of the controller for one vehicle at one simulation step (Trajectory.target_at).
+
+    - time: time of the target, the sample time when it is a sample of the trajectory.
+    - index: first sample of the trajectory at or after the simulation time.
+    - x, lane_id, lane_position: tail distance along the route, lane and position on the lane of the front.
+    """
+    __slots__ = ('time', 'index', 'x', 'lane_id', 'lane_position')
+
+    def __init__(self, time, index, x, lane_id, lane_position):
+        self.time = time
+        self.index = index
+        self.x = x
+        self.lane_id = lane_id
+        self.lane_position = lane_position
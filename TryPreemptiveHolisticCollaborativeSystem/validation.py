@@ -0,0 +1,94 @@
+import json
+import numpy as np
+
+CHECKS = ('time', 'position', 'speed', 'acceleration', 'gap')
+
+
+def check_trajectory(t_trajectory, params, tolerance=1e-6, acceleration_tolerance=0.1):
+    """
+    Checks a trajectory against the limits of its vehicle, as driven: the speed and the acceleration are the ones of
+    the positions x (what SUMO is moved along), not of the planned speed column.
+
+    - time: the times are strictly increasing.
+    - position: x never decreases (by more than tolerance).
+    - speed: 0 <= speed <= params.max_speed (within tolerance).
+    - acceleration: -params.decel <= acceleration <= params.accel (within acceleration_tolerance).
+
+    Parameters:
+    - t_trajectory: Trajectory to check.
+    - params: VehicleParams of the vehicle.
+
+    Returns:
+    - {check: (worst value, time of the first violation)} of the failed checks.
+    """
+    time, x = t_trajectory.time, t_trajectory.x
+    failed = {}
+    if len(time) < 2:
+        return failed
+    dt = np.diff(time)
+    if dt.min() <= 0:
+        failed['time'] = (float(dt.min()), float(time[np.argmax(dt <= 0)]))
+        # The speeds of non-increasing times are meaningless.
+        return failed
+    dx = np.diff(x)
+    if dx.min() < -tolerance:
+        failed['position'] = (float(dx.min()), float(time[np.argmax(dx < -tolerance)]))
+    speed = dx / dt
+    bad = (speed < -tolerance) | (speed > params.max_speed + tolerance)
+    if bad.any():
+        worst = speed.max() if speed.max() > params.max_speed + tolerance else speed.min()
+        failed['speed'] = (float(worst), float(time[np.argmax(bad)]))
+    if len(speed) > 1:
+        acceleration = np.diff(speed) / dt[1:]
+        bad = ((acceleration > params.accel + acceleration_tolerance) |
+               (acceleration < -params.decel - acceleration_tolerance))
+        if bad.any():
+            worst = acceleration[np.argmax(np.abs(acceleration))]
+            failed['acceleration'] = (float(worst), float(time[np.argmax(bad) + 1]))
+    return failed
+
+
+class ValidationReport:
+    """
+    Violations found in the plans of a run, per check (CHECKS): how many plans failed it, the vehicles (in the
+    order they failed, each once) and the worst value seen.
+
+    Usage:
+        report.plan()
+        report.violation('acceleration', vehicle, value, time)
+        report.export(path)
+    """
+    def __init__(self):
+        self.plans = 0
+        self.counts = {name: 0 for name in CHECKS}
+        # {check: {vehicle: time of its first violation}}
+        self.vehicles = {name: {} for name in CHECKS}
+        self.worst = {name: None for name in CHECKS}
+
+    def plan(self):
+        self.plans += 1
+
+    def violation(self, name, vehicle, value, t):
+        self.counts[name] += 1
+        self.vehicles[name].setdefault(vehicle, t)
+        if self.worst[name] is None or abs(value) > abs(self.worst[name]):
+            self.worst[name] = value
+
+    def to_dict(self):
+        return {'plans': self.plans,
+                'checks': {name: {'violations': self.counts[name], 'worst': self.worst[name],
+                                  'vehicles': self.vehicles[name]} for name in CHECKS}}
+
+    def export(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+    def summary(self):
+        """
+        One line per check: violations, vehicles and worst value.
+        """
+        lines = [f"{self.plans} plans checked"]
+        for name in CHECKS:
+            worst = '' if self.worst[name] is None else f", worst {self.worst[name]:.3f}"
+            lines.append(f"{name:>26}: {self.counts[name]:7d} violations, {len(self.vehicles[name])} vehicles{worst}")
+        return "\n".join(lines)
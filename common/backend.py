@@ -0,0 +1,73 @@
+"""
+Selects how the simulation drivers talk to SUMO.
+
+- traci: SUMO runs as a separate process, every TraCI call is a round-trip over a TCP socket.
+- libsumo: SUMO runs inside the Python process, the calls are plain function calls. Same API as traci, but no
+  sumo-gui and one simulation per process (the sweep already runs every simulation in its own process).
+
+The traci package itself imports libsumo in its place when the environment variable LIBSUMO_AS_TRACI is set (and falls
+back to traci when libsumo is not installed), so select_backend only has to set it before traci is first imported;
+every module importing traci, the drivers as well as the shared modules, then gets the same backend.
+
+Usage (at the top of a driver, before importing traci or modules importing it):
+    from backend import select_backend
+    select_backend()
+    import traci
+"""
+import argparse
+import importlib.util
+import os
+import sys
+
+BACKENDS = ('traci', 'libsumo')
+# Environment variable choosing the backend when there is no --backend flag on the command line.
+ENVIRONMENT = 'SUMO_BACKEND'
+# The missing libsumo is reported once per process.
+_reported = []
+
+
+def requested_backend(argv=None):
+    """
+    The backend asked for by --backend on the command line, else by SUMO_BACKEND, else traci.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--backend', choices=BACKENDS, default=None)
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    name = args.backend or os.environ.get(ENVIRONMENT, 'traci')
+    if name not in BACKENDS:
+        raise ValueError(f"unknown SUMO backend {name!r} ({ENVIRONMENT}), expected one of {BACKENDS}")
+    return name
+
+
+def select_backend(name=None):
+    """
+    Makes the next `import traci` load the given backend (requested_backend() by default). libsumo falls back to traci
+    when it is not installed.
+
+    Returns:
+    - name of the backend that will be used.
+    """
+    name = name or requested_backend()
+    if name == 'libsumo' and importlib.util.find_spec('libsumo') is None:
+        if not _reported:
+            print("libsumo is not installed (pip install libsumo), using traci")
+            _reported.append(name)
+        name = 'traci'
+    if 'traci' in sys.modules and active_backend() != name:
+        raise RuntimeError(f"traci has already been imported with the {active_backend()} backend")
+    if name == 'libsumo':
+        # 'quiet': traci does not announce the switch.
+        os.environ['LIBSUMO_AS_TRACI'] = 'quiet'
+    else:
+        os.environ.pop('LIBSUMO_AS_TRACI', None)
+    return name
+
+
+def active_backend():
+    """
+    Name of the backend traci has been imported with.
+    """
+    traci = sys.modules.get('traci')
+    if traci is not None and traci.isLibsumo():
+        return 'libsumo'
+    return 'traci'
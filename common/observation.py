@@ -0,0 +1,47 @@
+import traci
+import traci.constants as tc
+
+
+class VehicleObserver:
+    """
+    Reads the state of every vehicle in the simulation from one TraCI response per step.
+
+    Every vehicle is subscribed to VARIABLES when it departs. SUMO then sends the values of all subscribed vehicles
+    together with the reply to simulationStep, so the control loops do not need one get* round-trip per vehicle
+    and variable.
+
+    Usage:
+        observer = VehicleObserver()
+        while ...:
+            traci.simulationStep()
+            states = observer.update()
+            speed = states[vehicle_id][VehicleObserver.SPEED]
+    """
+    DISTANCE = tc.VAR_DISTANCE
+    LANE_POSITION = tc.VAR_LANEPOSITION
+    LANE_ID = tc.VAR_LANE_ID
+    SPEED = tc.VAR_SPEED
+    TIME_LOSS = tc.VAR_TIMELOSS
+    FUEL_CONSUMPTION = tc.VAR_FUELCONSUMPTION
+    VARIABLES = (DISTANCE, LANE_POSITION, LANE_ID, SPEED, TIME_LOSS, FUEL_CONSUMPTION)
+
+    def __init__(self, variables=VARIABLES):
+        self.variables = variables
+        # {vehicle_id: {variable: value}} of the last step.
+        self.states = {}
+        traci.simulation.subscribe((tc.VAR_DEPARTED_VEHICLES_IDS,))
+
+    def update(self):
+        """
+        To be called right after traci.simulationStep(). Subscribes the vehicles that departed in this step and
+        returns the states of all the vehicles in the simulation.
+        """
+        departed = traci.simulation.getSubscriptionResults().get(tc.VAR_DEPARTED_VEHICLES_IDS, ())
+        for t_vehicle in departed:
+            try:
+                # The reply to subscribe already carries the current values of the vehicle.
+                traci.vehicle.subscribe(t_vehicle, self.variables)
+            except traci.TraCIException as e:
+                print(f"subscribe vehicle {t_vehicle} failed: {repr(e)}")
+        self.states = traci.vehicle.getAllSubscriptionResults()
+        return self.states
@@ -0,0 +1,51 @@
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+from telemetry import load_steps
+
+
+def draw_td(out_dir, e_flow, r_flow, flow_values=('m', 'r'), show=False):
+    """
+    Draws the time-distance diagram of every flow in flow_values, coloured by speed, into
+    out_dir/(flow_value, e_flow, r_flow)_td.png.
+
+    The samples are loaded once for all the flows, and the points of a flow are drawn with a single scatter call
+    (ordered by vehicle and time, so the vehicles overlap as when drawn one by one).
+
+    Parameters:
+    - out_dir: output directory of the run.
+    - e_flow, r_flow: main road and ramp flows (veh/h) of the run.
+    - flow_values: 'm' for the main road vehicles, 'r' for the ramp vehicles.
+    - show: show the figures after saving them.
+    """
+    # 设置中文显示
+    plt.rcParams['font.sans-serif'] = ['SimHei']
+    plt.rcParams['axes.unicode_minus'] = False
+
+    # 读取数据
+    data = load_steps(out_dir, e_flow, r_flow, columns=('id', 'flow', 'time', 'x', 'speed'))
+    flow = data['flow'].to_numpy()
+    time = data['time'].to_numpy()
+    distance = np.abs(data['x'].to_numpy())
+    speed = data['speed'].to_numpy()
+
+    for flow_value in flow_values:
+        # 根据 flow 列筛选数据
+        mask = flow == flow_value
+
+        # 绘制轨迹图
+        fig = plt.figure(figsize=(16, 9), dpi=300)
+        plt.xticks(fontproperties="Times New Roman", size=12)
+        plt.yticks(fontproperties="Times New Roman", size=12)
+        plt.ylabel('位置 (m)')
+        plt.xlabel('时间 (s)')
+        plt.scatter(time[mask], distance[mask], marker='.', s=1, c=speed[mask], cmap='jet_r', vmin=0, vmax=25)
+        plt.colorbar(label='速度 (m/s)')
+        # 保存图形为图片文件. plt.savefig would render the figure a second time (draw_idle) after saving it.
+        fig.savefig(os.path.join(out_dir, f'{flow_value, e_flow, r_flow}_td.png'), format='png', dpi=300)
+        if not show:
+            plt.close(fig)
+
+    # 显示图形
+    if show:
+        plt.show()
@@ -0,0 +1,153 @@
+"""
+Headless parameter sweep over the three strategies.
+
+Every (strategy, e_flow, r_flow, seed) combination is simulated with sumo (no GUI) in its own worker process, with its
+own route file, output directory and TraCI connection label, so any number of them can run at the same time. The delay
+summary of every run is collected into one table, <out>/summary.csv.
+
+Example (from the repository root):
+    python common/sweep.py --e-flow 1200 1800 --r-flow 800 1600 --seed 1024 1025 --time 600 --workers 8
+"""
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import pandas as pd
+from backend import BACKENDS, ENVIRONMENT, select_backend
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# strategy: (directory, driver script)
+STRATEGIES = {'PreemptiveMerge': ('TryPreemptiveHolisticCollaborativeSystem', 'PreemptiveMerge.py'),
+              'BaseLine': ('BaseLine', 'run_simulation.py'),
+              'Krauss_LC2013': ('Krauss_LC2013', 'run_simulation.py')}
+
+
+def load_driver(strategy):
+    """
+    Imports the driver script of a strategy as a module. Its directory goes first on sys.path, so the driver finds
+    its own helper modules (tools, preemptive_follow, ...).
+    """
+    directory, script = STRATEGIES[strategy]
+    directory = os.path.join(ROOT, directory)
+    sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(f"driver_{strategy}", os.path.join(directory, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_case(case):
+    """
+    Runs one simulation in the current (worker) process and returns one row of the summary table.
+    """
+    strategy, e_flow, r_flow, seed, t, out_root, sumo_binary, actuation, backend, planner, resolution, representation = case
+    out_dir = os.path.join(out_root, strategy, f"{e_flow}_{r_flow}_{seed}")
+    os.makedirs(out_dir, exist_ok=True)
+    row = {'strategy': strategy, 'e_flow': e_flow, 'r_flow': r_flow, 'seed': seed, 'out_dir': out_dir}
+    start = time.perf_counter()
+    # The drivers and sumo (a child process writing to the inherited descriptors) print a lot while running, keep it
+    # in a log file per run instead of interleaving the workers. A worker only ever runs one case.
+    with open(os.path.join(out_dir, 'run.log'), 'w', encoding='utf-8') as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            # Before the driver imports traci; the driver selects the backend again from SUMO_BACKEND.
+            os.environ[ENVIRONMENT] = select_backend(backend)
+            driver = load_driver(strategy)
+            binary = sumo_binary or driver.sumo_cli
+            label = f"{strategy}_{e_flow}_{r_flow}_{seed}"
+            # Only the PreemptiveMerge driver controls the vehicles itself.
+            options = {}
+            if strategy == 'PreemptiveMerge':
+                options = {'actuation': actuation, 'planner': planner, 'resolution': resolution,
+                           'representation': representation}
+            row.update(driver.simulate(e_flow, r_flow, t, seed, out_dir, binary, label, **options))
+            row['error'] = ''
+        except Exception as e:
+            traceback.print_exc()
+            row['error'] = repr(e)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    row['wall_time'] = time.perf_counter() - start
+    return row
+
+
+def sweep(strategies, e_flows, r_flows, seeds, t=600, out_root=None, workers=None, sumo_binary=None,
+          actuation='moveTo', backend='traci', planner='sync', resolution=None, representation='dense'):
+    """
+    Runs all the combinations of the given parameters in a process pool.
+
+    Parameters:
+    - strategies: keys of STRATEGIES.
+    - e_flows, r_flows: main road and ramp flows (veh/h).
+    - seeds: SUMO random seeds.
+    - t: simulated time of every run (s).
+    - out_root: directory of the run outputs and of summary.csv.
+    - workers: number of parallel simulations, the number of CPUs by default.
+    - sumo_binary: sumo executable, the sumo_cli of each driver by default.
+    - actuation: how PreemptiveMerge drives the vehicles along their trajectories, see its run_sumo.
+    - backend: 'traci' or 'libsumo' (in-process SUMO, falls back to traci when not installed), see backend.py.
+    - planner: whether PreemptiveMerge plans in the step loop ('sync') or in a worker thread ('async').
+    - resolution: time step of the PreemptiveMerge trajectories (s), the simulation step length by default.
+    - representation: how PreemptiveMerge stores the trajectories, 'dense' samples or 'piecewise' polynomials.
+
+    Returns:
+    - pandas DataFrame with one row per run.
+    """
+    out_root = os.path.abspath(out_root or os.path.join(ROOT, 'sweep_output'))
+    cases = [(strategy, e_flow, r_flow, seed, t, out_root, sumo_binary, actuation, backend, planner, resolution,
+              representation)
+             for strategy in strategies for e_flow in e_flows for r_flow in r_flows for seed in seeds]
+    workers = min(workers or os.cpu_count() or 1, len(cases))
+    # spawn: every run starts from a clean interpreter (the drivers keep state in module globals), and a worker is
+    # replaced after each run for the same reason.
+    with multiprocessing.get_context('spawn').Pool(workers, maxtasksperchild=1) as pool:
+        rows = []
+        for row in pool.imap_unordered(run_case, cases):
+            status = row['error'] or f"avg delay {row.get('avg_delay', float('nan')):.2f} s"
+            print(f"{row['strategy']} e_flow={row['e_flow']} r_flow={row['r_flow']} seed={row['seed']}: "
+                  f"{status} ({row['wall_time']:.1f} s)")
+            rows.append(row)
+    summary = pd.DataFrame(rows).sort_values(['strategy', 'e_flow', 'r_flow', 'seed']).reset_index(drop=True)
+    os.makedirs(out_root, exist_ok=True)
+    summary.to_csv(os.path.join(out_root, 'summary.csv'), index=False)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless parallel sweep of the merge strategies.")
+    parser.add_argument('--strategy', nargs='+', default=list(STRATEGIES), choices=list(STRATEGIES))
+    parser.add_argument('--e-flow', nargs='+', type=int, default=[1800], help="main road flows (veh/h)")
+    parser.add_argument('--r-flow', nargs='+', type=int, default=[1600], help="ramp flows (veh/h)")
+    parser.add_argument('--seed', nargs='+', type=int, default=[1024])
+    parser.add_argument('--time', type=float, default=600, help="simulated time of every run (s)")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default=None, help="output directory, <repository>/sweep_output by default")
+    parser.add_argument('--sumo-binary', default=None, help="sumo executable, /usr/bin/sumo on Linux by default")
+    parser.add_argument('--actuation', default='moveTo', choices=['moveTo', 'keyframes'],
+                        help="PreemptiveMerge: moveTo every step, or speed keyframes with drift corrections")
+    parser.add_argument('--backend', default=os.environ.get(ENVIRONMENT, 'traci'), choices=BACKENDS,
+                        help="SUMO backend, SUMO_BACKEND or traci by default")
+    parser.add_argument('--planner', default='sync', choices=['sync', 'async'],
+                        help="PreemptiveMerge: plan in the step loop, or in a worker thread with a deadline per step")
+    parser.add_argument('--resolution', type=float, default=None,
+                        help="PreemptiveMerge: planning time step (s), the simulation step length by default")
+    parser.add_argument('--representation', default='dense', choices=['dense', 'piecewise'],
+                        help="PreemptiveMerge: store the trajectories as samples, or as piecewise polynomials")
+    args = parser.parse_args()
+
+    summary = sweep(args.strategy, args.e_flow, args.r_flow, args.seed, args.time, args.out, args.workers,
+                    args.sumo_binary, args.actuation, args.backend, args.planner, args.resolution,
+                    args.representation)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(summary.drop(columns=['out_dir']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import csv
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+
+class TelemetryRecorder:
+    """
+    Writes the outputs of a simulation run while it is running, so their size does not grow the memory of the run.
+
+    - data_step(e_flow, r_flow)/part-*.npz: the per vehicle samples (`columns`, STEP_COLUMNS by default), buffered
+      column-wise and written in shards of chunk_size rows. load_steps reads them back as one DataFrame.
+    - data_avg_speed(e_flow, r_flow).csv: average speed of each flow in every `interval` seconds, accumulated while
+      recording.
+    - data_td_3d(e_flow, r_flow).csv and data_fuel(e_flow, r_flow).csv: written row by row.
+    - data_timeloss.csv: the last time loss of every vehicle, written by close().
+
+    Usage:
+        recorder = TelemetryRecorder(out_dir, e_flow, r_flow)
+        while ...:
+            recorder.record_step(vehicle, flow, time, x, speed, lane, position, distance)
+        recorder.close()
+    """
+    STEP_COLUMNS = ('id', 'flow', 'time', 'x', 'speed', 'lane', 'position', 'distance')
+
+    def __init__(self, out_dir, e_flow, r_flow, columns=STEP_COLUMNS, chunk_size=65536, interval=5):
+        self.out_dir = out_dir
+        # 'flow', 'time' and 'speed' are needed for the average speeds.
+        self.column_names = columns
+        self.flow_index = columns.index('flow')
+        self.time_index = columns.index('time')
+        self.speed_index = columns.index('speed')
+        self.e_flow, self.r_flow = e_flow, r_flow
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.step_dir = step_directory(out_dir, e_flow, r_flow)
+        os.makedirs(self.step_dir, exist_ok=True)
+        # Shards of a previous run with the same flows would be read back together with this one.
+        for t_file in glob.glob(os.path.join(self.step_dir, 'part-*.npz')):
+            os.remove(t_file)
+        self.columns = [[] for _ in columns]
+        self.n_rows = 0
+        self.n_shards = 0
+        # {(flow, time_interval): [speed sum, sample count]}
+        self.speed_sum = {}
+        self.timeloss = {}
+        self.td_3d_file = open(os.path.join(out_dir, f"data_td_3d{e_flow, r_flow}.csv"), 'w', newline='')
+        self.td_3d_writer = csv.writer(self.td_3d_file)
+        self.td_3d_writer.writerow(['id', 'time', 'lane', 'distance'])
+        self.fuel_file = open(os.path.join(out_dir, f"data_fuel{e_flow, r_flow}.csv"), 'w', newline='')
+        self.fuel_writer = csv.writer(self.fuel_file)
+        self.fuel_writer.writerow(['time', 'fuel_sum'])
+
+    def record_step(self, *values):
+        """
+        Records one sample, values in the order of `columns`.
+        """
+        for t_column, value in zip(self.columns, values):
+            t_column.append(value)
+        key = (values[self.flow_index], (values[self.time_index] // self.interval) * self.interval)
+        speed = values[self.speed_index]
+        t_sum = self.speed_sum.get(key)
+        if t_sum is None:
+            self.speed_sum[key] = [speed, 1]
+        else:
+            t_sum[0] += speed
+            t_sum[1] += 1
+        self.n_rows += 1
+        if self.n_rows == self.chunk_size:
+            self.flush()
+
+    def record_td_3d(self, vehicle, time, lane, distance):
+        self.td_3d_writer.writerow([vehicle, time, lane, distance])
+
+    def record_fuel(self, time, fuel_sum):
+        self.fuel_writer.writerow([time, fuel_sum])
+
+    def record_timeloss(self, vehicle, timeloss):
+        self.timeloss[vehicle] = timeloss
+
+    def flush(self):
+        """
+        Writes the buffered samples as one shard.
+        """
+        if self.n_rows == 0:
+            return
+        shard = {name: np.array(values) for name, values in zip(self.column_names, self.columns)}
+        np.savez(os.path.join(self.step_dir, f"part-{self.n_shards:05d}.npz"), **shard)
+        self.n_shards += 1
+        self.columns = [[] for _ in self.column_names]
+        self.n_rows = 0
+
+    def close(self):
+        self.flush()
+        self.td_3d_file.close()
+        self.fuel_file.close()
+        with open(os.path.join(self.out_dir, f"data_avg_speed{self.e_flow, self.r_flow}.csv"), 'w',
+                  newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['flow', 'time_interval', 'speed'])
+            for (flow, time_interval), (speed_sum, count) in sorted(self.speed_sum.items()):
+                writer.writerow([flow, time_interval, speed_sum / count])
+        with open(os.path.join(self.out_dir, 'data_timeloss.csv'), 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['id', 'Type', 'TimeLoss'])
+            for vehicle, timeloss in self.timeloss.items():
+                writer.writerow([vehicle, vehicle[0], timeloss])
+
+
+def step_directory(out_dir, e_flow, r_flow):
+    return os.path.join(out_dir, f"data_step{e_flow, r_flow}")
+
+
+def load_steps(out_dir, e_flow, r_flow, columns=None):
+    """
+    Reads the per vehicle samples written by TelemetryRecorder.
+
+    Parameters:
+    - columns: names of the columns to read (must include 'id'), all the recorded columns by default.
+
+    Returns:
+    - DataFrame with the columns, ordered by vehicle and time.
+    """
+    shards = sorted(glob.glob(os.path.join(step_directory(out_dir, e_flow, r_flow), 'part-*.npz')))
+    names = columns
+    columns = {}
+    for t_file in shards:
+        with np.load(t_file) as shard:
+            # The arrays of an npz file are only read when accessed.
+            for name in names or shard.files:
+                columns.setdefault(name, []).append(shard[name])
+    if not columns:
+        # No shard was written (a run without vehicles): the columns, without rows.
+        return pd.DataFrame({name: np.empty(0) for name in names or TelemetryRecorder.STEP_COLUMNS})
+    data = pd.DataFrame({name: np.concatenate(values) for name, values in columns.items()})
+    return data.sort_values('id', kind='stable').reset_index(drop=True)